@@ -1,80 +1,831 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, redirect, stream_with_context
 import yt_dlp
+import hashlib
+import hmac
+import itertools
+import json
+import re
 import threading
+import time
 import uuid
 import os
+from urllib.parse import quote
 from flask_cors import CORS # Added for safety across networks
+from scheduler import DownloadScheduler, PRIORITIES
+from job_queue import create_job_queue
+import postprocess
+import info_cache
+from info_cache import InfoCache, canonical_key
+from task_store import create_task_store, is_terminal
+from library import FileLibrary, SORT_KEYS
+from file_serving import serve_file, content_disposition
+from file_store import create_file_store
+from tuning import parse_tuning, fragment_share, ydl_tuning_options
+from formats import format_table, parse_format, resolve
+from bandwidth import BandwidthManager
+from storage import StorageManager
+import streaming
+from metrics import Registry, LATENCY_BUCKETS, RATE_BUCKETS, render, error_category
 
 app = Flask(__name__)
 CORS(app) # Enable CORS for all routes
 
 # NOTE: Must match the volume mount in docker-compose.yml
-DOWNLOAD_FOLDER = '/app/downloads'
+DOWNLOAD_FOLDER = os.environ.get('DOWNLOAD_FOLDER', '/app/downloads')
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
-TASK_STATUS = {}
+# Number of downloads allowed to run at the same time; the rest wait in the queue
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', '3'))
 
+# Parallel fragment connections shared by this node's downloads (see tuning.fragment_share)
+FRAGMENT_BUDGET = int(os.environ.get('FRAGMENT_BUDGET', str(4 * MAX_CONCURRENT_DOWNLOADS)))
+# Connection knobs used where a download request does not set its own "tuning"
+TUNING_DEFAULTS = {
+    'http_chunk_size': int(os.environ.get('HTTP_CHUNK_SIZE', str(10 << 20))),
+    'buffer_size': int(os.environ.get('DOWNLOAD_BUFFER_SIZE', str(64 << 10))),
+    'retries': int(os.environ.get('DOWNLOAD_RETRIES', '10')),
+    'retry_backoff': float(os.environ.get('RETRY_BACKOFF', '1')),
+    'retry_backoff_max': float(os.environ.get('RETRY_BACKOFF_MAX', '30')),
+}
+
+# Whole-task retries after a transient network failure, on top of yt-dlp's per-request retries.
+# The wait starts at TASK_RETRY_BACKOFF seconds and doubles per attempt up to TASK_RETRY_BACKOFF_MAX
+TASK_RETRIES = int(os.environ.get('TASK_RETRIES', '3'))
+TASK_RETRY_BACKOFF = float(os.environ.get('TASK_RETRY_BACKOFF', '10'))
+TASK_RETRY_BACKOFF_MAX = float(os.environ.get('TASK_RETRY_BACKOFF_MAX', '300'))
+
+# Seconds a job may wait for a download slot before a running download of lower priority
+# is paused to make room for it (0 = never preempt). The paused download resumes afterwards
+PREEMPT_AFTER = float(os.environ.get('PREEMPT_AFTER', '2'))
+# How often a worker checks its running tasks for cancellation requests made elsewhere
+INTERRUPT_POLL_INTERVAL = 0.5
+# How often a task that duplicates a running download checks whether that download is done
+DUPLICATE_POLL_INTERVAL = 5
+
+# Download bandwidth caps in bytes/s (0 = none): in total, and per client (API key or IP).
+# These are the defaults; PUT /admin/bandwidth changes them at runtime for every process
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', '0'))
+CLIENT_BANDWIDTH_LIMIT = int(os.environ.get('CLIENT_BANDWIDTH_LIMIT', '0'))
+# Required in the X-Admin-Token header of /admin endpoints; they are disabled while unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Progress updates written per task per second; the final update is always written
+PROGRESS_HZ = float(os.environ.get('PROGRESS_HZ', '2'))
+PROGRESS_INTERVAL = 1.0 / PROGRESS_HZ if PROGRESS_HZ > 0 else 0.0
+
+# Default number of entries of one playlist/batch downloading at the same time
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', str(MAX_CONCURRENT_DOWNLOADS)))
+
+# Seconds between checks of the downloads folder for files added or removed outside the API
+LIBRARY_SCAN_INTERVAL = float(os.environ.get('LIBRARY_SCAN_INTERVAL', '5'))
+
+# How /download/<filename> sends bytes: 'sendfile' (from this process, zero-copy under gunicorn),
+# 'x-accel' (nginx serves FILE_ACCEL_PREFIX/<name>) or 'x-sendfile' (Apache/lighttpd)
+FILE_SERVING_MODE = os.environ.get('FILE_SERVING_MODE', 'sendfile')
+FILE_ACCEL_PREFIX = os.environ.get('FILE_ACCEL_PREFIX', '/protected-downloads')
+
+# Where finished files are kept: local (in DOWNLOAD_FOLDER) or s3, which leaves DOWNLOAD_FOLDER
+# as scratch space for running downloads and serves files by redirecting to presigned URLs
+FILE_STORE = os.environ.get('FILE_STORE', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', '')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+# Unset for AWS; the URL of MinIO or another S3-compatible service otherwise
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+S3_REGION = os.environ.get('S3_REGION') or None
+# Multipart upload part size, and parts uploaded at once per file
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE', str(16 * 1024 * 1024)))
+S3_UPLOAD_CONCURRENCY = int(os.environ.get('S3_UPLOAD_CONCURRENCY', '8'))
+# Lifetime of the presigned URLs /download/<filename> redirects to, in seconds
+S3_URL_TTL = int(os.environ.get('S3_URL_TTL', '3600'))
+
+# Disk quota for the downloads folder in bytes; 0 = bounded only by the filesystem it is on,
+# with no eviction (downloads just wait while the disk is full)
+STORAGE_QUOTA = int(os.environ.get('STORAGE_QUOTA', '0'))
+# Finished files are evicted once usage passes the high watermark, down to the low one (fractions of the quota)
+STORAGE_HIGH_WATERMARK = float(os.environ.get('STORAGE_HIGH_WATERMARK', '0.9'))
+STORAGE_LOW_WATERMARK = float(os.environ.get('STORAGE_LOW_WATERMARK', '0.8'))
+# lru = least recently downloaded first, age = oldest first, off = never delete (downloads wait for space instead)
+STORAGE_EVICTION = os.environ.get('STORAGE_EVICTION', 'lru')
+STORAGE_CHECK_INTERVAL = float(os.environ.get('STORAGE_CHECK_INTERVAL', '10'))
+
+# GET /stream responses this process serves at once; each runs its own ffmpeg outside the download queue
+STREAM_LIMIT = int(os.environ.get('STREAM_LIMIT', '4'))
+STREAM_SLOTS = threading.BoundedSemaphore(STREAM_LIMIT)
+
+# Metadata cache shared by /info and the download workers (stream URLs expire, so keep the TTL modest)
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', '1800'))
+INFO_CACHE_SIZE = int(os.environ.get('INFO_CACHE_SIZE', '512'))
+
+# Options shared by every extraction, so /info results can be reused for the download
+BASE_YDL_OPTS = {
+    'quiet': True,
+    'noprogress': True,
+    'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
+    'source_address': '0.0.0.0',
+}
+# Playlists come back flat (ids and URLs only); their entries are extracted by the child tasks
+INFO_YDL_OPTS = dict(BASE_YDL_OPTS, extract_flat='in_playlist')
+
+# Number of API processes (see gunicorn.conf.py); more than one needs the shared task store
+API_WORKERS = int(os.environ.get('API_WORKERS', '1'))
+
+# 'all': this process serves the API and runs downloads. 'api': it only serves the API;
+# downloads run in worker.py processes, on this host or others, pulling from the shared queue
+NODE_ROLE = os.environ.get('NODE_ROLE', 'all')
+
+# Task registry: 'sqlite' survives restarts, 'memory' is wiped with the process,
+# 'shared' keeps tasks and the job queue in SQLite for several processes on one host,
+# 'redis' keeps them in Redis for processes on several hosts
+TASK_STORE = os.environ.get('TASK_STORE') or ('shared' if API_WORKERS > 1 or NODE_ROLE != 'all' else 'sqlite')
+if (API_WORKERS > 1 or NODE_ROLE != 'all') and TASK_STORE not in ('shared', 'redis'):
+    raise RuntimeError(f"API_WORKERS={API_WORKERS}, NODE_ROLE={NODE_ROLE} needs a shared task store, got '{TASK_STORE}'")
+TASK_DB_PATH = os.environ.get('TASK_DB_PATH', '/app/data/tasks.db')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Seconds a download stays leased to a worker without a heartbeat before another worker takes it over
+JOB_LEASE_TTL = int(os.environ.get('JOB_LEASE_TTL', '30'))
+# Seconds a finished task stays queryable through /status
+TASK_RETENTION = int(os.environ.get('TASK_RETENTION', str(24 * 3600)))
+
+# Seconds between publications of this process's metrics to the shared store, for /metrics on its peers
+METRICS_PUBLISH_INTERVAL = float(os.environ.get('METRICS_PUBLISH_INTERVAL', '5'))
+
+# Progress stream: minimum gap between pushed events, and keep-alive period when nothing changes
+STREAM_COALESCE_INTERVAL = float(os.environ.get('STREAM_COALESCE_INTERVAL', '0.5'))
+STREAM_KEEPALIVE = 15
+
+TASKS = create_task_store(TASK_STORE, TASK_DB_PATH, TASK_RETENTION, REDIS_URL)
+# API processes of one node share its cap on running downloads, counted over that node's jobs
+# only; every worker node brings its own MAX_CONCURRENT_DOWNLOADS slots on top
+QUEUE = create_job_queue(TASK_STORE, TASK_DB_PATH, MAX_CONCURRENT_DOWNLOADS if NODE_ROLE == 'all' else 0,
+                         REDIS_URL, JOB_LEASE_TTL)
+INFO_CACHE = InfoCache(INFO_CACHE_TTL, INFO_CACHE_SIZE)
+
+# --- METRICS ---
+METRICS = Registry()
+ACTIVE = METRICS.gauge('ytdl_active', 'Jobs in progress in this process, by stage', ['stage'])
+EXTRACT_SECONDS = METRICS.histogram('ytdl_extract_seconds', 'Metadata extraction latency')
+DOWNLOAD_SECONDS = METRICS.histogram('ytdl_download_seconds', 'Time spent fetching the streams of a task', labels=['type'])
+DOWNLOAD_RATE = METRICS.histogram('ytdl_download_bytes_per_second', 'Average transfer rate of a task', RATE_BUCKETS)
+POSTPROCESS_SECONDS = METRICS.histogram('ytdl_postprocess_seconds', 'Post-processing duration, by job and by whether'
+                                        ' streams were copied or re-encoded', labels=['kind', 'mode'])
+FILES_SECONDS = METRICS.histogram('ytdl_files_seconds', 'GET /files latency', LATENCY_BUCKETS)
+STREAM_FIRST_BYTE = METRICS.histogram('ytdl_stream_first_byte_seconds', 'GET /stream time to the first media byte')
+ERRORS = METRICS.counter('ytdl_errors_total', 'Failed tasks by cause', ['category'])
+RETRIES = METRICS.counter('ytdl_retries_total', 'Tasks sent back to the queue to resume', ['trigger'])
+EVICTIONS = METRICS.counter('ytdl_evicted_files_total', 'Finished files deleted to stay under the disk quota')
+EVICTED_BYTES = METRICS.counter('ytdl_evicted_bytes_total', 'Bytes freed by evicting files')
+INTERRUPTIONS = METRICS.counter('ytdl_interruptions_total', 'Tasks cancelled, or paused for a more urgent one', ['reason'])
+CACHE_LOOKUPS = METRICS.counter('ytdl_info_cache_lookups_total', 'Metadata cache lookups', ['result'])
+CACHE_HIT_RATIO = METRICS.gauge('ytdl_info_cache_hit_ratio', 'Metadata cache hits over lookups')
+
+# --- HELPER: METADATA ---
+def extract_info(url):
+    with ACTIVE.track(stage='extract'), EXTRACT_SECONDS.time():
+        return info_cache.extract_info(url, INFO_YDL_OPTS)
+
+def get_cached_info(url):
+    return INFO_CACHE.get_or_extract(url, extract_info)
+
+# Left in an info dict by format selection; yt-dlp downloads these instead of a newly selected format
+SELECTION_KEYS = ('requested_formats', 'requested_downloads')
+
+def unselected(info):
+    """A copy of an info dict ready for another format selection."""
+    return {k: v for k, v in info.items() if k not in SELECTION_KEYS}
+
+def info_summary(info):
+    """The part of an info dict the frontend card shows."""
+    result = {
+        "id": info.get('id'),
+        "title": info.get('title'),
+        "thumbnail": info.get('thumbnail'),
+        "duration": info.get('duration_string') or f"{info.get('duration', 0)} seconds"
+    }
+    if info.get('_type') == 'playlist':
+        result['playlist_count'] = len(info.get('entries') or [])
+    else:
+        # Any of these ids, or constraints on them, can be passed to /download as "format"
+        result['formats'] = format_table(info)
+    return result
+
+# --- HELPER: SIZE FORMATTING ---
+def format_size(size):
+    """Formats a byte count as a human-readable string."""
+    if size < 1024:
+        return f"{size} B"
+    elif size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    elif size < 1024 * 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MB"
+    return f"{size / (1024 * 1024 * 1024):.2f} GB"
+
+STORE = create_file_store(FILE_STORE, DOWNLOAD_FOLDER, S3_BUCKET, prefix=S3_PREFIX, endpoint_url=S3_ENDPOINT_URL,
+                          region=S3_REGION, part_size=S3_PART_SIZE, concurrency=S3_UPLOAD_CONCURRENCY,
+                          url_ttl=S3_URL_TTL)
+LIBRARY = FileLibrary(STORE, format_size, LIBRARY_SCAN_INTERVAL)
+
+# --- HELPER: FORMAT SELECTION ---
+# Formats are picked by formats.resolve from the cached format table. These strings are the
+# yt-dlp selectors the quality presets used to be; they stay as the presets' part of the
+# download key so files already on disk keep deduplicating
+def select_format(type_mode, quality):
+    if type_mode == 'video':
+        # The best format string for muxing video/audio
+        if quality == 'max': return 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+        elif quality == '1080p': return 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]/best'
+        elif quality == '720p': return 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]/best'
+        else: return 'bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]/best'
+    return 'bestaudio/best'
+
+def postprocess_settings(type_mode, quality):
+    # The legacy qualities map to 'mp3-320' and 'mp3-128', as their keys always said
+    return postprocess.audio_profile(quality) if type_mode == 'audio' else 'mux-mp4'
+
+def choose_formats(info, type_mode, quality, requested):
+    """Resolves a download's formats against the cached table (see formats.resolve)."""
+    keepable = None
+    if type_mode == 'audio':
+        profile = postprocess.audio_profile(quality)
+        keepable = lambda row: postprocess.can_copy_audio(profile, row['acodec'], row['abr'])
+    return resolve(format_table(info), type_mode, quality, requested, keepable)
+
+# --- DEDUPLICATION ---
+# Every output file is tagged with a hash of (video, format selector, post-processing settings),
+# so identical requests map to the same stable path and different ones never collide.
+# Running tasks are looked up by key in the task store, which lets one task at a time hold a key.
+COMPLETED = {}   # download key -> filename already in the file store
+COMPLETED_FINGERPRINT = [None]  # library fingerprint COMPLETED was last rebuilt from
+KEY_PATTERN = re.compile(r' \[([0-9a-f]{12})\]\.\w+$')
+
+def download_key(url, type_mode, quality, requested=None):
+    selection = select_format(type_mode, quality) if requested is None else f"format:{json.dumps(requested, sort_keys=True)}"
+    raw = f"{canonical_key(url)}|{selection}|{postprocess_settings(type_mode, quality)}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+def find_existing(key):
+    """Returns the finished file for a download key, if it is still on disk."""
+    if key not in COMPLETED and COMPLETED_FINGERPRINT[0] != LIBRARY.fingerprint:
+        # Files finished by another process only reach us through the library watcher
+        index_existing_files()
+    filename = COMPLETED.get(key)
+    if filename and STORE.stat(filename) is not None:
+        return filename
+    COMPLETED.pop(key, None)
+    return None
+
+def index_existing_files():
+    COMPLETED_FINGERPRINT[0] = LIBRARY.fingerprint
+    for filename in LIBRARY.names():
+        match = KEY_PATTERN.search(filename)
+        if match:
+            COMPLETED[match.group(1)] = filename
+
+# --- STORAGE ---
+def file_in_use(filename):
+    """Whether a running task owns the file (it is being written, or re-fetched after a change)."""
+    match = KEY_PATTERN.search(filename)
+    return bool(match) and TASKS.active_task_for_key(match.group(1)) is not None
+
+def on_evicted(filename, size):
+    LIBRARY.remove(filename)
+    match = KEY_PATTERN.search(filename)
+    if match and COMPLETED.get(match.group(1)) == filename:
+        del COMPLETED[match.group(1)]
+    EVICTIONS.inc()
+    EVICTED_BYTES.inc(size)
+
+# The in-process queue of the memory and sqlite stores forgets its settings on restart, so pins
+# are kept in a file next to the task database there
+STORAGE_PINS_PATH = None if TASK_STORE in ('shared', 'redis') else os.path.join(os.path.dirname(TASK_DB_PATH), 'pins.json')
+STORAGE = StorageManager(DOWNLOAD_FOLDER, QUEUE, STORAGE_QUOTA, STORAGE_HIGH_WATERMARK, STORAGE_LOW_WATERMARK,
+                         STORAGE_EVICTION, file_in_use, on_evicted, STORAGE_CHECK_INTERVAL, STORAGE_PINS_PATH)
 # --- HELPER: PROGRESS HOOK ---
-def progress_hook(d, task_id):
+def progress_hook(d, task_id, throttle):
+    """Records download progress, at most PROGRESS_HZ times per second per task.
+
+    Also charges the task's bandwidth bucket, which holds this download thread
+    back when the task is over its allocation, and stops it once it is
+    cancelled or preempted.
+    """
+    check_interrupt(task_id)
     if d['status'] == 'downloading':
-        try:
-            progress = float(d.get('_percent_str', '0%').replace('%', ''))
-        except:
-            progress = 0
+        throttle['bucket'].observe(d.get('tmpfilename') or d.get('filename'), d.get('downloaded_bytes') or 0)
+        # yt-dlp calls this for every chunk; drop updates that arrive faster than the rate limit
+        now = time.monotonic()
+        if now - throttle['last'] < PROGRESS_INTERVAL:
+            return
+        throttle['last'] = now
 
-        current = TASK_STATUS.get(task_id, {})
-        current.update({
-            "progress": progress,
+        downloaded = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        speed = d.get('speed')
+        throttle['partial'][os.path.basename(d['filename'])] = {"bytes": downloaded, "total": total}
+        TASKS.update(task_id, {
+            "progress": round(min(downloaded * 100 / total, 100), 1) if total else 0,
             "status": "downloading",
-            "speed": d.get('_speed_str', 'N/A')
+            "speed": f"{format_size(int(speed))}/s" if speed else 'N/A',
+            "eta": d.get('eta'),
+            "downloaded_bytes": downloaded,
+            "total_bytes": total,
+            "partial": dict(throttle['partial']),
         })
-        TASK_STATUS[task_id] = current
 
     elif d['status'] == 'finished':
-        TASK_STATUS[task_id].update({"progress": 100, "status": "finished", "speed": "Done"})
+        # Always delivered. One stream is on disk; the task only finishes once post-processing is done
+        throttle['last'] = 0.0
+        total = d.get('total_bytes') or d.get('downloaded_bytes')
+        throttle['partial'][os.path.basename(d['filename'])] = {"bytes": total, "total": total}
+        TASKS.update(task_id, {"progress": 100, "speed": "Done", "eta": 0,
+                               "downloaded_bytes": total, "total_bytes": total,
+                               "partial": dict(throttle['partial'])})
 
     elif d['status'] == 'error':
-        TASK_STATUS[task_id] = {"progress": 0, "status": "error", "speed": "N/A"}
+        TASKS.set(task_id, {"progress": 0, "status": "error", "speed": "N/A", "stage": "error"})
 
-# --- DOWNLOAD THREAD ---
-def start_download_thread(url, type_mode, quality, task_id):
-    TASK_STATUS[task_id] = {"progress": 0, "status": "starting", "speed": "N/A", "title": "Processing..."}
+# --- HELPER: TASK COMPLETION ---
+def mark_finished(task_id, output_path):
+    TASKS.update(task_id, {"progress": 100, "status": "finished", "speed": "Done",
+                           "stage": "done", "filename": os.path.basename(output_path), "partial": None})
+    job = TASKS.job(task_id)
+    if job and job.get('key'):
+        COMPLETED[job['key']] = os.path.basename(output_path)
+    if job and job.get('pin'):
+        STORAGE.pin(os.path.basename(output_path))
+    LIBRARY.add(os.path.basename(output_path))
+    task_settled(task_id)
 
-    if type_mode == 'video':
-        # The best format string for muxing video/audio
-        if quality == 'max': fmt = 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
-        elif quality == '1080p': fmt = 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080]/best'
-        elif quality == '720p': fmt = 'bestvideo[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[height<=720]/best'
-        else: fmt = 'bestvideo[height<=360][ext=mp4]+bestaudio[ext=m4a]/best[height<=360]/best'
-    else: # Audio
-        fmt = 'bestaudio/best'
-
-    # Filename template
-    out_tmpl = f'{DOWNLOAD_FOLDER}/%(title)s.%(ext)s'
-
-    ydl_opts = {
-        'outtmpl': out_tmpl,
-        'format': fmt,
-        'progress_hooks': [lambda d: progress_hook(d, task_id)],
-        'extractor_args': {'youtube': {'player_client': ['android', 'web']}},
-        'source_address': '0.0.0.0',
-        'overwrites': True,
-    }
+def mark_failed(task_id, message, category=None, partial=None):
+    ERRORS.inc(category=category or error_category(message))
+    status = {"progress": 0, "status": f"error: {message}", "speed": "N/A", "stage": "error"}
+    if partial:
+        # The raw streams stay on disk, so /retry can resume from them
+        status['partial'] = partial
+    TASKS.set(task_id, status)
+    task_settled(task_id)
+
+# HTTP statuses worth another attempt; timeouts and dropped connections are matched by error_category
+TRANSIENT_HTTP = re.compile(r'HTTP Error (408|429|5\d\d)')
+
+def is_transient(message):
+    return error_category(message) == 'network' or bool(TRANSIENT_HTTP.search(message))
+
+def schedule_retry(task_id, message, partial):
+    """Sends a download that failed on a transient error back to the queue after an exponential backoff.
+
+    The job keeps its queue place and its files, so the next attempt resumes
+    where this one stopped. Returns False if the task should fail instead.
+    """
+    attempt = (TASKS.get(task_id) or {}).get('attempt', 0)
+    if attempt >= TASK_RETRIES or not is_transient(message):
+        return False
+    delay = min(TASK_RETRY_BACKOFF_MAX, TASK_RETRY_BACKOFF * 2 ** attempt)
+    TASKS.update(task_id, {"status": "retrying", "stage": "queued", "speed": "N/A", "eta": None,
+                           "attempt": attempt + 1, "retry_at": time.time() + delay, "last_error": message,
+                           "partial": partial})
+    RETRIES.inc(trigger='auto')
+    SCHEDULER.retry(task_id, delay)
+    return True
+
+def partial_bytes(partial):
+    """Bytes of a task's raw streams already on disk, complete or as .part files."""
+    total = 0
+    for name in partial or {}:
+        path = os.path.join(DOWNLOAD_FOLDER, name)
+        for candidate in (path, path + '.part'):
+            if os.path.isfile(candidate):
+                total += os.path.getsize(candidate)
+                break
+    return total
+
+def task_settled(task_id):
+    """Removes a finished or failed task from the queue and updates its parent batch, if any."""
+    SCHEDULER.done(task_id)
+    job = TASKS.job(task_id)
+    if job and job.get('parent'):
+        refresh_batch(job['parent'])
 
+# --- HELPER: POST-PROCESSING HAND-OFF ---
+def on_postprocess_done(future, task_id, kind, mode, started):
+    ACTIVE.dec(stage='postprocess')
+    POSTPROCESS_SECONDS.observe(time.monotonic() - started, kind=kind, mode=mode)
+    with LOCAL_LOCK:
+        LOCAL_TASKS.pop(task_id, None)
+    try:
+        os.remove(postprocess.cancel_marker(task_id))
+    except OSError:
+        pass
+    try:
+        mark_finished(task_id, future.result())
+    except postprocess.Cancelled:
+        finish_cancelled(task_id)
+    except Exception as e:
+        mark_failed(task_id, str(e), 'postprocess')
+
+def submit_postprocess(task_id, type_mode, quality, raw_files, base_path, source):
+    """Hands the raw downloads to the process pool so the network slot can be freed.
+
+    `source` is the format table row of the first raw file. Audio that already
+    satisfies the requested profile is copied into its container, not re-encoded.
+    """
     if type_mode == 'audio':
-        ydl_opts['postprocessors'] = [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '320' if quality == '320k' else '128',
-        }]
+        profile = postprocess.audio_profile(quality)
+        copy = postprocess.can_copy_audio(profile, source['acodec'], source['abr'])
+        output = f"{base_path}.{postprocess.audio_extension(profile, source['acodec'], copy)}"
+        kind, mode, job = 'audio', 'copy' if copy else 'transcode', (postprocess.extract_audio, raw_files[0], output, profile, copy)
+        report = {"kind": kind, "mode": mode, "profile": profile}
+    elif len(raw_files) > 1:
+        kind, mode, job = 'merge', 'copy', (postprocess.merge_av, raw_files[0], raw_files[1], base_path + '.mp4')
+        report = {"kind": kind, "mode": mode}
+    elif not STORE.remote:
+        # Already a single playable file; renaming it is not worth a round trip to the pool
+        mark_finished(task_id, postprocess.finalize(raw_files[0], base_path + os.path.splitext(raw_files[0])[1]))
+        return
+    else:
+        # Nothing to convert, but the upload still belongs in the pool
+        kind, mode, job = 'store', 'copy', (postprocess.finalize, raw_files[0], base_path + os.path.splitext(raw_files[0])[1])
+        report = {"kind": kind, "mode": mode}
+
+    TASKS.update(task_id, {"status": "processing", "speed": "N/A", "stage": "postprocess", "postprocess": report})
+    ACTIVE.inc(stage='postprocess')
+    with LOCAL_LOCK:
+        LOCAL_TASKS.setdefault(task_id, {})['stage'] = 'postprocess'
+    started = time.monotonic()
+    # The output goes to the file store from inside the pool (an upload for remote stores)
+    future = postprocess.get_pool().submit(postprocess.store_output, STORE, *job,
+                                           cancel_path=postprocess.cancel_marker(task_id))
+    future.add_done_callback(lambda f: on_postprocess_done(f, task_id, kind, mode, started))
+
+# --- CANCELLATION AND PREEMPTION ---
+# Tasks running in this process are stopped from the inside: a download by its progress
+# hook raising Interrupted, post-processing by a marker file its ffmpeg watches for.
+# A DELETE handled by another process only sets "cancel" on the task's status; the
+# watcher below polls it from the process running the task.
+LOCAL_LOCK = threading.Lock()
+LOCAL_TASKS = {}   # task id -> {"stage", "priority", "started"} for tasks running in this process
+INTERRUPTS = {}    # task id -> 'cancel' or 'pause', raised in the task's download thread
+
+class Interrupted(yt_dlp.utils.DownloadCancelled):
+    def __init__(self, reason):
+        super().__init__(f"Download {'paused' if reason == 'pause' else 'cancelled'}")
+        self.reason = reason
+
+def check_interrupt(task_id):
+    reason = INTERRUPTS.get(task_id)
+    if reason:
+        raise Interrupted(reason)
+
+def interrupt(task_id, reason):
+    """Stops a task running in this process. Returns False if it is not running here."""
+    with LOCAL_LOCK:
+        local = LOCAL_TASKS.get(task_id)
+        if local is None:
+            return False
+        if local['stage'] == 'download':
+            INTERRUPTS[task_id] = reason
+        elif reason == 'cancel':
+            # Pausing only makes sense while the network slot is held
+            open(postprocess.cancel_marker(task_id), 'w').close()
+        else:
+            return False
+    return True
 
+def request_cancel(task_id):
+    """Cancels a task wherever it is. Returns 'cancelled', or 'cancelling' while its worker stops it."""
+    status = TASKS.get(task_id) or {}
+    TASKS.update(task_id, {"cancel": True})
+    if status.get('stage') == 'queued':
+        # Not running anywhere; if a worker claims it meanwhile, the flag above stops it
+        finish_cancelled(task_id)
+        return 'cancelled'
+    TASKS.update(task_id, {"status": "cancelling"})
+    interrupt(task_id, 'cancel')
+    return 'cancelling'
+
+def finish_cancelled(task_id):
+    """Marks a stopped task cancelled and deletes the partial files it left behind."""
+    TASKS.update(task_id, {"progress": 0, "status": "cancelled", "speed": "N/A", "eta": None,
+                           "stage": "cancelled", "partial": None})
+    job = TASKS.job(task_id) or {}
+    if job.get('url') and 'children' not in job:
+        key = job.get('key') or download_key(job['url'], job['type'], job['quality'], job.get('format'))
+        if TASKS.active_task_for_key(key) in (None, task_id):
+            # Raw streams (with their .part/.ytdl/fragment files) and ffmpeg temp output; never a finished file
+            for name in os.listdir(DOWNLOAD_FOLDER):
+                if f' [{key}].f' in name or f' [{key}].tmp.' in name:
+                    try:
+                        os.remove(os.path.join(DOWNLOAD_FOLDER, name))
+                    except OSError:
+                        pass
+    INTERRUPTIONS.inc(reason='cancel')
+    task_settled(task_id)
+
+def pause_task(task_id, partial):
+    """Sends a preempted download back to the queue; it resumes from its partial files once a slot frees up."""
+    TASKS.update(task_id, {"status": "paused", "stage": "queued", "speed": "N/A", "eta": None, "partial": partial})
+    INTERRUPTIONS.inc(reason='pause')
+    SCHEDULER.retry(task_id, 0)
+
+PREEMPT_WAIT = {"priority": None, "since": 0.0}   # the most urgent waiting job, and since when it has waited
+
+def maybe_preempt():
+    """Pauses a download of this process for a more urgent job that has waited PREEMPT_AFTER for a slot.
+
+    The victim is the least urgent download, the most recently started among
+    equals, since it has the least progress to lose.
+    """
+    waiting = SCHEDULER.waiting_priority()
+    now = time.monotonic()
+    if waiting is None or waiting != PREEMPT_WAIT['priority']:
+        PREEMPT_WAIT.update(priority=waiting, since=now)
+        return
+    if now - PREEMPT_WAIT['since'] < PREEMPT_AFTER:
+        return
+    with LOCAL_LOCK:
+        candidates = [(local['priority'], local['started'], task_id) for task_id, local in LOCAL_TASKS.items()
+                      if local['stage'] == 'download' and local['priority'] > waiting and task_id not in INTERRUPTS]
+    if candidates:
+        # Other processes may be freeing a slot too; give them another PREEMPT_AFTER before the next pause
+        PREEMPT_WAIT['since'] = now
+        interrupt(max(candidates)[2], 'pause')
+
+def watch_local_tasks():
+    """Stops local tasks cancelled through other processes and preempts downloads for urgent jobs."""
+    while True:
+        time.sleep(INTERRUPT_POLL_INTERVAL)
+        with LOCAL_LOCK:
+            task_ids = list(LOCAL_TASKS)
+        if not task_ids:
+            continue
+        try:
+            for task_id, status in TASKS.get_many(task_ids).items():
+                if status.get('cancel') and not is_terminal(status):
+                    interrupt(task_id, 'cancel')
+            if PREEMPT_AFTER > 0:
+                maybe_preempt()
+        except Exception as e:
+            print(f"Watching local tasks failed: {e}", flush=True)
+
+# --- HELPER: CONNECTION TUNING ---
+def effective_tuning(requested):
+    """The request's knobs over the server defaults; the fragment default follows the current load."""
+    stats = SCHEDULER.stats()
+    fragments = fragment_share(FRAGMENT_BUDGET, stats['active'], MAX_CONCURRENT_DOWNLOADS, stats['queued'])
+    settings = {**TUNING_DEFAULTS, 'fragments': fragments, **(requested or {})}
+    settings['fragments'] = min(settings['fragments'], FRAGMENT_BUDGET)
+    return settings
+
+# --- DOWNLOAD THREAD ---
+def start_download_thread(url, type_mode, quality, task_id, tuning=None, requested=None):
+    status = TASKS.get(task_id) or {}
+    if status.get('cancel'):
+        # Cancelled while it sat in the queue
+        if not is_terminal(status):
+            finish_cancelled(task_id)
+        return
+    # Streams an earlier attempt left behind, which yt-dlp picks up again below
+    partial = dict(status.get('partial') or {})
+    TASKS.update(task_id, {"progress": 0, "status": "starting", "speed": "N/A", "stage": "download",
+                           "node": SCHEDULER.owner, "resumed_bytes": partial_bytes(partial), "follows": None})
+
+    job = TASKS.job(task_id) or {}
+    throttle = {'last': 0.0, 'partial': partial, 'bucket': None}
+    with LOCAL_LOCK:
+        LOCAL_TASKS[task_id] = {"stage": "download", "started": time.monotonic(),
+                                "priority": PRIORITIES.get(job.get('priority'), PRIORITIES['normal'])}
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            # We don't need to call extract_info separately here, as it's not needed by the progress
-            ydl.download([url])
+        # Everything that can fail on a bad job goes in here, so the task fails rather than hangs
+        settings = effective_tuning(tuning)
+        TASKS.update(task_id, {"tuning": settings})
+        key = download_key(url, type_mode, quality, requested)
+        holder = TASKS.claim(task_id)
+        if holder != task_id:
+            # Another task is fetching the same files; take its result once it is done,
+            # or download it here if it fails
+            TASKS.update(task_id, {"status": "waiting for a duplicate download", "stage": "queued",
+                                   "follows": holder})
+            SCHEDULER.retry(task_id, DUPLICATE_POLL_INTERVAL)
+            return
+        existing = find_existing(key)
+        if existing:
+            mark_finished(task_id, existing)
+            return
+
+        throttle['bucket'] = BANDWIDTH.register(task_id, job.get('client'), job.get('priority'))
+        ydl_opts = dict(BASE_YDL_OPTS, **ydl_tuning_options(settings), **{
+            # Raw streams carry their format id so a video and its audio never collide
+            'outtmpl': f'{DOWNLOAD_FOLDER}/%(title)s [{key}].f%(format_id)s.%(ext)s',
+            'progress_hooks': [lambda d: progress_hook(d, task_id, throttle)],
+            # Resume .part files and keep streams that finished before a failure or restart; the raw
+            # file names carry the download key, so only this download can have left them
+            'overwrites': False,
+            'continuedl': True,
+        })
+
+        # Reuse the metadata /info already fetched instead of extracting a second time
+        info = get_cached_info(url)
+        check_interrupt(task_id)
+        if info.get('_type') == 'playlist':
+            expand_playlist(task_id, info)
+            return
+        # Resolved against the cached table; yt-dlp only gets exact ids
+        choice = choose_formats(info, type_mode, quality, requested)
+        ydl_opts['format'] = choice['format_id']
+        if not STORAGE.reserve(task_id, key, choice['filesize']):
+            # Back in the queue until evictions or deletions make room
+            TASKS.update(task_id, {"status": "waiting for disk space", "stage": "queued", "speed": "N/A", "eta": None})
+            SCHEDULER.retry(task_id, STORAGE_CHECK_INTERVAL)
+            return
+
+        with ACTIVE.track(stage='download'), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            started = time.monotonic()
+            # Re-run format selection on the cached info with this task's format string
+            info = ydl.process_ie_result(unselected(info), download=False)
+            TASKS.update(task_id, {"title": info.get('title'), "format": choice['format_id']})
+            base_path = ydl.prepare_filename(info, outtmpl=f'{DOWNLOAD_FOLDER}/%(title)s [{key}]')
+
+            # Fetch each selected stream on its own; muxing/transcoding happens in the process pool
+            raw_files = []
+            for selected in info.get('requested_formats') or [info]:
+                ydl.params['format'] = selected['format_id']
+                result = ydl.process_ie_result(unselected(info), download=True)
+                raw_files.append(result['requested_downloads'][0]['filepath'])
+
+        elapsed = time.monotonic() - started
+        DOWNLOAD_SECONDS.observe(elapsed, type=type_mode)
+        DOWNLOAD_RATE.observe(sum(os.path.getsize(f) for f in raw_files) / max(elapsed, 1e-3))
+        submit_postprocess(task_id, type_mode, quality, raw_files, base_path, choice['formats'][0])
+    except Interrupted as e:
+        if e.reason == 'pause':
+            pause_task(task_id, throttle['partial'])
+        else:
+            finish_cancelled(task_id)
     except Exception as e:
-        TASK_STATUS[task_id] = {"progress": 0, "status": f"error: {str(e)}", "speed": "N/A"}
+        if not schedule_retry(task_id, str(e), throttle['partial']):
+            mark_failed(task_id, str(e), partial=throttle['partial'])
+    finally:
+        STORAGE.release(task_id)
+        with LOCAL_LOCK:
+            INTERRUPTS.pop(task_id, None)
+            if LOCAL_TASKS.get(task_id, {}).get('stage') == 'download':
+                del LOCAL_TASKS[task_id]
+        if BANDWIDTH.unregister(task_id):
+            TASKS.update(task_id, {"bandwidth": None})
+
+# --- BATCHES ---
+def submit_task(task_id, job):
+    """Queues a download task; batch children share a queue group capped at the batch's concurrency."""
+    args = (job['url'], job['type'], job['quality'], task_id, job.get('tuning'), job.get('format'))
+    return SCHEDULER.submit(task_id, args, job['priority'],
+                            job.get('parent'), job.get('concurrency') if job.get('parent') else None)
+
+def create_batch(parent_id, urls, job, title, existing=False):
+    """Turns parent_id into a batch task with one queued child task per URL.
+
+    With `existing` parent_id is already a task (a playlist being expanded);
+    its job and status are replaced instead of the task being created again.
+    """
+    concurrency = job.get('concurrency') or BATCH_CONCURRENCY
+    children = []
+    child_jobs = []
+    for url in urls:
+        child_id = str(uuid.uuid4())
+        child_job = {"url": url, "type": job['type'], "quality": job['quality'],
+                     "priority": job['priority'], "parent": parent_id, "concurrency": concurrency,
+                     "key": download_key(url, job['type'], job['quality'], job.get('format')),
+                     "tuning": job.get('tuning'), "format": job.get('format'), "client": job.get('client'),
+                     "pin": job.get('pin')}
+        status = {"progress": 0, "status": "queued", "speed": "N/A", "title": "Waiting in batch...",
+                  "stage": "queued", "parent": parent_id}
+        # A duplicate (of another entry or of any running download) is still created, but only
+        # takes over the download if the task it duplicates fails
+        holder = TASKS.create(child_id, status, child_job, exclusive=False)
+        if holder != child_id:
+            TASKS.update(child_id, {"status": "waiting for a duplicate download", "follows": holder})
+        children.append(child_id)
+        child_jobs.append((child_id, child_job))
+
+    batch_job = dict(job, children=children, concurrency=concurrency)
+    status = {"progress": 0, "status": "downloading", "speed": "N/A", "title": title, "stage": "batch",
+              "total": len(children), "completed": 0, "failed": 0, "children": children}
+    if existing:
+        # The job first: once it lists the children, a restart requeues them rather than the playlist
+        TASKS.set_job(parent_id, batch_job)
+        TASKS.set(parent_id, status)
+    else:
+        TASKS.create(parent_id, status, batch_job)
+    for child_id, child_job in child_jobs:
+        submit_task(child_id, child_job)
+    if not children:
+        refresh_batch(parent_id)
+
+def expand_playlist(task_id, info):
+    """Fans the entries of a flat-extracted playlist out as child tasks of task_id."""
+    urls = [entry.get('url') or entry.get('webpage_url') for entry in info.get('entries') or [] if entry]
+    create_batch(task_id, [u for u in urls if u], TASKS.job(task_id) or {}, info.get('title'), existing=True)
+    # The parent is only an aggregate from here on; its own queue slot is no longer needed
+    SCHEDULER.done(task_id)
+
+def refresh_batch(parent_id):
+    """Recomputes a batch's aggregate progress from its children."""
+    job = TASKS.job(parent_id)
+    if not job or 'children' not in job:
+        return
+    children = [TASKS.get(child_id) or {} for child_id in job['children']]
+    total = len(children)
+    completed = sum(1 for c in children if c.get('stage') == 'done')
+    failed = sum(1 for c in children if c.get('stage') == 'error')
+    cancelled = sum(1 for c in children if c.get('stage') == 'cancelled')
+    progress = round(sum(c.get('progress', 0) for c in children) / total, 1) if total else 100
+
+    fields = {"progress": progress, "completed": completed, "failed": failed, "cancelled": cancelled}
+    if completed + failed + cancelled == total:
+        if total and failed == total:
+            fields.update({"status": "error: every entry failed", "stage": "error"})
+        elif total and not completed:
+            fields.update({"status": "cancelled", "speed": "N/A", "stage": "cancelled"})
+        else:
+            fields.update({"progress": 100, "status": "finished", "speed": "Done", "stage": "done"})
+    TASKS.update(parent_id, fields)
+    if is_terminal(fields):
+        task_settled(parent_id)
+
+# --- SCHEDULER ---
+SCHEDULER = DownloadScheduler(0 if NODE_ROLE == 'api' else MAX_CONCURRENT_DOWNLOADS, start_download_thread, QUEUE,
+                              heartbeat_interval=JOB_LEASE_TTL / 3, admit=STORAGE.admitting)
+
+# --- BANDWIDTH ---
+BANDWIDTH = BandwidthManager(
+    QUEUE, SCHEDULER.owner,
+    {"global_rate": BANDWIDTH_LIMIT, "client_rate": CLIENT_BANDWIDTH_LIMIT, "clients": {}},
+    on_allocation=lambda task_id, allocation: TASKS.update(task_id, {"bandwidth": allocation}),
+)
+
+# --- METRICS PUBLISHING ---
+METRICS_PREFIX = 'metrics:'
+
+def metrics_snapshot():
+    """This process's metrics, with the cache counters read off the cache itself."""
+    cache = INFO_CACHE.stats()
+    CACHE_LOOKUPS.set_total(cache['hits'], result='hit')
+    CACHE_LOOKUPS.set_total(cache['misses'], result='miss')
+    CACHE_HIT_RATIO.set(cache['hit_ratio'])
+    return METRICS.snapshot()
+
+def publish_metrics():
+    """Shares this process's metrics through the job queue so /metrics on any peer can report them."""
+    while True:
+        time.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            QUEUE.put_setting(METRICS_PREFIX + SCHEDULER.owner, metrics_snapshot())
+        except Exception as e:
+            print(f"Publishing metrics failed: {e}", flush=True)
+
+def client_id():
+    """Who a request counts against for bandwidth: its API key (hashed) or else its address."""
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+    return f"ip:{request.remote_addr}"
+
+def requeue_unfinished():
+    """Puts tasks interrupted by a restart back in the queue."""
+    for task_id, job in TASKS.unfinished():
+        if not job:
+            TASKS.set(task_id, {"progress": 0, "status": "error: interrupted by restart", "speed": "N/A", "stage": "error"})
+        elif 'children' not in job:
+            # Batch parents need nothing; they follow their children
+            TASKS.update(task_id, {"progress": 0, "status": "queued", "speed": "N/A", "stage": "queued"})
+            submit_task(task_id, job)
+
+def start():
+    """Starts this process's background work: download workers and the threads that serve them."""
+    SCHEDULER.start()
+    if NODE_ROLE != 'api':
+        threading.Thread(target=watch_local_tasks, name='task-watcher', daemon=True).start()
+        # Evictions run where downloads fill the disk
+        STORAGE.start()
+    # Only a shared queue has peers to publish to
+    if TASK_STORE in ('shared', 'redis'):
+        threading.Thread(target=publish_metrics, name='metrics', daemon=True).start()
+    # A shared queue outlives the process; jobs left by a dead one are re-leased once their lease runs out
+    else:
+        requeue_unfinished()
+
+# Imported by gunicorn, asgi.py or worker.py: start right away. Run as a script, the module is
+# imported again as __mp_main__ by every spawned post-processing child, which must stay inert,
+# so `python api.py` starts it from the bottom of the file instead
+if __name__ not in ('__main__', '__mp_main__'):
+    start()
+
+def shutdown(timeout):
+    """Graceful stop: finish (or hand back) running downloads, then wait for post-processing."""
+    # Downloads still running at the timeout are paused, as for preemption, and so resume elsewhere
+    released = SCHEDULER.drain(timeout, lambda task_id: interrupt(task_id, 'pause'))
+    postprocess.shutdown_pool()
+    if hasattr(TASKS, 'flush'):
+        TASKS.flush()
+    return released
 
 # --- ROUTES ---
 
@@ -87,109 +838,478 @@ def get_video_info():
         return jsonify({"status": "error", "message": "No URL provided"}), 400
 
     try:
-        ydl_opts = {'quiet': True, 'noprogress': True}
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return jsonify({
-                "title": info.get('title'),
-                "thumbnail": info.get('thumbnail'),
-                "duration": info.get('duration_string') or f"{info.get('duration', 0)} seconds"
-            })
+        return jsonify(info_summary(get_cached_info(url)))
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 400
 
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Returns hit/miss counters for the metadata cache."""
+    return jsonify(INFO_CACHE.stats())
+
+@app.route('/workers', methods=['GET'])
+def get_workers():
+    """Lists the download workers currently heartbeating, with the shared queue's counters."""
+    return jsonify({"workers": QUEUE.workers(), "queue": QUEUE.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics of every process sharing the queue; series carry the process in a node label.
+
+    Queue depth and storage usage are global and have no node label. Peers are at most
+    METRICS_PUBLISH_INTERVAL seconds behind; this process is live.
+    """
+    snapshots = {}
+    if TASK_STORE in ('shared', 'redis'):
+        for name, snapshot in QUEUE.get_settings(METRICS_PREFIX, 3 * METRICS_PUBLISH_INTERVAL).items():
+            snapshots[name[len(METRICS_PREFIX):]] = snapshot
+    snapshots[SCHEDULER.owner] = metrics_snapshot()
+
+    queue = Registry()
+    depth = queue.gauge('ytdl_queue_jobs', 'Download jobs in the queue, by state', ['state'])
+    for state, count in QUEUE.stats().items():
+        depth.set(count, state=state)
+    usage = STORAGE.stats()
+    for name in ('used', 'limit'):
+        queue.gauge(f'ytdl_storage_{name}_bytes', f'Downloads volume: {name} bytes').set(usage[name])
+    snapshots[None] = queue.snapshot()
+    return Response(render(snapshots), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/bandwidth', methods=['GET', 'PUT'])
+def admin_bandwidth():
+    """Reads or changes the bandwidth limits (bytes/s, 0 = none) for every process sharing the queue.
+
+    PUT takes any of global_rate, client_rate and clients ({client: rate, or null
+    to drop the override}); clients are named as in a task's "bandwidth" status.
+    """
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({"status": "error", "message": "Admin token required"}), 403
+    if request.method == 'GET':
+        return jsonify({"limits": BANDWIDTH.limits(), "allocations": BANDWIDTH.allocations()})
+
+    data = request.json or {}
+    rates = {k: data[k] for k in ('global_rate', 'client_rate') if k in data}
+    clients = data.get('clients') or {}
+    if set(data) - {'global_rate', 'client_rate', 'clients'} or not isinstance(clients, dict):
+        return jsonify({"status": "error", "message": "Expected global_rate, client_rate and/or clients"}), 400
+    for value in list(rates.values()) + [v for v in clients.values() if v is not None]:
+        if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+            return jsonify({"status": "error", "message": "Rates must be non-negative integers (bytes/s)"}), 400
+    return jsonify({"limits": BANDWIDTH.set_limits(dict(rates, clients=clients))})
+
 @app.route('/download', methods=['POST'])
 def handle_download():
-    """Starts the download process in a background thread."""
+    """Starts the download process in a background thread.
+
+    Instead of a quality preset, "format" may name format ids from /info
+    ("137" or "137+140") or give constraints (see formats.CONSTRAINTS).
+    "pin": true keeps the file out of disk quota evictions.
+    """
     data = request.json
     url = data.get('url')
     type_mode = data.get('type')
     quality = data.get('quality')
+    priority = data.get('priority', 'normal')
+    # Only used if the URL turns out to be a playlist; unset = BATCH_CONCURRENCY
+    concurrency = data.get('concurrency') or None
 
-    if not all([url, type_mode, quality]):
+    if not all([url, type_mode]) or not (quality or data.get('format')):
         return jsonify({"status": "error", "message": "Missing download parameters"}), 400
+    if not isinstance(url, str):
+        return jsonify({"status": "error", "message": "url must be a string"}), 400
+    if priority not in PRIORITIES:
+        return jsonify({"status": "error", "message": f"Unknown priority: {priority}"}), 400
+    if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+        return jsonify({"status": "error", "message": "concurrency must be a positive integer"}), 400
+    try:
+        tuning = parse_tuning(data.get('tuning'))
+        requested = parse_format(data.get('format'))
+        postprocess_settings(type_mode, quality)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    # With the metadata cached (the card's /info call), a format that cannot be met fails here
+    # rather than in the queue; the choice is made again when the download starts
+    selected = None
+    info = INFO_CACHE.get(url)
+    if info is not None and info.get('_type') != 'playlist':
+        try:
+            selected = choose_formats(info, type_mode, quality, requested)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+    key = download_key(url, type_mode, quality, requested)
+    # Same video, format and post-processing as a running task: follow that task instead
+    running = TASKS.active_task_for_key(key)
+    if running:
+        return jsonify({"status": "processing", "task_id": running, "deduplicated": True}), 202
 
     task_id = str(uuid.uuid4())
-    thread = threading.Thread(target=start_download_thread, args=(url, type_mode, quality, task_id))
-    thread.start()
-    return jsonify({"status": "processing", "task_id": task_id}), 202
+    existing = find_existing(key)
+    if existing:
+        if data.get('pin'):
+            STORAGE.pin(existing)
+        TASKS.create(task_id, {"progress": 100, "status": "finished", "speed": "Done", "title": existing,
+                               "stage": "done", "filename": existing})
+        return jsonify({"status": "finished", "task_id": task_id, "filename": existing, "deduplicated": True}), 200
+
+    job = {"url": url, "type": type_mode, "quality": quality, "priority": priority,
+           "concurrency": concurrency, "key": key, "tuning": tuning, "format": requested,
+           "client": client_id(), "pin": bool(data.get('pin'))}
+    # The store checks the key and creates the task in one step, across every process: of two
+    # identical requests racing past the check above, only one gets a task
+    running = TASKS.create(task_id, {"progress": 0, "status": "queued", "speed": "N/A", "title": "Waiting in queue...", "stage": "queued"}, job)
+    if running != task_id:
+        return jsonify({"status": "processing", "task_id": running, "deduplicated": True}), 202
+    position = submit_task(task_id, job)
+    response = {"status": "processing", "task_id": task_id, "queue_position": position}
+    if selected:
+        response.update(format=selected['format_id'], filesize=selected['filesize'])
+    return jsonify(response), 202
+
+@app.route('/retry/<task_id>', methods=['POST'])
+def retry_task(task_id):
+    """Runs a failed task again, resuming from the partial files of its last attempt.
+
+    For a batch, every failed entry is retried.
+    """
+    status, job = TASKS.get(task_id), TASKS.job(task_id)
+    if status is None or job is None:
+        return jsonify({"status": "error", "message": "Unknown task"}), 404
+
+    if 'children' in job:
+        failed = [child_id for child_id in job['children'] if (TASKS.get(child_id) or {}).get('stage') == 'error']
+        if not failed:
+            return jsonify({"status": "error", "message": "No failed entries to retry"}), 409
+        TASKS.update(task_id, {"status": "downloading", "speed": "N/A", "stage": "batch"})
+        for child_id in failed:
+            resubmit(child_id, TASKS.job(child_id))
+        refresh_batch(task_id)
+        return jsonify({"status": "processing", "task_id": task_id, "retried": failed}), 202
+
+    if status.get('stage') != 'error':
+        return jsonify({"status": "error", "message": "Only failed tasks can be retried"}), 409
+    # Another task writing the same raw files would trample this one's partial downloads
+    running = TASKS.claim(task_id)
+    if running != task_id:
+        return jsonify({"status": "error", "message": "Another task is downloading this", "task_id": running}), 409
+    position = resubmit(task_id, job)
+    return jsonify({"status": "processing", "task_id": task_id, "queue_position": position,
+                    "resumable_bytes": partial_bytes(status.get('partial'))}), 202
+
+def resubmit(task_id, job):
+    TASKS.update(task_id, {"progress": 0, "status": "queued", "speed": "N/A", "stage": "queued", "attempt": 0})
+    RETRIES.inc(trigger='manual')
+    return submit_task(task_id, job)
+
+@app.route('/task/<task_id>', methods=['DELETE'])
+def cancel_task(task_id):
+    """Cancels a queued or running task and deletes its partial files.
+
+    For a batch, every unfinished entry is cancelled; finished entries are kept.
+    """
+    status, job = TASKS.get(task_id), TASKS.job(task_id)
+    if status is None:
+        return jsonify({"status": "error", "message": "Unknown task"}), 404
+    if is_terminal(status):
+        return jsonify({"status": "error", "message": "Task already ended", "stage": status.get('stage')}), 409
+
+    if job and 'children' in job:
+        cancelled = [child_id for child_id in job['children'] if not is_terminal(TASKS.get(child_id) or {'stage': 'done'})]
+        TASKS.update(task_id, {"status": "cancelling"})
+        for child_id in cancelled:
+            request_cancel(child_id)
+        refresh_batch(task_id)
+        return jsonify({"status": "cancelling", "task_id": task_id, "cancelled": cancelled}), 202
+
+    result = request_cancel(task_id)
+    return jsonify({"status": result, "task_id": task_id}), 200 if result == 'cancelled' else 202
+
+@app.route('/download/batch', methods=['POST'])
+def handle_batch_download():
+    """Starts a batch task that downloads many URLs with a per-batch concurrency cap."""
+    data = request.json or {}
+    urls = data.get('urls')
+    type_mode = data.get('type')
+    quality = data.get('quality')
+    priority = data.get('priority', 'normal')
+    concurrency = data.get('concurrency') or BATCH_CONCURRENCY
+
+    if not isinstance(urls, list) or not urls or not type_mode or not (quality or data.get('format')):
+        return jsonify({"status": "error", "message": "Missing download parameters"}), 400
+    if not all(isinstance(u, str) and u.strip() for u in urls):
+        return jsonify({"status": "error", "message": "urls must be non-empty strings"}), 400
+    if priority not in PRIORITIES:
+        return jsonify({"status": "error", "message": f"Unknown priority: {priority}"}), 400
+    if not isinstance(concurrency, int) or concurrency < 1:
+        return jsonify({"status": "error", "message": "concurrency must be a positive integer"}), 400
+    try:
+        tuning = parse_tuning(data.get('tuning'))
+        requested = parse_format(data.get('format'))
+        postprocess_settings(type_mode, quality)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    task_id = str(uuid.uuid4())
+    job = {"type": type_mode, "quality": quality, "priority": priority, "concurrency": concurrency,
+           "tuning": tuning, "format": requested, "client": client_id(), "pin": bool(data.get('pin'))}
+    create_batch(task_id, urls, job, data.get('title') or f"Batch of {len(urls)}")
+    return jsonify({"status": "processing", "task_id": task_id, "children": TASKS.get(task_id)['children']}), 202
+
+def with_queue_position(task_id, status):
+    if status.get('stage') == 'queued':
+        status['queue_position'] = SCHEDULER.position(task_id)
+    return status
 
 @app.route('/status/<task_id>', methods=['GET'])
 def get_status(task_id):
     """Returns the current progress status of a task."""
-    return jsonify(TASK_STATUS.get(task_id, {"status": "pending", "progress": 0, "speed": "N/A"}))
+    status = TASKS.get(task_id, {"status": "pending", "progress": 0, "speed": "N/A"})
+    return jsonify(with_queue_position(task_id, status))
+
+@app.route('/status/batch', methods=['POST'])
+def get_status_batch():
+    """Returns the status of many tasks at once, optionally only those changed since a version."""
+    data = request.json or {}
+    task_ids = data.get('task_ids')
+    since = data.get('since', 0)
+    if not isinstance(task_ids, list):
+        return jsonify({"status": "error", "message": "task_ids must be a list"}), 400
+    if not isinstance(since, int):
+        return jsonify({"status": "error", "message": "since must be an integer version"}), 400
+
+    # Read the cursor first so a change racing with this request is reported again next time
+    version = TASKS.current_version()
+    tasks = TASKS.get_many(task_ids, since)
+    for task_id, status in tasks.items():
+        with_queue_position(task_id, status)
+    return jsonify({"tasks": tasks, "version": version})
+
+@app.route('/status/<task_id>/stream', methods=['GET'])
+def stream_status(task_id):
+    """Pushes status changes of a task as Server-Sent Events until it finishes."""
+    if TASKS.get(task_id) is None:
+        return jsonify({"status": "error", "message": "Unknown task"}), 404
+
+    def generate():
+        version = 0
+        while True:
+            status, new_version = TASKS.wait_for_change(task_id, version, STREAM_KEEPALIVE)
+            if status is None:
+                # Expired while we were watching
+                return
+            if new_version == version:
+                yield ": keep-alive\n\n"
+                continue
+            version = new_version
+            yield f"id: {version}\ndata: {json.dumps(with_queue_position(task_id, status))}\n\n"
+            if is_terminal(status):
+                return
+            # Anything that changes while we sleep is folded into the next event
+            time.sleep(STREAM_COALESCE_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/files', methods=['GET'])
+@FILES_SECONDS.timed
 def list_files():
-    """Returns a list of files in the downloads folder with metadata."""
+    """Returns a page of the file library, filtered and sorted on indexed keys.
+
+    Query parameters: sort (modified|name|size), order (asc|desc), limit, cursor,
+    ext (comma-separated extensions), type (video|audio|other) and prefix.
+    """
     try:
-        files_list = []
-        if os.path.exists(DOWNLOAD_FOLDER):
-            for filename in os.listdir(DOWNLOAD_FOLDER):
-                filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-                if os.path.isfile(filepath):
-                    stat_info = os.stat(filepath)
-                    file_size = stat_info.st_size
-                    
-                    # Format file size to human-readable format
-                    if file_size < 1024:
-                        size_str = f"{file_size} B"
-                    elif file_size < 1024 * 1024:
-                        size_str = f"{file_size / 1024:.1f} KB"
-                    elif file_size < 1024 * 1024 * 1024:
-                        size_str = f"{file_size / (1024 * 1024):.1f} MB"
-                    else:
-                        size_str = f"{file_size / (1024 * 1024 * 1024):.2f} GB"
-                    
-                    files_list.append({
-                        "name": filename,
-                        "size": size_str,
-                        "size_bytes": file_size,
-                        "modified": stat_info.st_mtime,
-                        "extension": os.path.splitext(filename)[1].lower()
-                    })
-            
-            # Sort by modification time (newest first)
-            files_list.sort(key=lambda x: x['modified'], reverse=True)
-        
-        return jsonify({"files": files_list})
+        sort = request.args.get('sort', 'modified')
+        order = request.args.get('order', 'desc')
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor', 0, type=int)
+        if sort not in SORT_KEYS or order not in ('asc', 'desc'):
+            return jsonify({"status": "error", "message": "Unsupported sort or order"}), 400
+        if (limit is not None and limit < 1) or cursor < 0:
+            return jsonify({"status": "error", "message": "limit and cursor must be positive"}), 400
+
+        # The listing only changes when the library does, so the ETag is its fingerprint plus the query
+        etag = f"{LIBRARY.fingerprint:x}-{hashlib.sha1(request.query_string).hexdigest()[:8]}"
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        extensions = {'.' + e.strip().lower().lstrip('.') for e in request.args.get('ext', '').split(',') if e.strip()}
+        types = {t.strip().lower() for t in request.args.get('type', '').split(',') if t.strip()}
+        files_list, total, _ = LIBRARY.query(sort, order == 'desc', extensions, types,
+                                             request.args.get('prefix'), cursor, limit)
+
+        next_cursor = cursor + len(files_list) if limit and cursor + len(files_list) < total else None
+        response = jsonify({"files": files_list, "total": total, "next_cursor": next_cursor})
+        response.set_etag(etag)
+        return response
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
-    """Serve files as downloadable attachments."""
+    """Serve files as downloadable attachments, with byte ranges and conditional GET.
+
+    Files in a remote store are a redirect to a presigned URL instead.
+    """
     try:
         # Prevent path traversal attacks
         safe_filename = os.path.basename(filename)
         filepath = os.path.join(DOWNLOAD_FOLDER, safe_filename)
-        
-        # Check if file exists
-        if not os.path.exists(filepath):
+
+        # The library already knows size and mtime; only hit the disk for files it has not indexed yet
+        entry = LIBRARY.get(safe_filename)
+        if entry is None and LIBRARY.add(safe_filename):
+            entry = LIBRARY.get(safe_filename)
+        if entry is None:
             return jsonify({"status": "error", "message": "File not found"}), 404
-        
-        from flask import send_file
-        return send_file(filepath, as_attachment=True, download_name=safe_filename)
+
+        if STORE.remote:
+            # The client fetches the bytes from the bucket itself, ranges and all
+            return redirect(STORE.url(safe_filename))
+        STORAGE.touch(safe_filename)
+        return serve_file(request, filepath, safe_filename, entry['size_bytes'], entry['modified'],
+                          FILE_SERVING_MODE, FILE_ACCEL_PREFIX)
+    except FileNotFoundError:
+        LIBRARY.remove(os.path.basename(filename))
+        return jsonify({"status": "error", "message": "File not found"}), 404
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/stream', methods=['GET'])
+def stream_media():
+    """Sends a video or audio straight to the client, muxed or encoded on the fly; nothing is queued.
+
+    Query parameters: url, type (video|audio), quality and/or format (format ids,
+    as for /download), and save=1 to also keep the result in the library. What
+    the library already has is redirected to /download/<filename>.
+    """
+    url = request.args.get('url')
+    type_mode = request.args.get('type', 'video')
+    quality = request.args.get('quality')
+    if not url or type_mode not in ('video', 'audio') or not (quality or request.args.get('format')):
+        return jsonify({"status": "error", "message": "Missing stream parameters"}), 400
+    try:
+        requested = parse_format(request.args.get('format'))
+        postprocess_settings(type_mode, quality)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    key = download_key(url, type_mode, quality, requested)
+    existing = find_existing(key)
+    if existing:
+        return redirect(f"/download/{quote(existing)}")
+    if not STREAM_SLOTS.acquire(blocking=False):
+        return jsonify({"status": "error", "message": "Too many streams running, try again shortly"}), 503
+
+    state = {'pipeline': None, 'tee': None, 'saved': False}
+
+    def cleanup():
+        if state['pipeline']:
+            state['pipeline'].close()
+        if state['tee']:
+            state['tee'].close()
+            if not state['saved']:
+                try:
+                    os.remove(state['tee'].name)
+                except OSError:
+                    pass
+        STREAM_SLOTS.release()
+
+    try:
+        info = get_cached_info(url)
+        if info.get('_type') == 'playlist':
+            raise ValueError("Playlists cannot be streamed; download them instead")
+        choice = choose_formats(info, type_mode, quality, requested)
+        ext, codec_args = streaming.plan(type_mode, quality, choice['formats'])
+        started = time.monotonic()
+        state['pipeline'] = streaming.Pipeline(unselected(info), choice['format_id'].split('+'), ext, codec_args)
+        chunks = state['pipeline'].chunks()
+        first = next(chunks, b'')
+        STREAM_FIRST_BYTE.observe(time.monotonic() - started)
+    except streaming.StreamError as e:
+        cleanup()
+        return jsonify({"status": "error", "message": str(e)}), 502
+    except Exception as e:
+        cleanup()
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    title = yt_dlp.utils.sanitize_filename(info.get('title') or info.get('id') or 'stream')
+    final_path = os.path.join(DOWNLOAD_FOLDER, f"{title} [{key}].{ext}")
+    if request.args.get('save') in ('1', 'true') and STORAGE.admitting() and not TASKS.active_task_for_key(key):
+        try:
+            # Named like ffmpeg's temp output, so the library ignores it until it is complete
+            state['tee'] = open(f"{DOWNLOAD_FOLDER}/{title} [{key}].tmp.{ext}", 'xb')
+        except FileExistsError:
+            pass   # Someone else is already writing this file
+
+    def generate():
+        tee = state['tee']
+        with ACTIVE.track(stage='stream'):
+            for chunk in itertools.chain([first], chunks):
+                if tee:
+                    tee.write(chunk)
+                yield chunk
+        if tee:
+            # Only reached when ffmpeg finished cleanly and the client took every byte
+            tee.close()
+            state['saved'] = True
+            if STORE.remote:
+                future = postprocess.get_pool().submit(postprocess.store_output, STORE, postprocess.finalize,
+                                                       tee.name, final_path)
+                future.add_done_callback(lambda f: f.exception() or saved(f.result()))
+            else:
+                # finalize() returns the path; the library and COMPLETED hold names in the store
+                saved(os.path.basename(postprocess.finalize(tee.name, final_path)))
+
+    def saved(filename):
+        COMPLETED[key] = filename
+        LIBRARY.add(filename)
+
+    # No stream_with_context: generate() needs no request, and under API_MODE=asgi the body is
+    # pulled from whichever pool thread is free, where a pushed context could not be popped
+    response = Response(generate(), mimetype=streaming.CONTAINERS[ext][1],
+                        headers={'Content-Disposition': content_disposition(f"{title}.{ext}"),
+                                 'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(cleanup)
+    return response
+
+@app.route('/storage', methods=['GET'])
+def get_storage():
+    """Usage of the downloads volume against its quota, pins, and eviction counts (shared by all processes)."""
+    return jsonify(STORAGE.stats())
+
+@app.route('/pin/<path:filename>', methods=['PUT', 'DELETE'])
+def pin_file(filename):
+    """Pins a file so quota evictions never delete it (PUT), or unpins it (DELETE)."""
+    safe_filename = os.path.basename(filename)
+    if request.method == 'DELETE':
+        if not STORAGE.unpin(safe_filename):
+            return jsonify({"status": "error", "message": "File is not pinned"}), 404
+        return jsonify({"status": "success", "pinned": False})
+    if LIBRARY.get(safe_filename) is None and not LIBRARY.add(safe_filename):
+        return jsonify({"status": "error", "message": "File not found"}), 404
+    STORAGE.pin(safe_filename)
+    return jsonify({"status": "success", "pinned": True})
+
 @app.route('/delete/<path:filename>', methods=['DELETE'])
 def delete_file(filename):
     """Delete a file from the downloads folder."""
     try:
         # Prevent path traversal attacks
         safe_filename = os.path.basename(filename)
-        filepath = os.path.join(DOWNLOAD_FOLDER, safe_filename)
-        
-        # Check if file exists
-        if not os.path.exists(filepath):
+
+        # Delete the file, if it exists
+        if not STORE.delete(safe_filename):
             return jsonify({"status": "error", "message": "File not found"}), 404
-        
-        # Delete the file
-        os.remove(filepath)
+        LIBRARY.remove(safe_filename)
+        STORAGE.unpin(safe_filename)
         return jsonify({"status": "success", "message": f"File {safe_filename} deleted successfully"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 if __name__ == '__main__':
+    start()
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,227 @@
+# ASGI entry point for the async API mode: API_MODE=asgi gunicorn -c gunicorn.conf.py
+# (or `uvicorn asgi:app` for a single process).
+#
+# The slow paths run natively on the event loop and never hold a thread while they
+# wait: /info awaits metadata extraction on a bounded process pool, and the status
+# streams poll the task store between sleeps. Every other route is the unchanged
+# Flask app, called on its own thread pool, so cheap endpoints like /status and
+# /files never queue behind extractions. Extraction runs in separate processes because
+# yt-dlp is CPU-heavy enough to hold the GIL for long stretches. Downloads already run
+# on the scheduler's bounded worker pool (see scheduler.py).
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import api
+import info_cache
+from info_cache import canonical_key
+from task_store import is_terminal
+
+# Parallel yt-dlp metadata extractions per process; further /info requests wait their turn
+EXTRACT_WORKERS = int(os.environ.get('EXTRACT_WORKERS', '4'))
+# Threads running the synchronous Flask routes
+WSGI_THREADS = int(os.environ.get('API_THREADS', '32'))
+# How often an open status stream checks its task for changes
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', '0.25'))
+DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', '60'))
+
+# 'spawn' keeps the children from inheriting the API's threads and locks
+EXTRACTORS = ProcessPoolExecutor(EXTRACT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+WSGI_POOL = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix='wsgi')
+
+# canonical key -> running extraction, so concurrent /info calls for one video share it
+_INFLIGHT = {}
+
+CORS_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+
+# --- HELPERS ---
+async def run_sync(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode())] + CORS_HEADERS})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+# --- METADATA ---
+def lookup_cached(url):
+    return canonical_key(url), api.INFO_CACHE.get(url)
+
+async def extract_once(key, url):
+    try:
+        with api.ACTIVE.track(stage='extract'), api.EXTRACT_SECONDS.time():
+            info = await run_sync(EXTRACTORS, info_cache.extract_info, url, api.INFO_YDL_OPTS)
+        await run_sync(WSGI_POOL, api.INFO_CACHE.put, url, info)
+        return info
+    finally:
+        _INFLIGHT.pop(key, None)
+
+async def get_info(url):
+    key, info = await run_sync(WSGI_POOL, lookup_cached, url)
+    if info is not None:
+        return info
+    future = _INFLIGHT.get(key)
+    if future is None:
+        future = _INFLIGHT[key] = asyncio.ensure_future(extract_once(key, url))
+    # Shielded so a client hanging up does not cancel the extraction for everyone else
+    return await asyncio.shield(future)
+
+
+# --- NATIVE ROUTES ---
+async def video_info(scope, receive, send):
+    """Async twin of api.get_video_info."""
+    try:
+        data = json.loads(await read_body(receive) or b'{}')
+    except ValueError:
+        return await send_json(send, 400, {"status": "error", "message": "Invalid JSON body"})
+    url = data.get('url') if isinstance(data, dict) else None
+    if not url:
+        return await send_json(send, 400, {"status": "error", "message": "No URL provided"})
+    try:
+        info = await get_info(url)
+        return await send_json(send, 200, api.info_summary(info))
+    except Exception as e:
+        return await send_json(send, 400, {"status": "error", "message": str(e)})
+
+async def stream_status(scope, receive, send, task_id):
+    """Async twin of api.stream_status; polls the task store instead of blocking on it."""
+    status = await run_sync(WSGI_POOL, api.TASKS.get, task_id)
+    if status is None:
+        return await send_json(send, 404, {"status": "error", "message": "Unknown task"})
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')] + CORS_HEADERS})
+    disconnected = asyncio.ensure_future(wait_disconnect(receive))
+    version, idle = 0, 0.0
+    try:
+        while not disconnected.done():
+            if status is None:
+                # Expired while we were watching
+                break
+            if status['version'] != version:
+                version, idle = status['version'], 0.0
+                status = await run_sync(WSGI_POOL, api.with_queue_position, task_id, status)
+                event = f"id: {version}\ndata: {json.dumps(status)}\n\n"
+                await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+                if is_terminal(status):
+                    break
+                # Anything that changes while we sleep is folded into the next event
+                await asyncio.sleep(api.STREAM_COALESCE_INTERVAL)
+            else:
+                if idle >= api.STREAM_KEEPALIVE:
+                    idle = 0.0
+                    await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+                await asyncio.sleep(STREAM_POLL_INTERVAL)
+                idle += STREAM_POLL_INTERVAL
+            status = await run_sync(WSGI_POOL, api.TASKS.get, task_id)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+
+
+# --- WSGI BRIDGE ---
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def call_wsgi(scope, receive, send):
+    """Runs the Flask app for one request on WSGI_POOL, streaming its response body."""
+    environ = wsgi_environ(scope, await read_body(receive))
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+        return lambda data: None
+
+    result = await run_sync(WSGI_POOL, api.app, environ, start_response)
+    try:
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        chunks = iter(result)
+        while True:
+            chunk = await run_sync(WSGI_POOL, next, chunks, None)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await run_sync(WSGI_POOL, result.close)
+
+
+# --- APP ---
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Loads the extractor classes now rather than inside the first /info request
+            await run_sync(None, canonical_key, '')
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await run_sync(None, api.shutdown, DRAIN_TIMEOUT)
+            EXTRACTORS.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == '/info':
+        return await video_info(scope, receive, send)
+    if method == 'GET' and path.startswith('/status/') and path.endswith('/stream'):
+        task_id = path[len('/status/'):-len('/stream')]
+        if task_id and '/' not in task_id:
+            return await stream_status(scope, receive, send, task_id)
+    return await call_wsgi(scope, receive, send)
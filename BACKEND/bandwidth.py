@@ -0,0 +1,273 @@
+import threading
+import time
+import traceback
+
+UNLIMITED = float('inf')
+
+# Relative bandwidth share of a download by its queue priority
+PRIORITY_WEIGHTS = {'high': 4, 'normal': 2, 'low': 1}
+
+# Floor for the demand estimate of a download that used less than its allocation
+MIN_DEMAND = 32 * 1024
+
+LIMITS_SETTING = 'bandwidth-limits'
+DEMAND_PREFIX = 'bandwidth-demand:'
+
+
+def water_fill(capacity, demands):
+    """Weighted max-min fair split of `capacity` (bytes/s) over {key: (weight, demand)}.
+
+    Keys that want less than their weighted share get what they want; what
+    they leave is split again between the rest by weight.
+    """
+    if capacity == UNLIMITED:
+        return {key: demand for key, (_, demand) in demands.items()}
+    allocation = {}
+    pending = dict(demands)
+    while pending:
+        unit = capacity / sum(weight for weight, _ in pending.values())
+        satisfied = {key: demand for key, (weight, demand) in pending.items() if demand <= unit * weight}
+        if not satisfied:
+            allocation.update({key: unit * weight for key, (weight, _) in pending.items()})
+            break
+        for key, demand in satisfied.items():
+            allocation[key] = demand
+            capacity -= demand
+            del pending[key]
+    return allocation
+
+
+def _rate(value):
+    # Limits are stored as bytes/s with 0 meaning no limit
+    return value if value else UNLIMITED
+
+
+def _encode(rate):
+    # JSON has no infinity
+    return None if rate == UNLIMITED else rate
+
+
+def _decode(rate):
+    return UNLIMITED if rate is None else rate
+
+
+class TaskBucket:
+    """Token bucket for one download. Bytes are charged after they arrive; a
+    download that overdraws the bucket sleeps until the debt is paid off."""
+
+    def __init__(self, task_id, client, weight, burst):
+        self.task_id = task_id
+        self.client = client
+        self.weight = weight
+        self.burst = burst
+        self.rate = UNLIMITED
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._seen = {}
+        self._window_bytes = 0
+        self._window_start = time.monotonic()
+        self._waited = False
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            # Neither savings nor debt carry over beyond one burst at the new rate
+            self._tokens = max(-rate * self.burst, min(self._tokens, rate * self.burst))
+
+    def observe(self, stream, downloaded_bytes):
+        """Charges the bytes `stream` reported since its last call (yt-dlp reports running totals)."""
+        with self._lock:
+            last = self._seen.get(stream)
+            self._seen[stream] = downloaded_bytes
+            if last is None or downloaded_bytes < last:
+                # First report of a file; it may include bytes resumed from an earlier run
+                return
+            size = downloaded_bytes - last
+            self._window_bytes += size
+            if self.rate == UNLIMITED:
+                return
+            self._refill()
+            self._tokens -= size
+        # Sleep off the debt in short steps so a new rate takes effect straight away
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 0 or self.rate == UNLIMITED:
+                    return
+                self._waited = True
+                delay = -self._tokens / self.rate
+            time.sleep(min(delay, 0.25))
+
+    def sample(self):
+        """Returns (bytes/s used, whether the bucket held the download back) since the last sample."""
+        with self._lock:
+            now = time.monotonic()
+            used = self._window_bytes / max(now - self._window_start, 1e-3)
+            self._refill()
+            # Before its first bytes nothing is known about a download's demand, so it counts as held back
+            waited = self._waited or self._tokens < 0 or not self._seen
+            self._window_bytes, self._window_start, self._waited = 0, now, False
+            return used, waited
+
+    def _refill(self):
+        # Called with the lock held
+        now = time.monotonic()
+        if self.rate != UNLIMITED:
+            self._tokens = min(self.rate * self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+
+class BandwidthManager:
+    """Shapes download bandwidth with one token bucket per running download.
+
+    Every `interval` seconds the buckets are re-rated. The global cap is split
+    between clients and each client's cap between its downloads, both by
+    weighted max-min fairness, so a download that cannot use its share leaves
+    it to the others. Processes sharing a job queue publish their demand
+    through it and divide the caps between them; the limits are stored there
+    too, so a change made through any API process applies everywhere.
+    """
+
+    def __init__(self, queue, owner, defaults, on_allocation=None, interval=1.0, burst=1.0):
+        self.queue = queue
+        self.owner = owner
+        self.defaults = defaults
+        self.on_allocation = on_allocation
+        self.interval = interval
+        self.burst = burst
+        self._buckets = {}
+        self._reported = {}
+        self._published = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    # --- LIMITS ---
+    def limits(self):
+        stored = self.queue.get_setting(LIMITS_SETTING) or {}
+        return dict(self.defaults, **stored)
+
+    def set_limits(self, changes):
+        """Merges `changes` into the stored limits; a client set to None loses its override."""
+        limits = self.limits()
+        clients = dict(limits.get('clients') or {})
+        for client, rate in (changes.get('clients') or {}).items():
+            if rate is None:
+                clients.pop(client, None)
+            else:
+                clients[client] = rate
+        limits = dict(limits, **{k: v for k, v in changes.items() if k != 'clients'}, clients=clients)
+        self.queue.put_setting(LIMITS_SETTING, limits)
+        self._wake.set()
+        return limits
+
+    # --- DOWNLOADS ---
+    def register(self, task_id, client, priority):
+        bucket = TaskBucket(task_id, client or 'anonymous', PRIORITY_WEIGHTS.get(priority, PRIORITY_WEIGHTS['normal']), self.burst)
+        with self._lock:
+            self._buckets[task_id] = bucket
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='bandwidth', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return bucket
+
+    def unregister(self, task_id):
+        """Stops shaping a download. Returns True if an allocation had been reported for it."""
+        with self._lock:
+            self._buckets.pop(task_id, None)
+            reported = self._reported.pop(task_id, None)
+        self._wake.set()
+        return reported is not None and self.on_allocation is not None
+
+    def allocations(self):
+        """{task_id: allocation} for the downloads running in this process."""
+        with self._lock:
+            return dict(self._reported)
+
+    # --- REBALANCING ---
+    def _loop(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.rebalance()
+            except Exception:
+                traceback.print_exc()
+
+    def rebalance(self):
+        limits = self.limits()
+        with self._lock:
+            buckets = list(self._buckets.values())
+        global_rate, client_rate = _rate(limits.get('global_rate')), _rate(limits.get('client_rate'))
+        overrides = limits.get('clients') or {}
+        if global_rate == UNLIMITED and client_rate == UNLIMITED and not overrides:
+            rates = {b.task_id: UNLIMITED for b in buckets}
+        else:
+            rates = self._allocate(buckets, global_rate, client_rate, overrides)
+
+        for bucket in buckets:
+            bucket.set_rate(rates[bucket.task_id])
+            allocation = {"client": bucket.client, "weight": bucket.weight,
+                          "rate": _encode(rates[bucket.task_id])}
+            with self._lock:
+                previous = self._reported.get(bucket.task_id)
+                if bucket.task_id not in self._buckets:
+                    continue
+                self._reported[bucket.task_id] = allocation
+            if self.on_allocation and not _close(previous, allocation):
+                self.on_allocation(bucket.task_id, allocation)
+
+    def _allocate(self, buckets, global_rate, client_rate, overrides):
+        # Demand: a download the bucket held back wants more; one that was not wants a bit over its use
+        demand = {}
+        for bucket in buckets:
+            used, waited = bucket.sample()
+            demand[bucket.task_id] = UNLIMITED if waited or bucket.rate == UNLIMITED else max(MIN_DEMAND, used * 1.5)
+
+        local = {}
+        for bucket in buckets:
+            weight, want = local.get(bucket.client, (0, 0.0))
+            local[bucket.client] = (weight + bucket.weight, want + demand[bucket.task_id])
+        self._publish(local)
+
+        # {client: {process: (weight, demand)}} over every process with running downloads
+        everyone = {client: {self.owner: entry} for client, entry in local.items()}
+        for name, clients in self.queue.get_settings(DEMAND_PREFIX, 3 * self.interval).items():
+            process = name[len(DEMAND_PREFIX):]
+            if process == self.owner:
+                continue
+            for client, (weight, want) in clients.items():
+                everyone.setdefault(client, {})[process] = (weight, _decode(want))
+
+        def client_cap(client):
+            return _rate(overrides[client]) if client in overrides else client_rate
+
+        client_shares = water_fill(global_rate, {
+            client: (sum(w for w, _ in procs.values()), min(client_cap(client), sum(d for _, d in procs.values())))
+            for client, procs in everyone.items()
+        })
+        rates = {}
+        for client in local:
+            process_share = water_fill(client_shares[client], everyone[client])[self.owner]
+            mine = [b for b in buckets if b.client == client]
+            rates.update(water_fill(process_share, {b.task_id: (b.weight, demand[b.task_id]) for b in mine}))
+        return rates
+
+    def _publish(self, local):
+        if local or self._published:
+            self.queue.put_setting(DEMAND_PREFIX + self.owner,
+                                   {client: [weight, _encode(want)] for client, (weight, want) in local.items()})
+            self._published = bool(local)
+
+
+def _close(previous, allocation):
+    # Allocations are written to the task status only when they move by more than 5%
+    if previous is None or previous['weight'] != allocation['weight']:
+        return False
+    old, new = previous['rate'], allocation['rate']
+    if old is None or new is None:
+        return old == new
+    return abs(old - new) <= 0.05 * max(old, new)
@@ -0,0 +1,197 @@
+# Fake media origin for the benchmark: python benchmark/origin.py --port 8800
+#
+# Serves a JSON "watch page" API for the FakeOrigin yt-dlp extractor (see
+# plugins/yt_dlp_plugins/extractor/fake_origin.py) and the media it points at:
+# a progressive mp4, a video-only mp4 split into DASH-style fragments and an m4a
+# audio stream. Every video id maps to the same media. With ffmpeg on the PATH the
+# media is real (test pattern and a sine tone), so muxing and transcoding run for
+# real; without it the files are random bytes and only the progressive format is
+# offered, which needs no post-processing.
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK = 64 * 1024
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def synthesize(folder, seconds, seed):
+    """Writes progressive.mp4, video.mp4 and audio.m4a to `folder`. Returns whether they are real media."""
+    paths = {name: os.path.join(folder, name) for name in ('progressive.mp4', 'video.mp4', 'audio.m4a')}
+    if shutil.which('ffmpeg'):
+        base = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+        video = ['-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={seconds}',
+                 '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+        audio = ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}', '-c:a', 'aac', '-b:a', '128k']
+        # Fragmented like real DASH media, so the byte-range fragments can be read in order from a pipe
+        subprocess.run(base + video + ['-an', '-movflags', '+frag_keyframe+empty_moov+default_base_moof',
+                                       paths['video.mp4']], check=True)
+        subprocess.run(base + audio + ['-vn', paths['audio.m4a']], check=True)
+        subprocess.run(base + ['-f', 'lavfi', '-i', f'testsrc2=size=640x360:rate=30:duration={seconds}',
+                               '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                               '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+                               '-c:a', 'aac', '-b:a', '128k', '-shortest', paths['progressive.mp4']], check=True)
+        return True
+
+    # Roughly what the real files weigh: ~1.6 Mbit/s of video, 128 kbit/s of audio
+    rng = random.Random(seed)
+    sizes = {'progressive.mp4': 200_000 * seconds, 'video.mp4': 200_000 * seconds, 'audio.m4a': 16_000 * seconds}
+    for name, size in sizes.items():
+        with open(paths[name], 'wb') as f:
+            f.write(rng.randbytes(size))
+    return False
+
+
+class Origin:
+    def __init__(self, folder, real_media, seconds, fragments, rate, latency):
+        self.media = {}
+        for name in os.listdir(folder):
+            with open(os.path.join(folder, name), 'rb') as f:
+                self.media[name] = f.read()
+        self.real_media = real_media
+        self.seconds = seconds
+        self.fragments = fragments
+        self.rate = rate
+        self.latency = latency
+
+    def fragment(self, index):
+        data = self.media['video.mp4']
+        size = -(-len(data) // self.fragments)
+        return data[index * size:(index + 1) * size]
+
+    def manifest(self, base, video_id):
+        media = f'{base}/media/{video_id}'
+        formats = [{
+            'format_id': '360p', 'url': f'{media}/progressive.mp4', 'ext': 'mp4', 'width': 640, 'height': 360,
+            'vcodec': 'avc1.64001e', 'acodec': 'mp4a.40.2', 'filesize': len(self.media['progressive.mp4']),
+        }]
+        if self.real_media:
+            formats += [{
+                'format_id': 'dash-720p', 'url': f'{media}/video.mp4', 'protocol': 'http_dash_segments',
+                'fragments': [{'url': f'{media}/video.mp4/frag/{n}', 'duration': self.seconds / self.fragments}
+                              for n in range(self.fragments)],
+                'ext': 'mp4', 'width': 1280, 'height': 720, 'vcodec': 'avc1.64001f', 'acodec': 'none',
+                'filesize': len(self.media['video.mp4']),
+            }, {
+                'format_id': 'audio-128k', 'url': f'{media}/audio.m4a', 'ext': 'm4a', 'abr': 128,
+                'vcodec': 'none', 'acodec': 'mp4a.40.2', 'filesize': len(self.media['audio.m4a']),
+            }]
+        return {'id': video_id, 'title': f'Benchmark clip {video_id}', 'duration': self.seconds,
+                'thumbnail': f'{base}/thumb/{video_id}.jpg', 'formats': formats}
+
+
+def make_handler(origin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.route(send_body=False)
+
+        def do_GET(self):
+            self.route(send_body=True)
+
+        def route(self, send_body):
+            path = self.path.split('?', 1)[0]
+            base = f"http://{self.headers.get('Host')}"
+            parts = path.strip('/').split('/')
+            if parts[:2] == ['api', 'video'] and len(parts) == 3:
+                # Stands in for the page fetch and parsing a real extractor does
+                time.sleep(origin.latency)
+                return self.send_json(origin.manifest(base, parts[2]), send_body)
+            if parts[:2] == ['api', 'playlist'] and len(parts) == 3:
+                time.sleep(origin.latency)
+                count = int(re.search(r'count=(\d+)', self.path).group(1)) if 'count=' in self.path else 5
+                entries = [f'{parts[2]}-{n}' for n in range(count)]
+                return self.send_json({'id': parts[2], 'title': f'Benchmark playlist {parts[2]}', 'entries': entries},
+                                      send_body)
+            if parts[0] == 'media' and len(parts) == 3 and parts[2] in origin.media:
+                return self.send_bytes(origin.media[parts[2]], send_body)
+            if parts[0] == 'media' and len(parts) == 5 and parts[2:4] == ['video.mp4', 'frag'] and parts[4].isdigit():
+                index = int(parts[4])
+                if index < origin.fragments:
+                    return self.send_bytes(origin.fragment(index), send_body)
+            self.send_error(404)
+
+        def send_json(self, payload, send_body):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def send_bytes(self, data, send_body):
+            start, end = 0, len(data) - 1
+            match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(end, int(match.group(2))) if match.group(2) else end
+                else:
+                    start = max(0, len(data) - int(match.group(2)))
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(data)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            if not send_body:
+                return
+            view = memoryview(data)[start:end + 1]
+            started = time.monotonic()
+            try:
+                for offset in range(0, len(view), CHUNK):
+                    self.wfile.write(view[offset:offset + CHUNK])
+                    if origin.rate:
+                        # Paces each connection to `rate` bytes/s
+                        ahead = (offset + CHUNK) / origin.rate - (time.monotonic() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake media origin for the benchmark')
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--media-seconds', type=int, default=10, help='length of the synthetic clip')
+    parser.add_argument('--fragments', type=int, default=20, help='DASH fragments the video stream is split into')
+    parser.add_argument('--rate', type=int, default=0, help='bytes/s per connection, 0 = unpaced')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every metadata request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bench-media-') as folder:
+        real_media = synthesize(folder, args.media_seconds, args.seed)
+        origin = Origin(folder, real_media, args.media_seconds, args.fragments, args.rate, args.latency)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(origin))
+    server.daemon_threads = True
+    # The harness waits for this line before starting the API
+    print(json.dumps({'port': args.port, 'real_media': real_media,
+                      'sizes': {name: len(data) for name, data in origin.media.items()}}), flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
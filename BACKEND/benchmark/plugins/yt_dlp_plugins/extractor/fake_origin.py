@@ -0,0 +1,27 @@
+# yt-dlp plugin for the benchmark's fake origin (benchmark/origin.py). yt-dlp loads it
+# when benchmark/plugins is on PYTHONPATH, which benchmark/run.py sets for the API.
+from yt_dlp.extractor.common import InfoExtractor
+
+_BASE = r'(?P<base>https?://(?:127\.0\.0\.1|localhost):\d+)'
+
+
+class FakeOriginIE(InfoExtractor):
+    IE_NAME = 'fakeorigin'
+    _VALID_URL = _BASE + r'/watch/(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        base, video_id = self._match_valid_url(url).group('base', 'id')
+        # The origin hands out ready-made format dicts
+        return self._download_json(f'{base}/api/video/{video_id}', video_id)
+
+
+class FakeOriginPlaylistIE(InfoExtractor):
+    IE_NAME = 'fakeorigin:playlist'
+    _VALID_URL = _BASE + r'/playlist/(?P<id>[\w-]+)(?:\?count=(?P<count>\d+))?'
+
+    def _real_extract(self, url):
+        base, playlist_id, count = self._match_valid_url(url).group('base', 'id', 'count')
+        playlist = self._download_json(f'{base}/api/playlist/{playlist_id}?count={count or 5}', playlist_id)
+        entries = [self.url_result(f'{base}/watch/{video_id}', FakeOriginIE, video_id)
+                   for video_id in playlist['entries']]
+        return self.playlist_result(entries, playlist_id, playlist['title'])
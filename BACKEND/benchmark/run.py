@@ -0,0 +1,519 @@
+# Offline benchmark for the backend: python benchmark/run.py --output results.json
+#
+# Starts the fake media origin (origin.py) and the API under gunicorn with
+# gunicorn.conf.py, both on loopback, against a scratch downloads folder holding
+# --library-files files. Then runs each phase in turn:
+#
+#   files      GET /files with the queries the frontend and API clients make
+#   info       concurrent POST /info, a --info-repeat share of them for videos already asked about
+#   downloads  a burst of POST /download while clients flood /status and /status/batch,
+#              until every task has finished or failed
+#
+# and writes latency percentiles, throughput and the API's CPU time and peak RSS
+# (every process under gunicorn, read from /proc) as JSON. Pass --compare with an
+# earlier result to flag regressions; the exit status is 1 when there are any.
+# Server settings go through --env, e.g. --env API_WORKERS=4 --env API_MODE=asgi.
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.dirname(HERE)
+
+FILE_QUERIES = [
+    # (weight, query); the frontend sidebar asks for the newest few
+    (6, '/files?limit=20'),
+    (2, '/files?limit=50&cursor={cursor}'),
+    (1, '/files?limit=50&sort=name&order=asc'),
+    (1, '/files?limit=50&sort=size&type=audio'),
+    (1, '/files?limit=50&ext=mp4,webm&prefix=Bench%20clip%201'),
+    (1, '/files'),
+]
+EXTENSIONS = ['.mp4', '.mp4', '.mp3', '.webm', '.m4a']
+
+
+# --- HELPERS ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values) + 0.5)) - 1))]
+
+
+class Client:
+    """One keep-alive connection; reconnects after errors."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = dict(headers or {}, **({'Content-Type': 'application/json'} if body else {}))
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def json(self, method, path, payload=None):
+        status, body = self.request(method, path, payload)
+        return status, json.loads(body) if body else None
+
+
+class Recorder:
+    """Latencies and failures per endpoint."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def call(self, endpoint, func, *args):
+        started = time.perf_counter()
+        try:
+            status, body = func(*args)
+            ok = status < 400
+        except Exception:
+            status, body, ok = None, None, False
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return status, body
+
+    def summary(self, seconds):
+        result = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            result[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": round(len(values) / seconds, 1),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p90_ms": round(percentile(values, 90) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 2),
+            }
+        return result
+
+
+# --- SERVER RESOURCES ---
+class ProcessTree:
+    """Samples CPU time and resident memory of a process and all its descendants from /proc."""
+
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    TICKS = os.sysconf('SC_CLK_TCK')
+
+    def __init__(self, root, interval=0.2):
+        self.root = root
+        self.interval = interval
+        self.peak_rss = 0
+        self.window_peak_rss = 0   # since the current phase began
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def read(self):
+        """(CPU seconds, RSS bytes) of the tree. Reaped children count through their parent's cutime."""
+        stats, children = {}, {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    # The command name may contain spaces; the fields after it do not
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            pid = int(name)
+            stats[pid] = fields
+            children.setdefault(int(fields[1]), []).append(pid)
+        cpu, rss, pending = 0, 0, [self.root]
+        while pending:
+            pid = pending.pop()
+            if pid not in stats:
+                continue
+            fields = stats[pid]
+            cpu += sum(int(v) for v in fields[11:15])
+            rss += int(fields[21]) * self.PAGE_SIZE
+            pending.extend(children.get(pid, []))
+        return cpu / self.TICKS, rss
+
+    def _loop(self):
+        while not self._stop.is_set():
+            rss = self.read()[1]
+            self.peak_rss = max(self.peak_rss, rss)
+            self.window_peak_rss = max(self.window_peak_rss, rss)
+            self._stop.wait(self.interval)
+
+
+class Phase:
+    """Measures one phase: wall time, the server's CPU time and its peak RSS while the phase ran."""
+
+    def __init__(self, name, tree):
+        self.name = name
+        self.tree = tree
+        self.recorder = Recorder()
+
+    def __enter__(self):
+        self.cpu, self.tree.window_peak_rss = self.tree.read()
+        self.started = time.perf_counter()
+        print(f"[bench] {self.name}...", file=sys.stderr, flush=True)
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        cpu, rss = self.tree.read()
+        self.server = {"cpu_seconds": round(cpu - self.cpu, 2),
+                       "cpu_percent": round((cpu - self.cpu) / self.seconds * 100, 1),
+                       "peak_rss_bytes": max(self.tree.window_peak_rss, rss)}
+
+    def result(self, **extra):
+        return dict({"seconds": round(self.seconds, 2), "endpoints": self.recorder.summary(self.seconds),
+                     "server": self.server}, **extra)
+
+
+def run_clients(count, deadline, work):
+    """Runs `work(client, index)` in `count` threads until `deadline` (monotonic) or until it returns False."""
+    def loop(index):
+        client = Client(ARGS.port)
+        while time.monotonic() < deadline:
+            if work(client, index) is False:
+                break
+
+    threads = [threading.Thread(target=loop, args=(i,), daemon=True) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+# --- SETUP ---
+def populate_library(folder, count, seed):
+    """Fills the downloads folder with empty files named the way downloads are, spread over a year of mtimes."""
+    rng = random.Random(seed)
+    now = time.time()
+    for n in range(count):
+        path = os.path.join(folder, f"Bench clip {n:05d} [{n:012x}]{EXTENSIONS[n % len(EXTENSIONS)]}")
+        with open(path, 'wb') as f:
+            f.truncate(rng.randrange(1 << 20, 1 << 30))
+        mtime = now - rng.uniform(0, 365 * 86400)
+        os.utime(path, (mtime, mtime))
+
+
+def start_origin(workdir):
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, 'origin.py'), '--port', str(ARGS.origin_port),
+                             '--media-seconds', str(ARGS.media_seconds), '--rate', str(ARGS.origin_rate),
+                             '--latency', str(ARGS.extract_latency), '--seed', str(ARGS.seed)],
+                            stdout=subprocess.PIPE, stderr=open(os.path.join(workdir, 'origin.log'), 'w'), text=True)
+    line = proc.stdout.readline()
+    if not line:
+        raise RuntimeError(f"origin failed to start, see {workdir}/origin.log")
+    return proc, json.loads(line)
+
+
+def start_server(workdir, downloads):
+    env = dict(os.environ, BIND=f'127.0.0.1:{ARGS.port}', DOWNLOAD_FOLDER=downloads,
+               TASK_DB_PATH=os.path.join(workdir, 'tasks.db'),
+               PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(HERE, 'plugins'), os.environ.get('PYTHONPATH')])))
+    env.update(item.split('=', 1) for item in ARGS.env)
+    proc = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=BACKEND, env=env,
+                            stdout=open(os.path.join(workdir, 'server.log'), 'w'), stderr=subprocess.STDOUT)
+    started = time.perf_counter()
+    client = Client(ARGS.port)
+    # Ready once the library has been indexed and /files answers
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f"API exited with {proc.returncode}, see {workdir}/server.log")
+        try:
+            if client.request('GET', '/files?limit=1')[0] == 200:
+                return proc, time.perf_counter() - started
+        except OSError:
+            pass
+        if time.perf_counter() - started > 300:
+            raise RuntimeError("API did not come up within 300s")
+        time.sleep(0.2)
+
+
+# --- PHASES ---
+def bench_files(tree):
+    weights, queries = zip(*FILE_QUERIES)
+    rng = random.Random(ARGS.seed)
+    with Phase('files', tree) as phase:
+        def work(client, index):
+            query = rng.choices(queries, weights)[0]
+            phase.recorder.call(f'GET {query}', client.request, 'GET',
+                                query.format(cursor=rng.randrange(max(1, ARGS.library_files))))
+        run_clients(ARGS.concurrency, time.monotonic() + ARGS.duration, work)
+    return phase.result()
+
+
+def bench_info(tree, origin):
+    rng = random.Random(ARGS.seed + 1)
+    asked, lock = [], threading.Lock()
+    with Phase('info', tree) as phase:
+        def work(client, index):
+            with lock:
+                if asked and rng.random() < ARGS.info_repeat:
+                    video_id, endpoint = rng.choice(asked), 'POST /info (cached)'
+                else:
+                    video_id, endpoint = f'info-{uuid.uuid4().hex[:8]}', 'POST /info (cold)'
+                    asked.append(video_id)
+            phase.recorder.call(endpoint, client.request, 'POST', '/info', {"url": f"{origin}/watch/{video_id}"})
+        run_clients(ARGS.info_concurrency, time.monotonic() + ARGS.duration, work)
+    return phase.result()
+
+
+def bench_downloads(tree, origin, real_media, downloads):
+    rng = random.Random(ARGS.seed + 2)
+    tasks, submitted, finished = {}, {}, {}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    with Phase('downloads', tree) as phase:
+        def submit(client, index):
+            # Audio needs a real audio stream to transcode
+            audio = real_media and index % 4 == 3
+            payload = {"url": f"{origin}/watch/dl-{uuid.uuid4().hex[:8]}",
+                       "type": 'audio' if audio else 'video', "quality": '128k' if audio else '720p'}
+            status, body = phase.recorder.call('POST /download', client.json, 'POST', '/download', payload)
+            if status is not None and status < 400 and body.get('task_id'):
+                with lock:
+                    tasks[body['task_id']] = None
+                    submitted[body['task_id']] = time.monotonic()
+
+        def poll(client, index):
+            with lock:
+                task_ids = list(tasks)
+            if not task_ids:
+                time.sleep(0.01)
+                return not done.is_set()
+            if index % 4 == 0:
+                phase.recorder.call('POST /status/batch', client.request, 'POST', '/status/batch',
+                                    {"task_ids": rng.sample(task_ids, min(20, len(task_ids)))})
+            else:
+                task_id = rng.choice(task_ids)
+                status, body = phase.recorder.call('GET /status/<id>', client.json, 'GET', f'/status/{task_id}')
+                if status == 200 and body.get('stage') in ('done', 'error'):
+                    with lock:
+                        if tasks.get(task_id) is None:
+                            tasks[task_id] = body['stage']
+                            finished[task_id] = time.monotonic() - submitted[task_id]
+                            if len(finished) == ARGS.downloads:
+                                done.set()
+            return not done.is_set()
+
+        def sweep():
+            # Random polling alone takes long to notice the last few tasks
+            client = Client(ARGS.port)
+            while not done.wait(0.5):
+                with lock:
+                    pending = [t for t, stage in tasks.items() if stage is None]
+                for task_id in pending:
+                    status, body = client.json('GET', f'/status/{task_id}')
+                    if status == 200 and body.get('stage') in ('done', 'error'):
+                        with lock:
+                            if tasks.get(task_id) is None:
+                                tasks[task_id] = body['stage']
+                                finished[task_id] = time.monotonic() - submitted[task_id]
+                                if len(finished) == ARGS.downloads:
+                                    done.set()
+
+        deadline = time.monotonic() + ARGS.download_timeout
+        pollers = threading.Thread(target=run_clients, args=(ARGS.status_concurrency, deadline, poll), daemon=True)
+        pollers.start()
+        sweeper = threading.Thread(target=sweep, daemon=True)
+        sweeper.start()
+        counter = iter(range(ARGS.downloads))
+        counter_lock = threading.Lock()
+
+        def burst(client, index):
+            with counter_lock:
+                n = next(counter, None)
+            if n is None:
+                return False
+            submit(client, n)
+        run_clients(ARGS.concurrency, deadline, burst)
+        if not submitted:
+            done.set()
+        done.wait(max(0, deadline - time.monotonic()))
+        done.set()
+        pollers.join()
+        sweeper.join()
+
+    outcomes = list(tasks.values())
+    durations = sorted(finished.values())
+    size = sum(os.path.getsize(os.path.join(downloads, f)) for f in os.listdir(downloads)
+               if not f.startswith('Bench clip '))
+    return phase.result(downloads={
+        "submitted": len(submitted),
+        "finished": outcomes.count('done'),
+        "failed": outcomes.count('error'),
+        "unfinished": outcomes.count(None),
+        "completed_per_second": round(len(finished) / phase.seconds, 2),
+        "bytes_written": size,
+        "p50_seconds": round(percentile(durations, 50), 2) if durations else None,
+        "p99_seconds": round(percentile(durations, 99), 2) if durations else None,
+    })
+
+
+# --- COMPARISON ---
+def compare(old, new, tolerance):
+    """Lists what got worse than `tolerance` (a fraction) between two results."""
+    regressions = []
+    for name, phase in new['phases'].items():
+        before = old.get('phases', {}).get(name)
+        if not before:
+            continue
+        for endpoint, stats in phase['endpoints'].items():
+            prior = before['endpoints'].get(endpoint)
+            if not prior:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                if stats[key] > prior[key] * (1 + tolerance) and stats[key] - prior[key] > 1:
+                    regressions.append(f"{name} {endpoint} {key}: {prior[key]} -> {stats[key]}")
+            if stats['throughput_rps'] < prior['throughput_rps'] * (1 - tolerance):
+                regressions.append(f"{name} {endpoint} throughput_rps: {prior['throughput_rps']} -> {stats['throughput_rps']}")
+        for key in ('cpu_seconds', 'peak_rss_bytes'):
+            if phase['server'][key] > before['server'][key] * (1 + tolerance):
+                regressions.append(f"{name} server {key}: {before['server'][key]} -> {phase['server'][key]}")
+    return regressions
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BACKEND, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- MAIN ---
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark for the backend')
+    parser.add_argument('--output', help='write the JSON result here instead of stdout')
+    parser.add_argument('--compare', help='an earlier result to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging, as a fraction')
+    parser.add_argument('--label', help='free-form name stored with the result')
+    parser.add_argument('--phases', default='files,info,downloads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per timed phase')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients for /files and the /download burst')
+    parser.add_argument('--info-concurrency', type=int, default=8)
+    parser.add_argument('--info-repeat', type=float, default=0.5, help='share of /info calls for known videos')
+    parser.add_argument('--status-concurrency', type=int, default=32, help='clients polling /status during downloads')
+    parser.add_argument('--downloads', type=int, default=24)
+    parser.add_argument('--download-timeout', type=float, default=300)
+    parser.add_argument('--library-files', type=int, default=50000)
+    parser.add_argument('--media-seconds', type=int, default=10)
+    parser.add_argument('--origin-rate', type=int, default=0, help='bytes/s per origin connection, 0 = unpaced')
+    parser.add_argument('--extract-latency', type=float, default=0.05, help='seconds the origin adds per metadata request')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='API setting, repeatable')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch folder (logs, downloads, task db)')
+    args = parser.parse_args()
+    args.port, args.origin_port = free_port(), free_port()
+    return args
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='ytdl-bench-')
+    downloads = os.path.join(workdir, 'downloads')
+    os.makedirs(downloads)
+    origin_proc = server = tree = None
+    phases = ARGS.phases.split(',')
+    try:
+        populate_library(downloads, ARGS.library_files, ARGS.seed)
+        origin_proc, media = start_origin(workdir)
+        origin = f'http://127.0.0.1:{ARGS.origin_port}'
+        server, startup = start_server(workdir, downloads)
+        tree = ProcessTree(server.pid)
+        tree.start()
+
+        result = {
+            "label": ARGS.label,
+            "version": version(),
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count(), "ffmpeg": bool(shutil.which('ffmpeg')),
+                            "yt_dlp": __import__('yt_dlp').version.__version__},
+            "config": {k: v for k, v in vars(ARGS).items() if k not in ('output', 'compare', 'keep')},
+            "media": media,
+            "startup_seconds": round(startup, 2),
+            "phases": {},
+        }
+        if 'files' in phases:
+            result['phases']['files'] = bench_files(tree)
+        if 'info' in phases:
+            result['phases']['info'] = bench_info(tree, origin)
+        if 'downloads' in phases:
+            result['phases']['downloads'] = bench_downloads(tree, origin, media['real_media'], downloads)
+        result['server'] = {"cpu_seconds": round(tree.read()[0], 2), "peak_rss_bytes": tree.peak_rss}
+    finally:
+        if tree:
+            tree.stop()
+        for proc in (server, origin_proc):
+            if proc and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+                try:
+                    proc.wait(30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        if ARGS.keep:
+            print(f"[bench] scratch folder kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(result, indent=2)
+    if ARGS.output:
+        with open(ARGS.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if ARGS.compare:
+        with open(ARGS.compare) as f:
+            regressions = compare(json.load(f), result, ARGS.tolerance)
+        for line in regressions:
+            print(f"[bench] REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("[bench] no regressions", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    main()
@@ -0,0 +1,215 @@
+# Checks the Redis and S3 backends against local stand-ins: python benchmark/standins.py
+#
+# Starts fakeredis and moto's S3 server on loopback (pip install fakeredis moto[server]),
+# unless --redis-url / --s3-endpoint point at real servers, and runs:
+#
+#   lease      a RedisJobQueue job whose owner stops heartbeating is claimed again by
+#              another owner; one whose owner keeps heartbeating is not
+#   dedup      a RedisTaskStore dedup key is held by one task at a time and passes on
+#              once that task finishes
+#   watch      a RedisTaskStore update that loses the WATCH race to another writer is
+#              redone on top of that writer's change, and many concurrent writers lose
+#              no fields
+#   multipart  S3FileStore.put uploads a file larger than a part in parallel parts, then
+#              stat, names, a ranged GET of the presigned URL and delete
+#
+# The exit status is 1 if any check fails. Nothing outside the stand-ins is touched
+# except a scratch folder, which is removed.
+import argparse
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from file_store import S3FileStore  # noqa: E402
+from job_queue import RedisJobQueue  # noqa: E402
+from task_store import RedisTaskStore  # noqa: E402
+
+# S3 refuses multipart parts under 5 MiB (except the last)
+PART_SIZE = 5 * 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fakeredis():
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    # Connection threads must not keep the script alive once the checks are done
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fakeredis', daemon=True).start()
+    return f'redis://127.0.0.1:{port}/0'
+
+
+def start_moto():
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False).start()
+    # moto takes any credentials, but boto3 wants some
+    for name, value in (('AWS_ACCESS_KEY_ID', 'test'), ('AWS_SECRET_ACCESS_KEY', 'test'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        os.environ.setdefault(name, value)
+    return f'http://127.0.0.1:{port}'
+
+
+def check_lease(redis_url):
+    prefix = f'standins-{uuid.uuid4().hex[:8]}'
+    queue = RedisJobQueue(redis_url, 0, poll_interval=0.1, lease_ttl=1, prefix=prefix)
+    queue.put('abandoned', ['a'], 1)
+    queue.put('renewed', ['b'], 2)
+    assert queue.claim('host-a:1', 1)[0] == 'abandoned'
+    assert queue.claim('host-b:1', 1)[0] == 'renewed'
+    # host-a goes quiet while host-b keeps its lease alive
+    deadline = time.monotonic() + 2.5
+    while time.monotonic() < deadline:
+        queue.heartbeat('host-b:1', 1, 1)
+        time.sleep(0.2)
+    job = queue.claim('host-c:1', 2)
+    assert job and job[0] == 'abandoned', f"expired lease not re-claimed: {job}"
+    assert job[1] == ('a',), job
+    assert queue.claim('host-c:1', 0.5) is None, "a job with a renewed lease was taken"
+    queue.done('abandoned')
+    queue.done('renewed')
+    assert queue.stats() == {"queued": 0, "running": 0}, queue.stats()
+
+
+def check_dedup(redis_url):
+    store = RedisTaskStore(redis_url, 3600, prefix=f'standins-{uuid.uuid4().hex[:8]}')
+    job = {"key": "0123456789ab"}
+    assert store.create('first', {"stage": "queued"}, job) == 'first'
+    assert store.create('second', {"stage": "queued"}, job) == 'first'
+    assert store.get('second') is None, "an exclusive create of a held key created a task"
+    assert store.create('third', {"stage": "queued"}, job, exclusive=False) == 'first'
+    assert store.claim('third') == 'first'
+    store.update('first', {"stage": "download"})
+    assert store.active_task_for_key(job['key']) == 'first', "an ordinary update moved the key"
+    store.update('first', {"stage": "done"})
+    assert store.active_task_for_key(job['key']) is None
+    assert store.claim('third') == 'third'
+
+
+def check_watch(redis_url):
+    prefix = f'standins-{uuid.uuid4().hex[:8]}'
+    store = RedisTaskStore(redis_url, 3600, prefix=prefix)
+    rival = RedisTaskStore(redis_url, 3600, prefix=prefix)
+    store.create('task', {"stage": "download"})
+
+    # The rival writes between store's WATCH and its MULTI, exactly once
+    real_incr, attempts = store.r.incr, []
+
+    def incr(name, *args, **kwargs):
+        attempts.append(name)
+        if len(attempts) == 1:
+            rival.update('task', {"rival": True})
+        return real_incr(name, *args, **kwargs)
+
+    store.r.incr = incr
+    store.update('task', {"progress": 50})
+    store.r.incr = real_incr
+    status = store.get('task')
+    assert len(attempts) == 2, f"expected one retry, got {len(attempts) - 1}"
+    assert status.get('rival') is True and status.get('progress') == 50, status
+
+    # Free-for-all: every writer sets its own field, none may go missing
+    def write(n):
+        writer = RedisTaskStore(redis_url, 3600, prefix=prefix)
+        for i in range(20):
+            writer.update('task', {f"w{n}": i})
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    status = store.get('task')
+    missing = [n for n in range(8) if status.get(f"w{n}") != 19]
+    assert not missing, f"lost updates from writers {missing}: {status}"
+
+
+def check_multipart(s3_endpoint, scratch):
+    import boto3
+    bucket = f'standins-{uuid.uuid4().hex[:8]}'
+    boto3.client('s3', endpoint_url=s3_endpoint).create_bucket(Bucket=bucket)
+    store = S3FileStore(bucket, prefix='downloads', endpoint_url=s3_endpoint, part_size=PART_SIZE, concurrency=4)
+
+    name = 'clip [0123456789ab].mp4'
+    path = os.path.join(scratch, name)
+    data = os.urandom(2 * PART_SIZE + 12345)
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert store.put(path, name) == name
+    assert not os.path.exists(path), "the local copy was left behind"
+
+    head = store._s3().head_object(Bucket=bucket, Key='downloads/' + name)
+    # Multipart uploads get an ETag of the form "<md5 of part md5s>-<number of parts>"
+    assert head['ETag'].strip('"').endswith('-3'), f"not a 3-part upload: {head['ETag']}"
+    assert head['ContentType'] == 'video/mp4', head['ContentType']
+
+    fresh = S3FileStore(bucket, prefix='downloads', endpoint_url=s3_endpoint)
+    assert fresh.stat(name)[0] == len(data), "stat without a listing"
+    assert fresh.names() == [name], fresh.names()
+
+    request = urllib.request.Request(store.url(name, 'clip.mp4'), headers={'Range': 'bytes=100-199'})
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 206, response.status
+        assert response.read() == data[100:200], "ranged GET returned the wrong bytes"
+        assert 'clip.mp4' in response.headers.get('Content-Disposition', ''), response.headers
+
+    assert store.delete(name) is True
+    assert store.stat(name) is None
+    assert store.delete(name) is False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks the Redis and S3 backends against stand-ins')
+    parser.add_argument('--redis-url', help='Redis to use instead of starting fakeredis')
+    parser.add_argument('--s3-endpoint', help='S3 endpoint to use instead of starting moto')
+    parser.add_argument('checks', nargs='*', default=['lease', 'dedup', 'watch', 'multipart'])
+    args = parser.parse_args()
+
+    redis_url = s3_endpoint = None
+    if {'lease', 'dedup', 'watch'} & set(args.checks):
+        redis_url = args.redis_url or start_fakeredis()
+    if 'multipart' in args.checks:
+        s3_endpoint = args.s3_endpoint or start_moto()
+    scratch = tempfile.mkdtemp(prefix='ytdl-standins-')
+    checks = {
+        'lease': lambda: check_lease(redis_url),
+        'dedup': lambda: check_dedup(redis_url),
+        'watch': lambda: check_watch(redis_url),
+        'multipart': lambda: check_multipart(s3_endpoint, scratch),
+    }
+    failed = []
+    try:
+        for name in args.checks:
+            started = time.monotonic()
+            try:
+                checks[name]()
+            except Exception:
+                failed.append(name)
+                print(f"FAIL {name}", flush=True)
+                traceback.print_exc()
+            else:
+                print(f"ok   {name} ({time.monotonic() - started:.1f}s)", flush=True)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
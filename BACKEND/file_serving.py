@@ -0,0 +1,105 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from flask import Response
+from werkzeug.http import http_date, parse_date, parse_range_header
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def content_disposition(download_name):
+    # RFC 6266: plain ASCII fallback plus the UTF-8 name for browsers that understand it
+    ascii_name = download_name.encode('ascii', 'replace').decode().replace('"', '')
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(download_name)}"
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(BLOCK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_etag(size, mtime):
+    return f"{int(mtime * 1e6):x}-{size:x}"
+
+
+def not_modified(request, etag, mtime):
+    """True when the client's cached copy (If-None-Match / If-Modified-Since) is still current."""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    since = request.if_modified_since
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+def serve_file(request, path, download_name, size, mtime, mode='sendfile', accel_prefix='/protected'):
+    """Serves a file with ETag/Last-Modified validation and single byte-range support.
+
+    mode 'sendfile' streams from Python; when the WSGI server offers
+    wsgi.file_wrapper (gunicorn), the open file is handed to it so the bytes go
+    out through os.sendfile without being copied into Python. 'x-accel'
+    (nginx) and 'x-sendfile' (Apache/lighttpd) only send headers and let the
+    front proxy serve the bytes.
+    """
+    etag = file_etag(size, mtime)
+    content_type = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    headers = {
+        'Content-Disposition': content_disposition(download_name),
+        'Last-Modified': http_date(mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=0, must-revalidate',
+    }
+
+    if not_modified(request, etag, mtime):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    if mode == 'x-accel':
+        headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{quote(os.path.basename(path))}"
+        response = Response(headers=headers, content_type=content_type)
+        response.set_etag(etag)
+        return response
+    if mode == 'x-sendfile':
+        headers['X-Sendfile'] = path
+        response = Response(headers=headers, content_type=content_type)
+        response.set_etag(etag)
+        return response
+
+    # Byte ranges; If-Range falls back to the whole file when the client's copy is stale
+    start, length, status = 0, size, 200
+    range_header = parse_range_header(request.headers.get('Range'))
+    if_range = request.headers.get('If-Range')
+    if range_header and if_range:
+        if_range_date = parse_date(if_range)
+        if if_range.strip('"') != etag and (if_range_date is None or int(mtime) > if_range_date.timestamp()):
+            range_header = None
+    if range_header and range_header.units == 'bytes' and len(range_header.ranges) == 1:
+        bounds = range_header.range_for_length(size)
+        if bounds is None:
+            response = Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+            response.set_etag(etag)
+            return response
+        start, stop = bounds
+        length, status = stop - start, 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+    headers['Content-Length'] = str(length)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        # The server sends Content-Length bytes from the current offset with os.sendfile
+        f = open(path, 'rb')
+        f.seek(start)
+        body = file_wrapper(f, BLOCK_SIZE)
+    else:
+        body = _read_range(path, start, length)
+
+    response = Response(body, status=status, headers=headers, content_type=content_type,
+                        direct_passthrough=True)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,171 @@
+# Where finished downloads are kept. yt-dlp and ffmpeg always work in the local downloads
+# folder; the file store receives each finished file from there. The local store keeps it
+# in place. An S3-compatible store uploads it (multipart, parts in parallel) and serves
+# it with presigned URLs, so downloads go straight from the bucket to the client.
+import mimetypes
+import os
+import threading
+import time
+
+from file_serving import content_disposition
+from library import is_partial
+
+
+class LocalFileStore:
+    """Finished files stay in the downloads folder and are served from there."""
+
+    remote = False
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def version(self):
+        """Changes whenever files come or go; None when the store cannot tell cheaply."""
+        return os.stat(self.folder).st_mtime_ns
+
+    def names(self):
+        try:
+            with os.scandir(self.folder) as it:
+                return [e.name for e in it if e.is_file() and not is_partial(e.name)]
+        except FileNotFoundError:
+            return []
+
+    def stat(self, name):
+        """(size, mtime) of a finished file, or None."""
+        try:
+            stat_info = os.stat(self.path(name))
+        except OSError:
+            return None
+        return stat_info.st_size, stat_info.st_mtime
+
+    def put(self, path, name):
+        """Stores the file at `path` as `name`. Returns the name."""
+        if path != self.path(name):
+            os.replace(path, self.path(name))
+        return name
+
+    def delete(self, name):
+        """Returns False if there was no such file."""
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+class S3FileStore:
+    """Finished files are objects under `prefix` in an S3-compatible bucket.
+
+    Credentials come from the usual AWS environment variables or config files.
+    `endpoint_url` points it at MinIO, Ceph, R2 and the like. Listings are
+    kept between scans, so stat() of a file listed before costs no request.
+    The store is pickled into the post-processing pool; every process makes
+    its own client.
+    """
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, part_size=16 * 1024 * 1024,
+                 concurrency=8, url_ttl=3600):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.url_ttl = url_ttl
+        self._client = None
+        self._listing = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__, _client=None, _listing={})
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _lock=threading.Lock())
+
+    def _s3(self):
+        with self._lock:
+            if self._client is None:
+                import boto3  # Only needed for FILE_STORE=s3
+                from botocore.config import Config
+                self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region,
+                                            config=Config(max_pool_connections=max(10, self.concurrency)))
+            return self._client
+
+    def _key(self, name):
+        return self.prefix + name
+
+    def _missing(self, error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def version(self):
+        return None
+
+    def names(self):
+        listing = {}
+        for page in self._s3().get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                name = obj['Key'][len(self.prefix):]
+                # Objects in "subfolders" under the prefix are not ours
+                if name and '/' not in name:
+                    listing[name] = (obj['Size'], obj['LastModified'].timestamp())
+        with self._lock:
+            self._listing = listing
+        return list(listing)
+
+    def stat(self, name):
+        with self._lock:
+            listed = self._listing.get(name)
+        if listed:
+            return listed
+        from botocore.exceptions import ClientError
+        try:
+            head = self._s3().head_object(Bucket=self.bucket, Key=self._key(name))
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+        return head['ContentLength'], head['LastModified'].timestamp()
+
+    def put(self, path, name):
+        """Uploads the file, in parallel parts if it is larger than one, then deletes the local copy."""
+        from boto3.s3.transfer import TransferConfig
+        config = TransferConfig(multipart_threshold=self.part_size, multipart_chunksize=self.part_size,
+                                max_concurrency=self.concurrency, use_threads=self.concurrency > 1)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        size = os.path.getsize(path)
+        self._s3().upload_file(path, self.bucket, self._key(name), Config=config,
+                               ExtraArgs={'ContentType': content_type})
+        with self._lock:
+            self._listing[name] = (size, time.time())
+        os.remove(path)
+        return name
+
+    def delete(self, name):
+        if self.stat(name) is None:
+            return False
+        self._s3().delete_object(Bucket=self.bucket, Key=self._key(name))
+        with self._lock:
+            self._listing.pop(name, None)
+        return True
+
+    def url(self, name, download_name=None):
+        """A presigned GET URL that downloads the file as an attachment named `download_name`."""
+        params = {'Bucket': self.bucket, 'Key': self._key(name),
+                  'ResponseContentDisposition': content_disposition(download_name or name)}
+        return self._s3().generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_ttl)
+
+
+def create_file_store(kind, folder, bucket=None, **s3_options):
+    """Builds the file store matching the FILE_STORE setting."""
+    if kind == 's3':
+        if not bucket:
+            raise ValueError("FILE_STORE=s3 needs S3_BUCKET")
+        return S3FileStore(bucket, **s3_options)
+    return LocalFileStore(folder)
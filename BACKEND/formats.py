@@ -0,0 +1,208 @@
+# Format tables for /info and format selection for /download, both worked out from the
+# cached info dict, so picking a format never costs another extraction.
+import re
+
+# Constraints /download accepts under "format" as an object. name -> (type, description)
+CONSTRAINTS = {
+    'max_height': (int, 'tallest video, in pixels'),
+    'min_height': (int, 'shortest video, in pixels'),
+    'max_fps': (int, 'highest frame rate'),
+    'max_filesize': (int, 'largest total size in bytes (estimates count; unknown sizes pass)'),
+    'vcodec': (str, 'video codec prefix, e.g. avc1, vp09, av01'),
+    'acodec': (str, 'audio codec prefix, e.g. mp4a, opus'),
+}
+FORMAT_ID_PATTERN = re.compile(r'^[\w.-]+(\+[\w.-]+)?$')
+
+# The quality buttons as constraints. Like the format strings they replace, they fall back
+# to the best format overall when nothing meets them
+QUALITY_PRESETS = {'max': {}, '1080p': {'max_height': 1080}, '720p': {'max_height': 720}}
+DEFAULT_PRESET = {'max_height': 360}
+
+# Codecs ffmpeg can stream-copy into the .mp4 that merge_av writes. The first group plays
+# almost everywhere and is preferred when it does not cost resolution
+MP4_NATIVE_VIDEO = ('avc1', 'h264')
+MP4_VIDEO = MP4_NATIVE_VIDEO + ('hev1', 'hvc1', 'h265', 'av01', 'vp09', 'vp9')
+MP4_NATIVE_AUDIO = ('mp4a', 'aac')
+MP4_AUDIO = MP4_NATIVE_AUDIO + ('mp3', 'opus', 'ac-3', 'ec-3', 'flac')
+
+
+def parse_format(raw):
+    """Validates a request's format: a format id ("137" or "137+140") or a constraints object.
+
+    Returns it unchanged (None if absent); raises ValueError.
+    """
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        if not FORMAT_ID_PATTERN.match(raw):
+            raise ValueError("format must be a format id, two joined by '+', or an object of constraints")
+        return raw
+    if not isinstance(raw, dict):
+        raise ValueError("format must be a format id or an object of constraints")
+    for name, value in raw.items():
+        if name not in CONSTRAINTS:
+            raise ValueError(f"Unknown format constraint: {name}")
+        kind = CONSTRAINTS[name][0]
+        if kind is int and (isinstance(value, bool) or not isinstance(value, int) or value < 1):
+            raise ValueError(f"format.{name} must be a positive integer")
+        if kind is str and (not isinstance(value, str) or not value):
+            raise ValueError(f"format.{name} must be a non-empty string")
+    return raw
+
+
+def _codec(value):
+    # yt-dlp uses 'none' for an absent stream and leaves the field out when it does not know
+    if value in (None, 'none'):
+        return value
+    return value.lower()
+
+
+def format_table(info):
+    """One row per downloadable format of an info dict, worst to best as yt-dlp orders them."""
+    duration = info.get('duration')
+    rows = []
+    for f in info.get('formats') or []:
+        vcodec, acodec = _codec(f.get('vcodec')), _codec(f.get('acodec'))
+        if vcodec == 'none' and acodec == 'none':
+            # Storyboards and other images
+            continue
+        filesize, estimated = f.get('filesize'), False
+        if not filesize and f.get('filesize_approx'):
+            filesize, estimated = f['filesize_approx'], True
+        elif not filesize and f.get('tbr') and duration:
+            # tbr is in kbit/s
+            filesize, estimated = int(f['tbr'] * 125 * duration), True
+        rows.append({
+            "format_id": f.get('format_id'),
+            "ext": f.get('ext'),
+            "kind": 'audio' if vcodec == 'none' else 'video' if acodec == 'none' else 'av',
+            "vcodec": vcodec,
+            "acodec": acodec,
+            "width": f.get('width'),
+            "height": f.get('height'),
+            "fps": f.get('fps'),
+            "tbr": f.get('tbr'),
+            "vbr": f.get('vbr'),
+            "abr": f.get('abr'),
+            "filesize": filesize,
+            "filesize_estimated": estimated,
+            "protocol": f.get('protocol'),
+            "note": f.get('format_note'),
+        })
+    return rows
+
+
+def _is(codec, prefixes):
+    return bool(codec) and codec.startswith(prefixes)
+
+
+def _fits(row, constraints):
+    """Whether a format meets the constraints that apply to its streams."""
+    has_video = row['kind'] != 'audio'
+    if has_video:
+        height, fps = row['height'], row['fps']
+        if 'max_height' in constraints and (height is None or height > constraints['max_height']):
+            return False
+        if 'min_height' in constraints and (height is None or height < constraints['min_height']):
+            return False
+        if 'max_fps' in constraints and fps and fps > constraints['max_fps']:
+            return False
+        if 'vcodec' in constraints and not _is(row['vcodec'], constraints['vcodec'].lower()):
+            return False
+    if row['kind'] != 'video' and 'acodec' in constraints and not _is(row['acodec'], constraints['acodec'].lower()):
+        return False
+    return True
+
+
+def _size(*rows):
+    sizes = [row['filesize'] for row in rows]
+    return None if None in sizes else sum(sizes)
+
+
+def _small_enough(rows, constraints):
+    size = _size(*rows)
+    return 'max_filesize' not in constraints or size is None or size <= constraints['max_filesize']
+
+
+def _video_rank(row):
+    return (row['height'] or 0, row['fps'] or 0, _is(row['vcodec'], MP4_NATIVE_VIDEO), row['tbr'] or 0)
+
+
+def _bitrate(row):
+    return row['abr'] or row['tbr'] or 0
+
+
+def _audio_rank(row):
+    # For muxing beside a video: copyable everywhere first, then quality
+    return (_is(row['acodec'], MP4_NATIVE_AUDIO), _bitrate(row))
+
+
+def _choice(rows):
+    return {"format_id": '+'.join(row['format_id'] for row in rows), "formats": rows, "filesize": _size(*rows)}
+
+
+def _best_video(table, constraints):
+    # Separate streams muxed by stream copy, or a single stream that already has both
+    videos = sorted((r for r in table if r['kind'] == 'video' and _is(r['vcodec'], MP4_VIDEO)
+                     and _fits(r, constraints)), key=_video_rank, reverse=True)
+    audios = sorted((r for r in table if r['kind'] == 'audio' and _is(r['acodec'], MP4_AUDIO)
+                     and _fits(r, constraints)), key=_audio_rank, reverse=True)
+    pair = next(([v, a] for v in videos for a in audios if _small_enough([v, a], constraints)), None)
+    single = max((r for r in table if r['kind'] == 'av' and _fits(r, constraints) and _small_enough([r], constraints)),
+                 key=_video_rank, default=None)
+    if single and (pair is None or _video_rank(single) >= _video_rank(pair[0])):
+        # As good as the best pair and needs no merge
+        return [single]
+    return pair
+
+
+def _best_audio(table, constraints, keepable=None):
+    candidates = [r for r in table if r['kind'] == 'audio' and _fits(r, constraints) and _small_enough([r], constraints)]
+    if candidates:
+        # A stream the output can keep as it is beats a better one that would need re-encoding
+        return [max(candidates, key=lambda r: (bool(keepable and keepable(r)), _bitrate(r)))]
+    # Only formats with video as well; the audio is extracted from the smallest of the best-sounding
+    audio_constraints = {k: v for k, v in constraints.items() if k in ('acodec', 'max_filesize')}
+    candidates = [r for r in table if r['kind'] == 'av' and _fits(r, audio_constraints) and _small_enough([r], constraints)]
+    if candidates:
+        return [min(candidates, key=lambda r: (-_bitrate(r), r['filesize'] or 0))]
+    return None
+
+
+def resolve(table, type_mode, quality, requested=None, keepable=None):
+    """Picks the formats to download from a format table.
+
+    `requested` is what parse_format() accepted; without it the quality preset
+    applies. For audio, `keepable(row)` tells which streams the output could
+    keep without re-encoding; those are preferred. Returns {"format_id",
+    "formats", "filesize"}, where format_id is the format string to hand
+    yt-dlp; raises ValueError if nothing fits.
+    """
+    if isinstance(requested, str):
+        by_id = {row['format_id']: row for row in table}
+        rows = []
+        for format_id in requested.split('+'):
+            if format_id not in by_id:
+                raise ValueError(f"Unknown format id: {format_id}")
+            rows.append(by_id[format_id])
+        if type_mode == 'audio' and all(row['kind'] == 'video' for row in rows):
+            raise ValueError(f"Format {requested} has no audio")
+        if type_mode == 'video' and [row['kind'] for row in rows] == ['video']:
+            # A lone video stream gets the best audio that can be copied in beside it
+            audio = max((r for r in table if r['kind'] == 'audio' and _is(r['acodec'], MP4_AUDIO)),
+                        key=_audio_rank, default=None)
+            if audio:
+                rows.append(audio)
+        return _choice(rows)
+
+    preset = requested is None
+    constraints = requested or (QUALITY_PRESETS.get(quality, DEFAULT_PRESET) if type_mode == 'video' else {})
+    if type_mode == 'video':
+        pick = _best_video
+    else:
+        def pick(table, constraints):
+            return _best_audio(table, constraints, keepable)
+    rows = pick(table, constraints) or (pick(table, {}) if preset else None)
+    if not rows:
+        raise ValueError("No format matches the requested constraints" if requested else "No downloadable formats")
+    return _choice(rows)
@@ -0,0 +1,37 @@
+# Production server settings: gunicorn -c gunicorn.conf.py
+# Everything is read from the environment so docker-compose.yml stays the one place to tune it.
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# Several API processes share tasks and the download queue through SQLite (TASK_STORE=shared)
+workers = int(os.environ.get('API_WORKERS', '1'))
+
+# 'wsgi': the Flask app on threaded workers, where every open /status/<id>/stream and
+# every /info extraction holds a thread. 'asgi': the event-loop front end in asgi.py.
+API_MODE = os.environ.get('API_MODE', 'wsgi')
+if API_MODE == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'api:app'
+    worker_class = 'gthread'
+threads = int(os.environ.get('API_THREADS', '32'))
+
+keepalive = int(os.environ.get('KEEPALIVE', '5'))
+timeout = int(os.environ.get('REQUEST_TIMEOUT', '120'))
+
+# Seconds a stopping worker waits for its running downloads before handing them back to the queue
+DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', '60'))
+# The master must not kill a worker while it is still draining
+graceful_timeout = DRAIN_TIMEOUT + 30
+
+accesslog = '-'
+
+
+def worker_exit(server, worker):
+    """Drains in-flight downloads and post-processing before the worker process goes away."""
+    import api
+    released = api.shutdown(DRAIN_TIMEOUT)
+    if released:
+        server.log.info("Worker %s handed %d unfinished downloads back to the queue", worker.pid, len(released))
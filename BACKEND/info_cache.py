@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+
+import yt_dlp
+from yt_dlp.extractor import gen_extractor_classes
+
+_EXTRACTORS = None
+
+
+def canonical_key(url):
+    """Maps a URL to '<extractor>:<video id>' so different spellings of the same video share an entry."""
+    global _EXTRACTORS
+    if _EXTRACTORS is None:
+        # The generic extractor matches everything, so it is left out and the raw URL is used instead
+        _EXTRACTORS = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+    for ie in _EXTRACTORS:
+        if ie.suitable(url):
+            try:
+                return f"{ie.ie_key()}:{ie.get_temp_id(url)}"
+            except Exception:
+                break
+    return url
+
+
+def extract_info(url, ydl_opts):
+    """Metadata-only extraction. Module-level and picklable both ways, so it can run in a worker process."""
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+
+class InfoCache:
+    """Thread-safe TTL cache for yt-dlp info dicts with LRU eviction."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        key = canonical_key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, url, info):
+        keys = {canonical_key(url)}
+        if info.get('extractor_key') and info.get('id'):
+            keys.add(f"{info['extractor_key']}:{info['id']}")
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._entries[key] = (expires, info)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_extract(self, url, extract):
+        """Returns the cached info for a URL, calling extract(url) on a miss."""
+        info = self.get(url)
+        if info is None:
+            info = extract(url)
+            self.put(url, info)
+        return info
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
@@ -0,0 +1,596 @@
+import heapq
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+
+def node_of(owner):
+    """The host part of a scheduler's owner id ("host:pid")."""
+    return owner.rsplit(':', 1)[0]
+
+
+class LocalJobQueue:
+    """In-process priority queue. Jobs are served by priority, then FIFO.
+
+    A job may belong to a group with a limit on how many of its jobs run at
+    once (used for playlist batches); jobs of a full group are skipped over
+    until one of its running jobs is done.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._delayed = []   # (runnable at, heap entry) of jobs handed back by retry()
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._running = {}
+        self._group_running = Counter()
+        self._group_limits = {}
+        self._settings = {}
+
+    def put(self, task_id, args, priority, group=None, group_limit=None):
+        with self._cond:
+            if group:
+                self._group_limits[group] = group_limit
+            heapq.heappush(self._heap, (priority, next(self._counter), task_id, args, group))
+            self._cond.notify()
+
+    def claim(self, owner, timeout):
+        """Takes the next runnable job, waiting up to `timeout` seconds. Returns (task_id, args) or None."""
+        with self._cond:
+            job = self._pop_runnable()
+            if job is None and self._cond.wait(timeout):
+                job = self._pop_runnable()
+            return job
+
+    def _pop_runnable(self):
+        # Called with the lock held
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            heapq.heappush(self._heap, heapq.heappop(self._delayed)[1])
+        skipped, found = [], None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            group = entry[4]
+            if group and self._group_running[group] >= (self._group_limits.get(group) or 1):
+                skipped.append(entry)
+                continue
+            found = entry
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        if found is None:
+            return None
+        _, _, task_id, args, group = found
+        self._running[task_id] = found
+        if group:
+            self._group_running[group] += 1
+        return task_id, args
+
+    def done(self, task_id):
+        """Removes a job for good, freeing its slot or dropping it from the queue. Unknown jobs are ignored."""
+        with self._cond:
+            self._free(self._running.pop(task_id, None))
+            if any(entry[2] == task_id for entry in self._heap):
+                self._heap = [entry for entry in self._heap if entry[2] != task_id]
+                heapq.heapify(self._heap)
+            if any(entry[1][2] == task_id for entry in self._delayed):
+                self._delayed = [entry for entry in self._delayed if entry[1][2] != task_id]
+                heapq.heapify(self._delayed)
+            self._cond.notify_all()
+
+    def _free(self, entry):
+        # Called with the lock held
+        group = entry[4] if entry else None
+        if group:
+            self._group_running[group] -= 1
+            if self._group_running[group] <= 0:
+                del self._group_running[group]
+
+    def handoff(self, task_id, owner):
+        # Nothing outlives the process, so a job in post-processing needs no record
+        self.done(task_id)
+
+    def release(self, task_id):
+        # Dropped here; the task store requeues the task on the next start
+        self.done(task_id)
+
+    def retry(self, task_id, delay):
+        """Puts a claimed job back in the queue, keeping its place, runnable again after `delay` seconds."""
+        with self._cond:
+            entry = self._running.pop(task_id, None)
+            if entry is None:
+                return
+            self._free(entry)
+            heapq.heappush(self._delayed, (time.monotonic() + delay, entry))
+            self._cond.notify_all()
+
+    def waiting_priority(self):
+        """Priority of the most urgent queued job that could start if a slot were free, or None."""
+        with self._cond:
+            now = time.monotonic()
+            waiting = self._heap + [entry for due, entry in self._delayed if due <= now]
+            runnable = [entry[0] for entry in waiting
+                        if not entry[4] or self._group_running[entry[4]] < (self._group_limits.get(entry[4]) or 1)]
+            return min(runnable, default=None)
+
+    def position(self, task_id):
+        """Returns the 1-based queue position of a task, or None if it is not queued."""
+        with self._cond:
+            for i, entry in enumerate(sorted(self._heap)):
+                if entry[2] == task_id:
+                    return i + 1
+        return None
+
+    def stats(self):
+        with self._cond:
+            return {"queued": len(self._heap) + len(self._delayed), "running": len(self._running)}
+
+    def heartbeat(self, owner, active, capacity):
+        # Jobs cannot outlive their owner here, so there is nothing to keep alive
+        pass
+
+    def workers(self):
+        return []
+
+    def put_setting(self, name, value):
+        with self._cond:
+            self._settings[name] = (value, time.time())
+
+    def get_setting(self, name, default=None):
+        with self._cond:
+            entry = self._settings.get(name)
+        return entry[0] if entry else default
+
+    def get_settings(self, prefix, max_age):
+        """Returns {name: value} for settings under `prefix` written within `max_age` seconds."""
+        cutoff = time.time() - max_age
+        with self._cond:
+            return {name: value for name, (value, updated) in self._settings.items()
+                    if name.startswith(prefix) and updated >= cutoff}
+
+    def recover(self):
+        """Nothing survives a restart of an in-process queue."""
+
+    def close(self):
+        pass
+
+
+class SQLiteJobQueue:
+    """Job queue in an SQLite table, shared by every process that opens the same file.
+
+    Claiming happens inside one IMMEDIATE transaction, so two processes never
+    take the same job. `max_running` (0 = no limit) caps the running jobs of
+    each node: the processes on the claiming host share it, and jobs running
+    on other hosts do not count against it.
+
+    A claimed job is leased to its owner for `lease_ttl` seconds and the
+    owner's scheduler keeps renewing the lease while it works on it. A job
+    whose lease ran out (its worker died or lost the database) goes back to
+    the queue at the next claim.
+    """
+
+    def __init__(self, path, max_running, poll_interval=0.5, lease_ttl=30):
+        self.path = path
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        db = self._db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' seq INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL UNIQUE,'
+            ' priority INTEGER NOT NULL, args TEXT NOT NULL, grp TEXT, grp_limit INTEGER,'
+            " state TEXT NOT NULL DEFAULT 'queued', owner TEXT, claimed_at REAL, lease_until REAL, not_before REAL)"
+        )
+        columns = {row[1] for row in db.execute('PRAGMA table_info(jobs)')}
+        # Queue files written before leases and retries existed
+        for column in ('lease_until', 'not_before'):
+            if column not in columns:
+                db.execute(f'ALTER TABLE jobs ADD COLUMN {column} REAL')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, seq)')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_group ON jobs (grp, state)')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner)')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS workers ('
+            ' owner TEXT PRIMARY KEY, active INTEGER NOT NULL, capacity INTEGER NOT NULL, last_seen REAL NOT NULL)'
+        )
+        # Small shared key/value records, e.g. runtime limits every process should apply
+        db.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def _db(self):
+        # sqlite3 connections must not be shared between threads, so each thread gets its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def put(self, task_id, args, priority, group=None, group_limit=None):
+        self._db().execute(
+            'INSERT OR IGNORE INTO jobs (task_id, priority, args, grp, grp_limit) VALUES (?, ?, ?, ?, ?)',
+            (task_id, priority, json.dumps(args), group, group_limit),
+        )
+
+    def claim(self, owner, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim_once(owner)
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def _claim_once(self, owner):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._reap_expired(db)
+            if self.max_running:
+                prefix = node_of(owner) + ':'
+                running = db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running' AND substr(owner, 1, ?) = ?",
+                                     (len(prefix), prefix)).fetchone()[0]
+                if running >= self.max_running:
+                    return None
+            row = db.execute(
+                "SELECT task_id, args FROM jobs j WHERE state = 'queued' AND COALESCE(not_before, 0) <= ? AND (grp IS NULL OR"
+                " (SELECT COUNT(*) FROM jobs r WHERE r.grp = j.grp AND r.state = 'running') < COALESCE(j.grp_limit, 1))"
+                ' ORDER BY priority, seq LIMIT 1', (time.time(),)
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            db.execute("UPDATE jobs SET state = 'running', owner = ?, claimed_at = ?, lease_until = ? WHERE task_id = ?",
+                       (owner, now, now + self.lease_ttl, row[0]))
+        return row[0], tuple(json.loads(row[1]))
+
+    def _reap_expired(self, db):
+        # Jobs whose owner stopped renewing the lease are claimable again; NULL leases predate leasing
+        db.execute("UPDATE jobs SET state = 'queued', owner = NULL, lease_until = NULL"
+                   " WHERE state != 'queued' AND COALESCE(lease_until, 0) < ?", (time.time(),))
+
+    def done(self, task_id):
+        """Removes a job for good once its task has finished or failed."""
+        self._db().execute('DELETE FROM jobs WHERE task_id = ?', (task_id,))
+
+    def handoff(self, task_id, owner):
+        """Frees the job's download slot while its task is post-processed; the row stays until done()."""
+        self._db().execute("UPDATE jobs SET state = 'postprocess' WHERE task_id = ? AND state = 'running' AND owner = ?",
+                           (task_id, owner))
+
+    def release(self, task_id):
+        """Puts a claimed job back in the queue, keeping its place."""
+        self._db().execute("UPDATE jobs SET state = 'queued', owner = NULL, lease_until = NULL WHERE task_id = ?",
+                           (task_id,))
+
+    def retry(self, task_id, delay):
+        """Puts a claimed job back in the queue, keeping its place, runnable again after `delay` seconds."""
+        self._db().execute("UPDATE jobs SET state = 'queued', owner = NULL, lease_until = NULL, not_before = ?"
+                           ' WHERE task_id = ?', (time.time() + delay, task_id))
+
+    def heartbeat(self, owner, active, capacity):
+        """Renews the leases of every job `owner` holds and records the worker as alive."""
+        now = time.time()
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute("UPDATE jobs SET lease_until = ? WHERE owner = ? AND state != 'queued'",
+                       (now + self.lease_ttl, owner))
+            db.execute('INSERT OR REPLACE INTO workers (owner, active, capacity, last_seen) VALUES (?, ?, ?, ?)',
+                       (owner, active, capacity, now))
+            db.execute('DELETE FROM workers WHERE last_seen < ?', (now - 10 * self.lease_ttl,))
+
+    def workers(self):
+        """Workers that heartbeated within the lease period."""
+        rows = self._db().execute(
+            'SELECT owner, active, capacity, last_seen FROM workers WHERE last_seen >= ? ORDER BY owner',
+            (time.time() - self.lease_ttl,),
+        ).fetchall()
+        return [{"owner": o, "active": a, "capacity": c, "last_seen": ls} for o, a, c, ls in rows]
+
+    def put_setting(self, name, value):
+        self._db().execute('INSERT OR REPLACE INTO settings (name, value, updated) VALUES (?, ?, ?)',
+                           (name, json.dumps(value), time.time()))
+
+    def get_setting(self, name, default=None):
+        row = self._db().execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_settings(self, prefix, max_age):
+        """Returns {name: value} for settings under `prefix` written within `max_age` seconds; drops older ones."""
+        cutoff = time.time() - max_age
+        db = self._db()
+        db.execute('DELETE FROM settings WHERE substr(name, 1, ?) = ? AND updated < ?', (len(prefix), prefix, cutoff))
+        rows = db.execute('SELECT name, value FROM settings WHERE substr(name, 1, ?) = ?', (len(prefix), prefix))
+        return {name: json.loads(value) for name, value in rows}
+
+    def waiting_priority(self):
+        row = self._db().execute(
+            "SELECT MIN(priority) FROM jobs j WHERE state = 'queued' AND COALESCE(not_before, 0) <= ? AND (grp IS NULL OR"
+            " (SELECT COUNT(*) FROM jobs r WHERE r.grp = j.grp AND r.state = 'running') < COALESCE(j.grp_limit, 1))",
+            (time.time(),),
+        ).fetchone()
+        return row[0]
+
+    def position(self, task_id):
+        row = self._db().execute(
+            "SELECT COUNT(*) FROM jobs q, (SELECT priority, seq FROM jobs WHERE task_id = ? AND state = 'queued') t"
+            " WHERE q.state = 'queued' AND (q.priority < t.priority OR (q.priority = t.priority AND q.seq <= t.seq))",
+            (task_id,),
+        ).fetchone()
+        return row[0] or None
+
+    def stats(self):
+        counts = dict(self._db().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return {"queued": counts.get('queued', 0), "running": counts.get('running', 0)}
+
+    def recover(self):
+        """Requeues jobs whose lease has run out. Safe at any time; claim() does the same."""
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            self._reap_expired(db)
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class RedisJobQueue:
+    """Job queue in Redis (or any server speaking its protocol) for workers on several hosts.
+
+    Same semantics as SQLiteJobQueue: a job is a hash, the queue a sorted set
+    ordered by priority then submission, and leases and retry delays sorted
+    sets of expiry times. Running jobs are also kept in a set per node, for
+    the `max_running` cap. Claims are serialised by a short-lived lock key, which keeps the
+    commands plain enough for Redis stand-ins without Lua.
+    """
+
+    LOCK_TTL_MS = 10000
+
+    def __init__(self, url, max_running, poll_interval=0.5, lease_ttl=30, prefix='ytdl'):
+        import redis  # Only needed for TASK_STORE=redis
+        self._redis = redis
+        self.r = redis.Redis.from_url(url, decode_responses=True)
+        self.max_running = max_running
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self.prefix = prefix
+        self._token = f'{socket.gethostname()}:{os.getpid()}:{id(self)}'
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix, 'jobs') + parts)
+
+    def _score(self, job):
+        return int(job['priority']) * 1e12 + int(job['seq'])
+
+    def put(self, task_id, args, priority, group=None, group_limit=None):
+        job_key = self._key('job', task_id)
+        if not self.r.hsetnx(job_key, 'args', json.dumps(args)):
+            return
+        job = {'priority': priority, 'seq': self.r.incr(self._key('seq')), 'grp': group or '',
+               'grp_limit': group_limit or 0, 'state': 'queued', 'owner': ''}
+        with self.r.pipeline() as pipe:
+            pipe.hset(job_key, mapping=job)
+            pipe.zadd(self._key('queued'), {task_id: self._score(job)})
+            pipe.execute()
+
+    def claim(self, owner, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim_once(owner)
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def _claim_once(self, owner):
+        if not self._lock():
+            return None
+        try:
+            self._reap_expired()
+            self._promote_delayed()
+            if self.max_running and self.r.scard(self._key('node', node_of(owner))) >= self.max_running:
+                return None
+            start = 0
+            while True:
+                # Walk the queue in pages; jobs of groups at their limit are skipped over
+                page = self.r.zrange(self._key('queued'), start, start + 99)
+                if not page:
+                    return None
+                for task_id in page:
+                    job = self.r.hgetall(self._key('job', task_id))
+                    if not job:
+                        self.r.zrem(self._key('queued'), task_id)
+                        continue
+                    group = job['grp']
+                    if group and self.r.scard(self._key('group', group)) >= (int(job['grp_limit']) or 1):
+                        continue
+                    with self.r.pipeline() as pipe:
+                        pipe.zrem(self._key('queued'), task_id)
+                        pipe.hset(self._key('job', task_id), mapping={'state': 'running', 'owner': owner})
+                        pipe.zadd(self._key('leases'), {task_id: time.time() + self.lease_ttl})
+                        pipe.sadd(self._key('owner', owner), task_id)
+                        pipe.sadd(self._key('running'), task_id)
+                        pipe.sadd(self._key('node', node_of(owner)), task_id)
+                        if group:
+                            pipe.sadd(self._key('group', group), task_id)
+                        pipe.execute()
+                    return task_id, tuple(json.loads(job['args']))
+                start += len(page)
+        finally:
+            self._unlock()
+
+    def _lock(self):
+        return bool(self.r.set(self._key('lock'), self._token, nx=True, px=self.LOCK_TTL_MS))
+
+    def _unlock(self):
+        with self.r.pipeline() as pipe:
+            try:
+                pipe.watch(self._key('lock'))
+                if pipe.get(self._key('lock')) == self._token:
+                    pipe.multi()
+                    pipe.delete(self._key('lock'))
+                    pipe.execute()
+            except self._redis.WatchError:
+                pass
+
+    def _reap_expired(self):
+        # Called with the claim lock held
+        for task_id in self.r.zrangebyscore(self._key('leases'), '-inf', time.time()):
+            self._requeue(task_id)
+
+    def _promote_delayed(self):
+        # Called with the claim lock held; retried jobs whose delay is over rejoin the queue
+        for task_id in self.r.zrangebyscore(self._key('delayed'), '-inf', time.time()):
+            job = self.r.hgetall(self._key('job', task_id))
+            with self.r.pipeline() as pipe:
+                pipe.zrem(self._key('delayed'), task_id)
+                if job:
+                    pipe.zadd(self._key('queued'), {task_id: self._score(job)})
+                pipe.execute()
+
+    def _requeue(self, task_id):
+        job = self.r.hgetall(self._key('job', task_id))
+        with self.r.pipeline() as pipe:
+            self._unclaim(pipe, task_id, job)
+            if job:
+                pipe.hset(self._key('job', task_id), mapping={'state': 'queued', 'owner': ''})
+                pipe.zadd(self._key('queued'), {task_id: self._score(job)})
+            pipe.execute()
+
+    def _unclaim(self, pipe, task_id, job):
+        pipe.zrem(self._key('leases'), task_id)
+        pipe.srem(self._key('running'), task_id)
+        if job.get('owner'):
+            pipe.srem(self._key('owner', job['owner']), task_id)
+            pipe.srem(self._key('node', node_of(job['owner'])), task_id)
+        if job.get('grp'):
+            pipe.srem(self._key('group', job['grp']), task_id)
+
+    def done(self, task_id):
+        """Removes a job for good once its task has finished or failed."""
+        job = self.r.hgetall(self._key('job', task_id))
+        with self.r.pipeline() as pipe:
+            self._unclaim(pipe, task_id, job)
+            pipe.zrem(self._key('queued'), task_id)
+            pipe.zrem(self._key('delayed'), task_id)
+            pipe.delete(self._key('job', task_id))
+            pipe.execute()
+
+    def handoff(self, task_id, owner):
+        """Frees the job's download slot while its task is post-processed; the lease stays with the owner."""
+        job = self.r.hgetall(self._key('job', task_id))
+        if job.get('state') != 'running' or job.get('owner') != owner:
+            return
+        with self.r.pipeline() as pipe:
+            pipe.hset(self._key('job', task_id), 'state', 'postprocess')
+            pipe.srem(self._key('running'), task_id)
+            pipe.srem(self._key('node', node_of(owner)), task_id)
+            if job['grp']:
+                pipe.srem(self._key('group', job['grp']), task_id)
+            pipe.execute()
+
+    def release(self, task_id):
+        """Puts a claimed job back in the queue, keeping its place."""
+        self._requeue(task_id)
+
+    def retry(self, task_id, delay):
+        """Puts a claimed job back in the queue, keeping its place, runnable again after `delay` seconds."""
+        job = self.r.hgetall(self._key('job', task_id))
+        if not job:
+            return
+        with self.r.pipeline() as pipe:
+            self._unclaim(pipe, task_id, job)
+            pipe.hset(self._key('job', task_id), mapping={'state': 'queued', 'owner': ''})
+            pipe.zadd(self._key('delayed'), {task_id: time.time() + delay})
+            pipe.execute()
+
+    def heartbeat(self, owner, active, capacity):
+        """Renews the leases of every job `owner` holds and records the worker as alive."""
+        now = time.time()
+        held = self.r.smembers(self._key('owner', owner))
+        with self.r.pipeline() as pipe:
+            if held:
+                pipe.zadd(self._key('leases'), {task_id: now + self.lease_ttl for task_id in held}, xx=True)
+            pipe.hset(self._key('workers'), owner,
+                      json.dumps({"owner": owner, "active": active, "capacity": capacity, "last_seen": now}))
+            pipe.execute()
+
+    def workers(self):
+        """Workers that heartbeated within the lease period."""
+        now, alive, stale = time.time(), [], []
+        for owner, record in sorted(self.r.hgetall(self._key('workers')).items()):
+            record = json.loads(record)
+            if record['last_seen'] >= now - self.lease_ttl:
+                alive.append(record)
+            elif record['last_seen'] < now - 10 * self.lease_ttl:
+                stale.append(owner)
+        if stale:
+            self.r.hdel(self._key('workers'), *stale)
+        return alive
+
+    def put_setting(self, name, value):
+        self.r.hset(self._key('settings'), name, json.dumps({"value": value, "updated": time.time()}))
+
+    def get_setting(self, name, default=None):
+        entry = self.r.hget(self._key('settings'), name)
+        return json.loads(entry)['value'] if entry else default
+
+    def get_settings(self, prefix, max_age):
+        """Returns {name: value} for settings under `prefix` written within `max_age` seconds; drops older ones."""
+        cutoff, fresh, stale = time.time() - max_age, {}, []
+        for name, entry in self.r.hgetall(self._key('settings')).items():
+            if name.startswith(prefix):
+                entry = json.loads(entry)
+                if entry['updated'] >= cutoff:
+                    fresh[name] = entry['value']
+                else:
+                    stale.append(name)
+        if stale:
+            self.r.hdel(self._key('settings'), *stale)
+        return fresh
+
+    def waiting_priority(self):
+        # Looks at the head of the queue only; a long run of jobs from full groups hides what is behind it
+        for task_id in self.r.zrange(self._key('queued'), 0, 99):
+            job = self.r.hgetall(self._key('job', task_id))
+            if job and (not job['grp'] or self.r.scard(self._key('group', job['grp']))
+                        < (int(job['grp_limit']) or 1)):
+                return int(job['priority'])
+        return None
+
+    def position(self, task_id):
+        rank = self.r.zrank(self._key('queued'), task_id)
+        return None if rank is None else rank + 1
+
+    def stats(self):
+        return {"queued": self.r.zcard(self._key('queued')) + self.r.zcard(self._key('delayed')),
+                "running": self.r.scard(self._key('running'))}
+
+    def recover(self):
+        """Requeues jobs whose lease has run out. Safe at any time; claim() does the same."""
+        if self._lock():
+            try:
+                self._reap_expired()
+            finally:
+                self._unlock()
+
+    def close(self):
+        self.r.close()
+
+
+def create_job_queue(kind, path, max_running, redis_url=None, lease_ttl=30):
+    """Builds the job queue matching the TASK_STORE setting."""
+    if kind == 'shared':
+        return SQLiteJobQueue(path, max_running, lease_ttl=lease_ttl)
+    if kind == 'redis':
+        return RedisJobQueue(redis_url, max_running, lease_ttl=lease_ttl)
+    return LocalJobQueue()
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import re
+import threading
+import time
+
+VIDEO_EXTENSIONS = {'.mp4', '.mkv', '.avi', '.mov', '.webm'}
+AUDIO_EXTENSIONS = {'.mp3', '.m4a', '.wav', '.flac', '.ogg', '.opus'}
+
+SORT_KEYS = {
+    'modified': lambda e: e['modified'],
+    'name': lambda e: e['name'].lower(),
+    'size': lambda e: e['size_bytes'],
+}
+
+# Intermediate files written while a download is running; they are not part of the library
+_PARTIAL = re.compile(r'(\.part|\.ytdl|\.part-Frag\d+)$| \[[0-9a-f]{12}\]\.(tmp|f[\w-]+)\.\w+$')
+
+
+def is_partial(filename):
+    return bool(_PARTIAL.search(filename))
+
+
+def _entry_hash(entry):
+    # Stable across processes (unlike hash()), so every API worker derives the same fingerprint
+    key = f"{entry['name']}\0{entry['size_bytes']}\0{entry['modified']}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+
+def file_type(extension):
+    if extension in VIDEO_EXTENSIONS:
+        return 'video'
+    if extension in AUDIO_EXTENSIONS:
+        return 'audio'
+    return 'other'
+
+
+class FileLibrary:
+    """In-memory index of the finished downloads in a file store (see file_store.py).
+
+    The download pipeline reports new and deleted files directly; a watcher
+    thread rescans the store when its version changes (the folder's mtime for
+    local storage; every interval for stores that cannot tell) to pick up
+    anything done behind our back. Sorted views are cached until the index changes.
+
+    `fingerprint` is an order-independent hash of the indexed files, updated
+    incrementally; two processes indexing the same store agree on it, which
+    makes it usable as an ETag.
+    """
+
+    def __init__(self, store, format_size, scan_interval=5.0):
+        self.store = store
+        self.format_size = format_size
+        self.scan_interval = scan_interval
+        self.generation = 0
+        self.fingerprint = 0
+        self._entries = {}
+        self._sorted = {}
+        self._version = None
+        self._lock = threading.Lock()
+        self.rescan()
+        if scan_interval > 0:
+            threading.Thread(target=self._watch, name='library-watcher', daemon=True).start()
+
+    # --- UPDATES ---
+    def add(self, filename):
+        """Indexes (or re-indexes) a single file. Returns False if it does not exist."""
+        entry = self._stat(filename)
+        with self._lock:
+            if entry is None:
+                return self._remove_locked(filename)
+            self._put_locked(entry)
+            self._changed()
+        return True
+
+    def remove(self, filename):
+        with self._lock:
+            return self._remove_locked(filename)
+
+    def rescan(self):
+        """Syncs the index with the store, statting only files it has not seen before."""
+        try:
+            self._version = self.store.version()
+        except FileNotFoundError:
+            self._version = None
+        names = set(self.store.names())
+        with self._lock:
+            known = set(self._entries)
+        added = {}
+        for name in names - known:
+            entry = self._stat(name)
+            if entry is not None:
+                added[name] = entry
+        removed = known - names
+        if added or removed:
+            with self._lock:
+                for entry in added.values():
+                    self._put_locked(entry)
+                for name in removed:
+                    self._remove_locked(name)
+                self._changed()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.scan_interval)
+            try:
+                version = self.store.version()
+                if version is None or version != self._version:
+                    self.rescan()
+            except Exception as e:
+                print(f"Library scan failed: {e}")
+
+    def _stat(self, filename):
+        if is_partial(filename):
+            return None
+        found = self.store.stat(filename)
+        if found is None:
+            return None
+        size, modified = found
+        extension = os.path.splitext(filename)[1].lower()
+        return {
+            "name": filename,
+            "size": self.format_size(size),
+            "size_bytes": size,
+            "modified": modified,
+            "extension": extension,
+            "type": file_type(extension),
+        }
+
+    def _put_locked(self, entry):
+        old = self._entries.get(entry['name'])
+        if old is not None:
+            self.fingerprint ^= _entry_hash(old)
+        self._entries[entry['name']] = entry
+        self.fingerprint ^= _entry_hash(entry)
+
+    def _remove_locked(self, filename):
+        old = self._entries.pop(filename, None)
+        if old is None:
+            return False
+        self.fingerprint ^= _entry_hash(old)
+        self._changed()
+        return True
+
+    def _changed(self):
+        # Called with the lock held
+        self.generation += 1
+        self._sorted.clear()
+
+    # --- QUERIES ---
+    def get(self, filename):
+        with self._lock:
+            return self._entries.get(filename)
+
+    def names(self):
+        with self._lock:
+            return list(self._entries)
+
+    def query(self, sort='modified', descending=True, extensions=None, types=None, prefix=None,
+              offset=0, limit=None):
+        """Returns (page, total, generation) for a filtered, sorted slice of the library."""
+        with self._lock:
+            view = self._sorted.get((sort, descending))
+            if view is None:
+                view = sorted(self._entries.values(), key=SORT_KEYS[sort], reverse=descending)
+                self._sorted[(sort, descending)] = view
+            generation = self.generation
+
+        if extensions or types or prefix:
+            prefix = prefix.lower() if prefix else None
+            view = [e for e in view
+                    if (not extensions or e['extension'] in extensions)
+                    and (not types or e['type'] in types)
+                    and (not prefix or e['name'].lower().startswith(prefix))]
+        end = offset + limit if limit else None
+        return view[offset:end], len(view), generation
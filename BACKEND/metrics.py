@@ -0,0 +1,198 @@
+import bisect
+import functools
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the default histogram buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# 64 KiB/s to 128 MiB/s, doubling
+RATE_BUCKETS = tuple(65536 * 2 ** i for i in range(12))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), value] for key, value in self._values.items()]
+        return {"type": self.kind, "help": self.help, "labels": list(self.label_names), "samples": samples}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """For counts kept elsewhere (e.g. the metadata cache's own counters), copied in at scrape time."""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Counts the block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, func):
+        """Decorator form of time()."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+
+class Registry:
+    """The metrics of one process. Updates are a lock and a dict write, cheap enough to leave on."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS, labels=()):
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def snapshot(self):
+        """JSON-serialisable state of every metric, for rendering or for handing to another process."""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots, extra_label='node'):
+    """Prometheus text format for {node: registry snapshot}; every series is labelled with its node."""
+    families = {}
+    for node, snapshot in snapshots.items():
+        for name, metric in snapshot.items():
+            families.setdefault(name, (metric, []))[1].append((node, metric))
+
+    lines = []
+    for name, (first, per_node) in sorted(families.items()):
+        lines.append(f"# HELP {name} {first['help']}")
+        lines.append(f"# TYPE {name} {first['type']}")
+        for node, metric in per_node:
+            for values, value in metric['samples']:
+                pairs = list(zip(metric['labels'], values))
+                if node is not None:
+                    pairs.append((extra_label, node))
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_labels(pairs)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric['buckets'] + [float('inf')], value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(pairs + [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(pairs)} {_number(value[-1])}")
+                lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+# yt-dlp error message -> category, first match wins
+_ERROR_CATEGORIES = [
+    ('unsupported', re.compile(r'Unsupported URL|is not a valid URL|No video formats found', re.I)),
+    ('unavailable', re.compile(r'Private video|Video unavailable|removed|Sign in to confirm|members-only|geo', re.I)),
+    ('http', re.compile(r'HTTP Error \d{3}', re.I)),
+    ('network', re.compile(r'timed out|Connection (refused|reset|aborted)|Name or service not known|'
+                           r'Temporary failure in name resolution|Network is unreachable|TransportError|'
+                           r'IncompleteRead|Did not get any data blocks|bytes read, \d+ more expected', re.I)),
+    ('disk', re.compile(r'No space left|Disk quota|Permission denied|Read-only file system', re.I)),
+]
+
+
+def error_category(message, default='download'):
+    """Buckets a failure message into a small, fixed set of categories for the error counter."""
+    for category, pattern in _ERROR_CATEGORIES:
+        if pattern.search(message or ''):
+            return category
+    return default
@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+# ffmpeg jobs are CPU-bound, so by default the pools of a node's API_WORKERS processes (one pool
+# each) split its cores between them
+POSTPROCESS_WORKERS = (int(os.environ.get('POSTPROCESS_WORKERS', '0'))
+                       or max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get('API_WORKERS', '1')))))
+# Threads per ffmpeg run (0 = ffmpeg decides, which is one per core for every job in the pool)
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', '0'))
+
+# Audio outputs, by the name /download takes as the audio quality. Only encoders built into
+# every ffmpeg, so no profile depends on the host's hardware. "copy" is the source codecs and
+# the lowest source bitrate (kbps) at which the stream is kept as it is instead of re-encoded
+AUDIO_PROFILES = {
+    'mp3-320': {"ext": 'mp3', "encode": ['-c:a', 'libmp3lame', '-b:a', '320k'], "copy": (('mp3',), 320)},
+    'mp3-128': {"ext": 'mp3', "encode": ['-c:a', 'libmp3lame', '-b:a', '128k'], "copy": (('mp3',), 128)},
+    'mp3-v0': {"ext": 'mp3', "encode": ['-c:a', 'libmp3lame', '-q:a', '0'], "copy": (('mp3',), 220)},
+    'mp3-v2': {"ext": 'mp3', "encode": ['-c:a', 'libmp3lame', '-q:a', '2'], "copy": (('mp3',), 170)},
+    'opus-128': {"ext": 'opus', "encode": ['-c:a', 'libopus', '-b:a', '128k'], "copy": (('opus',), 115)},
+    'opus-96': {"ext": 'opus', "encode": ['-c:a', 'libopus', '-b:a', '96k'], "copy": (('opus',), 85)},
+    'aac-256': {"ext": 'm4a', "encode": ['-c:a', 'aac', '-b:a', '256k'], "copy": (('mp4a', 'aac'), 230)},
+    'aac-128': {"ext": 'm4a', "encode": ['-c:a', 'aac', '-b:a', '128k'], "copy": (('mp4a', 'aac'), 115)},
+    # Whatever the source is, never re-encoded
+    'original': {"ext": None, "encode": None, "copy": ((), 0)},
+}
+# The audio qualities the frontend has always sent
+AUDIO_QUALITY_ALIASES = {'320k': 'mp3-320', '128k': 'mp3-128'}
+DEFAULT_AUDIO_PROFILE = 'mp3-128'
+# Container for a stream kept as it is, by codec; anything else goes in Matroska
+COPY_EXTENSIONS = (('mp4a', 'm4a'), ('aac', 'm4a'), ('opus', 'opus'), ('mp3', 'mp3'), ('vorbis', 'ogg'), ('flac', 'flac'))
+
+
+# How often a running ffmpeg checks whether its job was cancelled
+CANCEL_POLL_INTERVAL = 0.25
+
+
+class Cancelled(Exception):
+    """Raised by a job whose cancel marker appeared while it ran."""
+
+
+def cancel_marker(task_id):
+    """Path of the file whose existence tells a task's post-processing job to stop.
+
+    The jobs run in other processes, so a file is the simplest signal both sides can see.
+    """
+    return os.path.join(tempfile.gettempdir(), f'ytdl-cancel-{task_id}')
+
+
+def _run_ffmpeg(args, cancel_path=None):
+    if cancel_path and os.path.exists(cancel_path):
+        raise Cancelled()
+    # The thread count is an output option, so it goes just before the output path
+    threads = ['-threads', str(FFMPEG_THREADS)] if FFMPEG_THREADS else []
+    cmd = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error'] + args[:-1] + threads + args[-1:]
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+        while True:
+            try:
+                _, stderr = proc.communicate(timeout=CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_path and os.path.exists(cancel_path):
+                    proc.kill()
+                    proc.communicate()
+                    raise Cancelled()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.strip() or proc.returncode}")
+
+
+def audio_profile(quality):
+    """The AUDIO_PROFILES name an audio quality stands for; raises ValueError for unknown ones."""
+    profile = AUDIO_QUALITY_ALIASES.get(quality, quality) if quality else DEFAULT_AUDIO_PROFILE
+    if profile not in AUDIO_PROFILES:
+        raise ValueError(f"Unknown audio quality: {quality} (expected one of {', '.join(AUDIO_PROFILES)})")
+    return profile
+
+
+def can_copy_audio(profile, acodec, abr):
+    """Whether a source stream already satisfies a profile, so it can be kept without re-encoding."""
+    codecs, min_abr = AUDIO_PROFILES[profile]['copy']
+    if profile == 'original':
+        return True
+    return bool(acodec) and acodec.lower().startswith(codecs) and (abr or 0) >= min_abr
+
+
+def audio_extension(profile, acodec, copy):
+    """File extension of a profile's output."""
+    if not copy or AUDIO_PROFILES[profile]['ext']:
+        return AUDIO_PROFILES[profile]['ext']
+    acodec = (acodec or '').lower()
+    return next((ext for prefix, ext in COPY_EXTENSIONS if acodec.startswith(prefix)), 'mka')
+
+
+def _temp_path(output_path):
+    # Keeps the real extension last so ffmpeg still picks the right muxer
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.tmp{ext}"
+
+
+def _cleanup(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# --- JOBS (run inside the process pool) ---
+def merge_av(video_path, audio_path, output_path, cancel_path=None):
+    """Muxes a separate video and audio stream into one file without re-encoding."""
+    temp_path = _temp_path(output_path)
+    try:
+        _run_ffmpeg(['-i', video_path, '-i', audio_path, '-map', '0:v:0', '-map', '1:a:0',
+                     '-c', 'copy', '-movflags', '+faststart', temp_path], cancel_path)
+        os.replace(temp_path, output_path)
+    finally:
+        _cleanup([video_path, audio_path, temp_path])
+    return output_path
+
+
+def extract_audio(source_path, output_path, profile, copy, cancel_path=None):
+    """Writes the audio stream of a file to output_path, kept as it is (copy) or encoded per the profile."""
+    temp_path = _temp_path(output_path)
+    if copy:
+        codec = ['-c:a', 'copy'] + (['-movflags', '+faststart'] if output_path.endswith('.m4a') else [])
+    else:
+        codec = AUDIO_PROFILES[profile]['encode']
+    try:
+        _run_ffmpeg(['-i', source_path, '-vn', '-map', '0:a:0'] + codec + [temp_path], cancel_path)
+        os.replace(temp_path, output_path)
+    finally:
+        _cleanup([source_path, temp_path])
+    return output_path
+
+
+def finalize(source_path, output_path, cancel_path=None):
+    """Moves an already playable download into place when no ffmpeg work is needed."""
+    os.replace(source_path, output_path)
+    return output_path
+
+
+def store_output(store, job, *args, cancel_path=None):
+    """Runs a job, then hands its output to the file store (see file_store.py). Returns the stored name.
+
+    For a remote store this is where the file is uploaded, still inside the
+    pool, so the upload never holds up a download slot or an API thread.
+    """
+    output_path = job(*args, cancel_path=cancel_path)
+    name = os.path.basename(output_path)
+    if not store.remote:
+        return store.put(output_path, name)
+    try:
+        if cancel_path and os.path.exists(cancel_path):
+            raise Cancelled()
+        return store.put(output_path, name)
+    except BaseException:
+        # Nothing would ever serve the local copy
+        _cleanup([output_path])
+        raise
+
+
+# --- POOL ---
+_POOL = None
+
+
+def get_pool():
+    """Lazily creates the shared post-processing pool."""
+    global _POOL
+    if _POOL is None:
+        # 'spawn' keeps the children from inheriting the API's threads and locks
+        _POOL = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS,
+                                    mp_context=multiprocessing.get_context('spawn'))
+    return _POOL
+
+
+def shutdown_pool():
+    """Waits for queued ffmpeg jobs to finish and stops the pool."""
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=True)
+        _POOL = None
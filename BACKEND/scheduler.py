@@ -0,0 +1,160 @@
+import os
+import socket
+import threading
+import time
+import traceback
+
+# Lower number = served first. Tasks with equal priority are served FIFO.
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+
+class DownloadScheduler:
+    """Fixed-size worker pool pulling jobs from a job queue.
+
+    The queue decides what runs next (see job_queue.py); with a shared queue
+    several processes, on one host or many, can each run a scheduler against
+    the same jobs. While it has workers the scheduler heartbeats every
+    `heartbeat_interval` seconds, renewing the leases on the jobs it holds.
+    With `workers=0` it only submits jobs for others to run. While `admit()`
+    returns False (e.g. the disk is full) workers claim nothing, leaving the
+    jobs to other processes or for later. Nothing runs until start().
+    """
+
+    def __init__(self, workers, handler, queue, name='download', heartbeat_interval=10.0, admit=None):
+        self.workers = workers
+        self.handler = handler
+        self.admit = admit
+        self.queue = queue
+        self.name = name
+        self.heartbeat_interval = heartbeat_interval
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._active = set()
+        self._requeue = {}   # task id -> delay, for jobs handed back while their handler runs
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Starts the worker threads and the heartbeat; a second call does nothing."""
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f'{self.name}-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        if self.workers:
+            threading.Thread(target=self._heartbeat, name=f'{self.name}-heartbeat', daemon=True).start()
+
+    def submit(self, task_id, args, priority='normal', group=None, group_limit=None):
+        """Queues a job and returns its 1-based queue position."""
+        prio = PRIORITIES.get(priority, priority if isinstance(priority, int) else PRIORITIES['normal'])
+        self.queue.put(task_id, args, prio, group, group_limit)
+        return self.queue.position(task_id)
+
+    def position(self, task_id):
+        """Returns the 1-based queue position of a task, or None if it is not queued."""
+        return self.queue.position(task_id)
+
+    def done(self, task_id):
+        """Tells the queue a task has finished or failed for good."""
+        self.queue.done(task_id)
+
+    def retry(self, task_id, delay):
+        """Hands a job back to the queue to be claimed again after `delay` seconds.
+
+        Called from the job's own handler, the hand-back waits until the handler
+        returns, so the job cannot be claimed again while it is still running.
+        """
+        with self._lock:
+            if task_id in self._active:
+                self._requeue[task_id] = delay
+                return
+        self.queue.retry(task_id, delay)
+
+    def waiting_priority(self):
+        """Priority of the most urgent job waiting for a free slot, or None."""
+        return self.queue.waiting_priority()
+
+    def stats(self):
+        with self._lock:
+            active = len(self._active)
+        return dict(self.queue.stats(), active=active, workers=len(self._threads))
+
+    def drain(self, timeout, interrupt=None, stop_timeout=10):
+        """Stops taking new jobs and waits up to `timeout` seconds for running ones.
+
+        Jobs still running afterwards are stopped with `interrupt(task_id)`,
+        and their handlers hand them back to the queue (retry()) on the way
+        out, so another worker (or the next start) picks them up. A job is
+        never released while its handler runs, or two processes would write
+        the same files: one that does not stop within `stop_timeout` seconds
+        stays leased to this process until its lease runs out after exit.
+        Returns the task ids of the jobs that were still running at `timeout`.
+        """
+        self._stopping.set()
+        if self._wait_idle(timeout):
+            return []
+        with self._lock:
+            unfinished = list(self._active)
+        deadline = time.monotonic() + stop_timeout
+        while interrupt and time.monotonic() < deadline:
+            with self._lock:
+                running = list(self._active)
+            if not running:
+                break
+            # Again on every round: a job may not have been far enough along to take it the first time
+            for task_id in running:
+                interrupt(task_id)
+            time.sleep(0.2)
+        return unfinished
+
+    def _wait_idle(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._active:
+                    return True
+            time.sleep(0.2)
+        return False
+
+    def _heartbeat(self):
+        # Keeps running through drain(): jobs still in post-processing stay leased to us
+        while True:
+            with self._lock:
+                active = len(self._active)
+            try:
+                self.queue.heartbeat(self.owner, active, 0 if self._stopping.is_set() else len(self._threads))
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.heartbeat_interval)
+
+    def _worker(self):
+        while not self._stopping.is_set():
+            if self.admit and not self.admit():
+                time.sleep(1.0)
+                continue
+            try:
+                job = self.queue.claim(self.owner, 1.0)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(1.0)
+                continue
+            if job is None:
+                continue
+            task_id, args = job
+            with self._lock:
+                self._active.add(task_id)
+            try:
+                self.handler(*args)
+            except Exception:
+                # Never let one bad job take a worker down with it
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._active.discard(task_id)
+                    delay = self._requeue.pop(task_id, None)
+                if delay is not None:
+                    self.queue.retry(task_id, delay)
+                else:
+                    # Frees the download slot; the job itself stays until its task settles
+                    self.queue.handoff(task_id, self.owner)
@@ -0,0 +1,245 @@
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+
+from library import is_partial
+
+POLICIES = ('lru', 'age', 'off')
+PINS_SETTING = 'storage-pins'
+EVICTIONS_SETTING = 'storage-evictions'
+# Last-access times closer together than this are not written back to the file
+TOUCH_INTERVAL = 60
+# Evictions listed in the stats
+RECENT_EVICTIONS = 20
+
+
+class StorageManager:
+    """Keeps the downloads folder under its quota by deleting finished files.
+
+    Usage counts every file in the folder, partial downloads included; the
+    limit is `quota` bytes, never more than the disk can actually hold. Once
+    usage passes the high watermark, files are deleted until it is back under
+    the low one: least recently accessed first ('lru') or oldest first
+    ('age'). A file's last access is its atime, set explicitly by touch() on
+    every download, so it works on noatime mounts and every process sharing
+    the folder sees it.
+
+    Without a quota nothing is ever deleted: the folder shares its disk with
+    whatever else is on it, so the watermarks would measure other people's
+    files. Downloads are then only held back while the disk has no room for
+    them.
+
+    Partial files, files `is_protected(name)` claims (those of running tasks)
+    and pinned files are never deleted. Pins and the eviction counts live in
+    the job queue's settings, like the bandwidth limits, so every process
+    shares them. A queue that keeps its settings in memory would forget the
+    pins on restart; with `pins_path` they are kept in that JSON file instead.
+    """
+
+    def __init__(self, folder, queue, quota, high, low, policy, is_protected, on_evict=None, interval=10.0,
+                 pins_path=None):
+        if not 0 < low <= high <= 1:
+            raise ValueError("Storage watermarks must satisfy 0 < low <= high <= 1")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.folder = folder
+        self.queue = queue
+        self.quota = quota
+        self.high = high
+        self.low = low
+        self.policy = policy
+        self.is_protected = is_protected
+        self.on_evict = on_evict
+        self.interval = interval
+        self.pins_path = pins_path
+        self._reserved = {}   # task id -> (download key, bytes) for downloads admitted by this process
+        self._admitting = True
+        self._lock = threading.Lock()
+        self._pins_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='storage', daemon=True)
+            self._thread.start()
+
+    # --- ACCESS AND PINS ---
+    def touch(self, filename):
+        """Records a download of a file, for LRU eviction. Keeps its mtime."""
+        path = os.path.join(self.folder, filename)
+        try:
+            stat_info = os.stat(path)
+            if time.time() - stat_info.st_atime > TOUCH_INTERVAL:
+                os.utime(path, ns=(time.time_ns(), stat_info.st_mtime_ns))
+        except OSError:
+            pass
+
+    def pins(self):
+        if not self.pins_path:
+            return self.queue.get_setting(PINS_SETTING) or {}
+        try:
+            with open(self.pins_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            # Losing the pins would expose every pinned file to eviction, so don't pretend there are none
+            raise RuntimeError(f"Cannot read pins from {self.pins_path}: {e}") from e
+
+    def pin(self, filename):
+        with self._pins_lock:
+            pins = self.pins()
+            pins.setdefault(filename, time.time())
+            self._save_pins(pins)
+
+    def unpin(self, filename):
+        """Returns False if the file was not pinned."""
+        with self._pins_lock:
+            pins = self.pins()
+            if pins.pop(filename, None) is None:
+                return False
+            self._save_pins(pins)
+            return True
+
+    def _save_pins(self, pins):
+        if not self.pins_path:
+            self.queue.put_setting(PINS_SETTING, pins)
+            return
+        # Written aside and renamed, so a crash never leaves a torn file behind
+        os.makedirs(os.path.dirname(self.pins_path) or '.', exist_ok=True)
+        tmp_path = f'{self.pins_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(pins, f)
+        os.replace(tmp_path, self.pins_path)
+
+    # --- ADMISSION ---
+    def admitting(self):
+        """Whether new downloads may start here; refreshed by every check, so it is cheap to poll."""
+        return self._admitting
+
+    def reserve(self, task_id, key, size):
+        """Admits a download of about `size` bytes, evicting to make room if needed.
+
+        The reservation counts until release(), less what the download has
+        already written (files tagged with its key). Returns False if there is
+        no room even after eviction.
+        """
+        with self._lock:
+            files = self._scan()
+            if not self._make_room(files, self._pending(files) + (size or 0)):
+                return False
+            self._reserved[task_id] = (key, size or 0)
+            return True
+
+    def release(self, task_id):
+        with self._lock:
+            self._reserved.pop(task_id, None)
+
+    def check(self):
+        """Evicts if usage is past the high watermark and updates admission. Returns the usage."""
+        with self._lock:
+            files = self._scan()
+            self._make_room(files, self._pending(files))
+            return self._usage(files)
+
+    # --- STATS ---
+    def stats(self):
+        files = self._scan()
+        usage = self._usage(files)
+        pins = self.pins()
+        finished = [f for f in files if not f['partial']]
+        return dict(usage, quota=self.quota or None, policy=self.policy if self.quota else 'off',
+                    high_watermark=int(self.high * usage['limit']) if self.quota else None,
+                    low_watermark=int(self.low * usage['limit']) if self.quota else None,
+                    files=len(finished), partial_bytes=sum(f['size'] for f in files if f['partial']),
+                    pinned=len(pins), pinned_bytes=sum(f['size'] for f in finished if f['name'] in pins),
+                    reserved=self._pending(files), admitting=self._admitting,
+                    evictions=self.queue.get_setting(EVICTIONS_SETTING) or {"files": 0, "bytes": 0, "recent": []})
+
+    # --- EVICTION ---
+    def _loop(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.interval)
+
+    def _scan(self):
+        files = []
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat_info = entry.stat()
+                    except OSError:
+                        continue
+                    files.append({"name": entry.name, "size": stat_info.st_size, "partial": is_partial(entry.name),
+                                  "modified": stat_info.st_mtime,
+                                  # Finishing a download counts as an access
+                                  "accessed": max(stat_info.st_atime, stat_info.st_mtime)})
+        except FileNotFoundError:
+            pass
+        return files
+
+    def _usage(self, files):
+        disk = shutil.disk_usage(self.folder)
+        if not self.quota:
+            return {"limit": disk.total, "used": disk.used, "free": disk.free}
+        used = sum(f['size'] for f in files)
+        # The filesystem may fill up before the quota does
+        limit = min(self.quota, used + disk.free)
+        return {"limit": limit, "used": used, "free": max(0, limit - used)}
+
+    def _pending(self, files):
+        # Reserved bytes not written yet
+        total = 0
+        for key, size in self._reserved.values():
+            written = sum(f['size'] for f in files if f' [{key}].' in f['name'])
+            total += max(0, size - written)
+        return total
+
+    def _make_room(self, files, extra):
+        """Evicts until `extra` more bytes fit under the high watermark, going down to the low one."""
+        usage = self._usage(files)
+        if not self.quota:
+            self._admitting = extra <= usage['free']
+            return self._admitting
+        limit, used = usage['limit'], usage['used']
+        if used + extra > self.high * limit and self.policy != 'off':
+            used -= self._evict(files, used + extra - min(self.low * limit, self.high * limit - extra))
+        self._admitting = used + extra <= self.high * limit
+        return self._admitting
+
+    def _evict(self, files, needed):
+        pins = self.pins()
+        candidates = [f for f in files if not f['partial'] and f['name'] not in pins and not self.is_protected(f['name'])]
+        candidates.sort(key=lambda f: f['accessed'] if self.policy == 'lru' else f['modified'])
+        freed, evicted = 0, []
+        for f in candidates:
+            if freed >= needed:
+                break
+            try:
+                os.remove(os.path.join(self.folder, f['name']))
+            except FileNotFoundError:
+                # Deleted by someone else in the meantime; its space is free all the same
+                pass
+            except OSError as e:
+                print(f"Evicting {f['name']} failed: {e}", flush=True)
+                continue
+            freed += f['size']
+            evicted.append({"name": f['name'], "size": f['size'], "at": time.time()})
+            if self.on_evict:
+                self.on_evict(f['name'], f['size'])
+        if evicted:
+            print(f"Evicted {len(evicted)} files ({freed} bytes) from {self.folder}", flush=True)
+            totals = self.queue.get_setting(EVICTIONS_SETTING) or {"files": 0, "bytes": 0, "recent": []}
+            self.queue.put_setting(EVICTIONS_SETTING, {
+                "files": totals['files'] + len(evicted), "bytes": totals['bytes'] + freed,
+                "last_run": time.time(), "recent": (evicted[::-1] + totals['recent'])[:RECENT_EVICTIONS]})
+        return freed
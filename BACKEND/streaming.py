@@ -0,0 +1,130 @@
+# GET /stream: the selected formats go through ffmpeg straight into the HTTP response,
+# without landing in the downloads folder first.
+#
+# ffmpeg fetches plain HTTP and HLS formats itself, with range requests, so a progressive
+# mp4 whose index sits at the end still works. Anything else (DASH fragments, site-specific
+# protocols) is fetched by a yt-dlp subprocess writing to a pipe ffmpeg reads. The output
+# is a container that can be written front to back: fragmented mp4, mp3, ogg or Matroska.
+# Nothing reads ahead of the client: while the response blocks, ffmpeg's stdout fills up,
+# ffmpeg stops reading and the fetches stall.
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import postprocess
+
+CHUNK = 64 * 1024
+FFMPEG_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+# Output extension -> (ffmpeg muxer, content type)
+CONTAINERS = {
+    'mp4': ('mp4', 'video/mp4'),
+    'm4a': ('mp4', 'audio/mp4'),
+    'mp3': ('mp3', 'audio/mpeg'),
+    'opus': ('ogg', 'audio/ogg'),
+    'ogg': ('ogg', 'audio/ogg'),
+    'flac': ('flac', 'audio/flac'),
+    'mka': ('matroska', 'audio/x-matroska'),
+}
+# mp4 without seeking back: an empty index up front and one fragment per keyframe
+FRAGMENTED_MP4 = ['-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+
+class StreamError(Exception):
+    """The pipeline failed before producing any output."""
+
+
+def plan(type_mode, quality, rows):
+    """Output extension and ffmpeg codec arguments for the chosen formats (rows of formats.format_table)."""
+    if type_mode == 'audio':
+        profile = postprocess.audio_profile(quality)
+        copy = postprocess.can_copy_audio(profile, rows[0]['acodec'], rows[0]['abr'])
+        codec = ['-c:a', 'copy'] if copy else postprocess.AUDIO_PROFILES[profile]['encode']
+        return postprocess.audio_extension(profile, rows[0]['acodec'], copy), ['-vn', '-map', '0:a:0'] + codec
+    if len(rows) > 1:
+        return 'mp4', ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy']
+    return 'mp4', ['-c', 'copy']
+
+
+class Pipeline:
+    """ffmpeg writing the given formats of an info dict to its stdout, plus the yt-dlp processes feeding it."""
+
+    def __init__(self, info, format_ids, ext, codec_args):
+        self.feeders = []
+        self._info_path = None
+        self._fds = []
+        formats = {f.get('format_id'): f for f in info.get('formats') or []}
+        inputs = []
+        try:
+            for format_id in format_ids:
+                f = formats[format_id]
+                if f.get('protocol') in FFMPEG_PROTOCOLS:
+                    headers = ''.join(f'{k}: {v}\r\n' for k, v in (f.get('http_headers') or {}).items())
+                    inputs += (['-headers', headers] if headers else []) + ['-i', f['url']]
+                else:
+                    inputs += ['-i', f'pipe:{self._feed(info, format_id)}']
+            muxer = CONTAINERS[ext][0]
+            threads = ['-threads', str(postprocess.FFMPEG_THREADS)] if postprocess.FFMPEG_THREADS else []
+            cmd = (['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin'] + inputs + codec_args + threads
+                   + ['-f', muxer] + (FRAGMENTED_MP4 if muxer == 'mp4' else []) + ['pipe:1'])
+            self.ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=self._fds)
+        except Exception:
+            self.close()
+            raise
+        finally:
+            # ffmpeg holds its own copies now
+            for fd in self._fds:
+                os.close(fd)
+            self._fds = []
+
+    def _feed(self, info, format_id):
+        """Starts yt-dlp downloading one format to a pipe. Returns the pipe's read end."""
+        if self._info_path is None:
+            # The cached metadata, so yt-dlp does not extract the video again
+            fd, self._info_path = tempfile.mkstemp(prefix='ytdl-stream-', suffix='.info.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(info, f)
+        read_fd, write_fd = os.pipe()
+        self._fds.append(read_fd)
+        try:
+            self.feeders.append(subprocess.Popen(
+                [sys.executable, '-m', 'yt_dlp', '--quiet', '--no-warnings', '--no-progress',
+                 '--load-info-json', self._info_path, '-f', format_id, '-o', '-'],
+                stdout=write_fd, stdin=subprocess.DEVNULL))
+        finally:
+            os.close(write_fd)
+        return read_fd
+
+    def chunks(self):
+        """The output as it comes. Raises StreamError if ffmpeg fails before writing anything."""
+        sent = False
+        try:
+            while True:
+                data = self.ffmpeg.stdout.read1(CHUNK)
+                if not data:
+                    break
+                sent = True
+                yield data
+            if self.ffmpeg.wait() != 0:
+                message = self.ffmpeg.stderr.read().decode(errors='replace').strip() or f"exit {self.ffmpeg.returncode}"
+                # Once bytes are out the status line is gone too; the client only sees the body stop short
+                raise StreamError(message) if not sent else RuntimeError(f"Stream cut short: {message}")
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops every process of the pipeline; safe to call more than once."""
+        for proc in self.feeders + ([self.ffmpeg] if getattr(self, 'ffmpeg', None) else []):
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        if getattr(self, 'ffmpeg', None):
+            self.ffmpeg.stdout.close()
+            self.ffmpeg.stderr.close()
+        if self._info_path:
+            try:
+                os.remove(self._info_path)
+            except OSError:
+                pass
+            self._info_path = None
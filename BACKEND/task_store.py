@@ -0,0 +1,713 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Stages after which a task will never change again
+TERMINAL_STAGES = ('done', 'error', 'cancelled')
+
+
+def is_terminal(status):
+    return status.get('stage') in TERMINAL_STAGES
+
+
+class MemoryTaskStore:
+    """Keeps task status in a dict. Finished tasks expire after `retention` seconds."""
+
+    def __init__(self, retention):
+        self.retention = retention
+        self._tasks = {}
+        self._jobs = {}
+        self._finished_at = {}
+        self._versions = {}
+        self._version = 0
+        self._active_keys = {}
+        self._last_purge = time.time()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    # --- READS ---
+    def get(self, task_id, default=None):
+        with self._lock:
+            return self._snapshot(task_id, default)
+
+    def get_many(self, task_ids, since_version=0):
+        """Returns {task_id: status} for the given tasks whose version is above `since_version`."""
+        with self._lock:
+            return {tid: self._snapshot(tid) for tid in task_ids
+                    if tid in self._tasks and self._versions.get(tid, 0) > since_version}
+
+    def current_version(self):
+        with self._lock:
+            return self._version
+
+    def wait_for_change(self, task_id, since_version, timeout):
+        """Blocks until the task's version passes `since_version` or the timeout runs out.
+
+        Returns (status, version); status is None if the task does not exist.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._versions.get(task_id, 0) > since_version, timeout)
+            return self._snapshot(task_id), self._versions.get(task_id, 0)
+
+    def job(self, task_id):
+        with self._lock:
+            return self._jobs.get(task_id)
+
+    def active_task_for_key(self, key):
+        """Returns the unfinished task holding this dedup key, if any."""
+        with self._lock:
+            return self._active_keys.get(key)
+
+    def unfinished(self):
+        """Returns (task_id, job) for every task that had not finished, oldest first."""
+        with self._lock:
+            return [(tid, self._jobs.get(tid)) for tid, status in self._tasks.items()
+                    if not is_terminal(status)]
+
+    def _snapshot(self, task_id, default=None):
+        # Called with the lock held; every copy handed out carries the task's version
+        status = self._tasks.get(task_id)
+        if status is None:
+            return default
+        status = dict(status)
+        status['version'] = self._versions.get(task_id, 0)
+        return status
+
+    # --- WRITES ---
+    def create(self, task_id, status, job=None, exclusive=True):
+        """Registers a new task along with the job arguments needed to requeue it.
+
+        A job with a dedup key ("key") claims it: until the task ends, no other
+        task can hold the same key. Returns the id of the task holding the key,
+        which is task_id unless another unfinished task had it. In that case an
+        `exclusive` create does nothing; otherwise the task is created without
+        the key and can take it later with claim().
+        """
+        with self._lock:
+            key = (job or {}).get('key')
+            holder = self._active_keys.get(key) if key else None
+            if holder and exclusive:
+                return holder
+            self._tasks[task_id] = dict(status)
+            self._jobs[task_id] = job
+            self._finished_at.pop(task_id, None)
+            if key and not holder and not is_terminal(status):
+                self._active_keys[key] = task_id
+            self._changed(task_id)
+        # Expiry piggybacks on task creation, so an idle server does no background work
+        if time.time() - self._last_purge > 60:
+            self._last_purge = time.time()
+            self.purge_expired()
+        return holder or task_id
+
+    def claim(self, task_id):
+        """Takes the task's dedup key unless another unfinished task holds it. Returns the holder."""
+        with self._lock:
+            key = (self._jobs.get(task_id) or {}).get('key')
+            if not key:
+                return task_id
+            # Written to disk with the task's next change, which the caller is about to make
+            return self._active_keys.setdefault(key, task_id)
+
+    def set(self, task_id, status):
+        with self._lock:
+            self._tasks[task_id] = dict(status)
+            self._changed(task_id)
+
+    def set_job(self, task_id, job):
+        """Replaces the job of an existing task (a playlist download turning into a batch).
+
+        The task keeps its dedup key only if the new job has the same one.
+        """
+        with self._lock:
+            if (job or {}).get('key') != (self._jobs.get(task_id) or {}).get('key'):
+                self._forget_key(task_id)
+            self._jobs[task_id] = job
+            self._changed(task_id)
+
+    def update(self, task_id, fields):
+        with self._lock:
+            self._tasks.setdefault(task_id, {}).update(fields)
+            self._changed(task_id)
+
+    def delete(self, task_id):
+        with self._lock:
+            self._forget_key(task_id)
+            self._tasks.pop(task_id, None)
+            self._jobs.pop(task_id, None)
+            self._finished_at.pop(task_id, None)
+            self._versions.pop(task_id, None)
+
+    def purge_expired(self):
+        """Drops finished tasks older than the retention period. Returns the removed ids."""
+        cutoff = time.time() - self.retention
+        with self._lock:
+            expired = [tid for tid, ts in self._finished_at.items() if ts < cutoff]
+            for tid in expired:
+                self._forget_key(tid)
+                self._tasks.pop(tid, None)
+                self._jobs.pop(tid, None)
+                self._versions.pop(tid, None)
+                del self._finished_at[tid]
+            return expired
+
+    def _changed(self, task_id):
+        # Called with the lock held
+        self._version += 1
+        self._versions[task_id] = self._version
+        self._cond.notify_all()
+        if is_terminal(self._tasks[task_id]):
+            self._finished_at.setdefault(task_id, time.time())
+            self._forget_key(task_id)
+        else:
+            self._finished_at.pop(task_id, None)
+
+    def _forget_key(self, task_id):
+        # Called with the lock held
+        key = (self._jobs.get(task_id) or {}).get('key')
+        if key and self._active_keys.get(key) == task_id:
+            del self._active_keys[key]
+
+
+class SQLiteTaskStore(MemoryTaskStore):
+    """Memory store backed by an SQLite WAL database.
+
+    Reads are served from memory. Writes are collected and flushed in one
+    transaction every `flush_interval` seconds; a task reaching a terminal
+    stage is flushed straight away.
+    """
+
+    def __init__(self, path, retention, flush_interval=1.0):
+        super().__init__(retention)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._dirty = set()
+        self._db_lock = threading.Lock()
+        self._flush_now = threading.Event()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            ' task_id TEXT PRIMARY KEY, status TEXT NOT NULL, job TEXT, dedup_key TEXT,'
+            ' version INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, finished REAL)'
+        )
+        self._load()
+        self.purge_expired()
+
+        threading.Thread(target=self._flush_loop, name='task-store-flush', daemon=True).start()
+
+    def _load(self):
+        rows = self._db.execute('SELECT task_id, status, job, dedup_key, finished FROM tasks ORDER BY created').fetchall()
+        for task_id, status, job, dedup_key, finished in rows:
+            self._tasks[task_id] = json.loads(status)
+            self._jobs[task_id] = json.loads(job) if job else None
+            self._version += 1
+            self._versions[task_id] = self._version
+            if finished is not None:
+                self._finished_at[task_id] = finished
+            elif dedup_key:
+                self._active_keys[dedup_key] = task_id
+
+    def create(self, task_id, status, job=None, exclusive=True):
+        holder = super().create(task_id, status, job, exclusive)
+        # New tasks go to disk immediately so a crash right after queuing does not lose them
+        self.flush()
+        return holder
+
+    def delete(self, task_id):
+        super().delete(task_id)
+        with self._lock:
+            self._dirty.discard(task_id)
+        with self._db_lock:
+            self._db.execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+    def purge_expired(self):
+        expired = super().purge_expired()
+        if expired:
+            with self._lock:
+                self._dirty.difference_update(expired)
+            with self._db_lock:
+                self._db.executemany('DELETE FROM tasks WHERE task_id = ?', [(tid,) for tid in expired])
+        return expired
+
+    def _changed(self, task_id):
+        super()._changed(task_id)
+        self._dirty.add(task_id)
+        if task_id in self._finished_at:
+            self._flush_now.set()
+
+    def flush(self):
+        """Writes every task changed since the last flush in a single transaction."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [(tid, json.dumps(self._tasks[tid]), json.dumps(self._jobs.get(tid)), self._held_key(tid),
+                     time.time(), self._finished_at.get(tid))
+                    for tid in dirty if tid in self._tasks]
+        if not rows:
+            return
+        try:
+            with self._db_lock, self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany(
+                    'INSERT INTO tasks (task_id, status, job, dedup_key, created, finished) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT(task_id) DO UPDATE SET status = excluded.status, job = excluded.job,'
+                    ' dedup_key = excluded.dedup_key, finished = excluded.finished',
+                    rows,
+                )
+        except sqlite3.Error:
+            # Keep the rows dirty so the next flush retries them
+            with self._lock:
+                self._dirty.update(row[0] for row in rows)
+            raise
+
+    def _held_key(self, task_id):
+        # Called with the lock held
+        key = (self._jobs.get(task_id) or {}).get('key')
+        return key if key and self._active_keys.get(key) == task_id else None
+
+    def _flush_loop(self):
+        while True:
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Task store flush failed: {e}")
+
+
+class SharedSQLiteTaskStore:
+    """Task store for several processes sharing one SQLite file.
+
+    The database is the source of truth, so a task written by one API worker
+    is visible to all of them. Field updates are buffered per process and
+    merged into the stored row every `flush_interval` seconds; terminal
+    updates are flushed straight away. Versions come from a counter in the
+    same database, so they are ordered across processes. A unique index
+    lets only one unfinished task hold each dedup key.
+    """
+
+    def __init__(self, path, retention, flush_interval=1.0, poll_interval=0.25):
+        self.path = path
+        self.retention = retention
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._flush_now = threading.Event()
+        self._flusher = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        db = self._db()
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS tasks ('
+            ' task_id TEXT PRIMARY KEY, status TEXT NOT NULL, job TEXT, dedup_key TEXT,'
+            ' version INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, finished REAL)'
+        )
+        db.execute('CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished)')
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            # Databases from before the index was unique: finished tasks let go of their keys
+            # and one unfinished task keeps each key
+            db.execute('DROP INDEX IF EXISTS tasks_dedup')
+            db.execute('UPDATE tasks SET dedup_key = NULL WHERE finished IS NOT NULL AND dedup_key IS NOT NULL')
+            db.execute('UPDATE tasks SET dedup_key = NULL WHERE finished IS NULL AND dedup_key IS NOT NULL'
+                       ' AND rowid NOT IN (SELECT min(rowid) FROM tasks WHERE finished IS NULL'
+                       ' AND dedup_key IS NOT NULL GROUP BY dedup_key)')
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tasks_dedup_active ON tasks (dedup_key)'
+                       ' WHERE finished IS NULL')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0)")
+
+    def _db(self):
+        # sqlite3 connections must not be shared between threads, so each thread gets its own
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    # --- READS ---
+    def get(self, task_id, default=None):
+        row = self._db().execute('SELECT status, version FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return default
+        return self._overlay(task_id, row[0], row[1])
+
+    def get_many(self, task_ids, since_version=0):
+        result = {}
+        task_ids = list(task_ids)
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(task_ids), 500):
+            chunk = task_ids[i:i + 500]
+            rows = self._db().execute(
+                f"SELECT task_id, status, version FROM tasks WHERE version > ? AND task_id IN ({','.join('?' * len(chunk))})",
+                [since_version] + chunk,
+            ).fetchall()
+            for task_id, status, version in rows:
+                result[task_id] = self._overlay(task_id, status, version)
+        return result
+
+    def current_version(self):
+        return self._db().execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+
+    def wait_for_change(self, task_id, since_version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.get(task_id)
+            version = status['version'] if status else 0
+            if status is None or version > since_version or time.monotonic() >= deadline:
+                return status, version
+            time.sleep(self.poll_interval)
+
+    def job(self, task_id):
+        row = self._db().execute('SELECT job FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def active_task_for_key(self, key):
+        row = self._db().execute('SELECT task_id FROM tasks WHERE dedup_key = ? AND finished IS NULL LIMIT 1',
+                                 (key,)).fetchone()
+        return row[0] if row else None
+
+    def unfinished(self):
+        rows = self._db().execute('SELECT task_id, job FROM tasks WHERE finished IS NULL ORDER BY created').fetchall()
+        return [(task_id, json.loads(job) if job else None) for task_id, job in rows]
+
+    def _overlay(self, task_id, status, version):
+        # This process's unflushed changes are applied on top of the stored row
+        status = json.loads(status)
+        with self._lock:
+            pending = self._pending.get(task_id)
+        if pending:
+            replace, fields = pending
+            status = dict(fields) if replace else dict(status, **fields)
+        status['version'] = version
+        return status
+
+    # --- WRITES ---
+    def create(self, task_id, status, job=None, exclusive=True):
+        db = self._db()
+        with self._lock:
+            self._pending.pop(task_id, None)
+        key = (job or {}).get('key')
+        with db:
+            # The write lock makes the check and the insert one step for every process
+            db.execute('BEGIN IMMEDIATE')
+            holder = self._holder(db, key, task_id) if key else None
+            if holder and exclusive:
+                return holder
+            version = self._next_version(db)
+            finished = time.time() if is_terminal(status) else None
+            db.execute(
+                'INSERT INTO tasks (task_id, status, job, dedup_key, version, created, finished)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(task_id) DO UPDATE SET status = excluded.status,'
+                ' job = excluded.job, dedup_key = excluded.dedup_key, version = excluded.version,'
+                ' created = excluded.created, finished = excluded.finished',
+                (task_id, json.dumps(status), json.dumps(job), None if holder or finished else key, version,
+                 time.time(), finished),
+            )
+        return holder or task_id
+
+    def claim(self, task_id):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute('SELECT job FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+            key = (json.loads(row[0]) or {}).get('key') if row and row[0] else None
+            if not key:
+                return task_id
+            holder = self._holder(db, key, task_id)
+            if holder:
+                return holder
+            # A retried task may still be marked finished until its new status is flushed
+            db.execute('UPDATE tasks SET dedup_key = ?, finished = NULL, version = ? WHERE task_id = ?',
+                       (key, self._next_version(db), task_id))
+        return task_id
+
+    def set(self, task_id, status):
+        self._buffer(task_id, True, status)
+
+    def set_job(self, task_id, job):
+        db = self._db()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            # The task keeps its claim only if the new job has the same key
+            db.execute('UPDATE tasks SET job = ?, dedup_key = CASE WHEN dedup_key = ? THEN dedup_key END,'
+                       ' version = ? WHERE task_id = ?',
+                       (json.dumps(job), (job or {}).get('key'), self._next_version(db), task_id))
+
+    def update(self, task_id, fields):
+        self._buffer(task_id, False, fields)
+
+    def delete(self, task_id):
+        with self._lock:
+            self._pending.pop(task_id, None)
+        self._db().execute('DELETE FROM tasks WHERE task_id = ?', (task_id,))
+
+    def purge_expired(self):
+        cutoff = time.time() - self.retention
+        db = self._db()
+        expired = [row[0] for row in db.execute('SELECT task_id FROM tasks WHERE finished < ?', (cutoff,))]
+        db.execute('DELETE FROM tasks WHERE finished < ?', (cutoff,))
+        return expired
+
+    def _buffer(self, task_id, replace, fields):
+        with self._lock:
+            pending = self._pending.get(task_id)
+            if pending and not replace:
+                pending[1].update(fields)
+                merged = pending[1]
+            else:
+                self._pending[task_id] = (replace, dict(fields))
+                merged = fields
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name='task-store-flush', daemon=True)
+                self._flusher.start()
+        if merged.get('stage') in TERMINAL_STAGES:
+            self._flush_now.set()
+
+    def _holder(self, db, key, task_id):
+        # Called inside a write transaction
+        row = db.execute('SELECT task_id FROM tasks WHERE dedup_key = ? AND finished IS NULL AND task_id != ? LIMIT 1',
+                         (key, task_id)).fetchone()
+        return row[0] if row else None
+
+    def _next_version(self, db):
+        # Called inside a write transaction
+        db.execute("UPDATE meta SET value = value + 1 WHERE name = 'version'")
+        return db.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+
+    def flush(self):
+        """Merges every buffered change into the database in one transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        db = self._db()
+        try:
+            with db:
+                db.execute('BEGIN IMMEDIATE')
+                for task_id, (replace, fields) in pending.items():
+                    row = db.execute('SELECT status FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+                    if row is None and not replace:
+                        status = dict(fields)
+                    else:
+                        status = dict(fields) if replace else dict(json.loads(row[0]), **fields)
+                    version = self._next_version(db)
+                    finished = time.time() if is_terminal(status) else None
+                    if row is None:
+                        db.execute('INSERT INTO tasks (task_id, status, version, created, finished) VALUES (?, ?, ?, ?, ?)',
+                                   (task_id, json.dumps(status), version, time.time(), finished))
+                    elif finished:
+                        # A finished task gives up its dedup key
+                        db.execute('UPDATE tasks SET status = ?, version = ?, finished = ?, dedup_key = NULL'
+                                   ' WHERE task_id = ?', (json.dumps(status), version, finished, task_id))
+                    else:
+                        db.execute('UPDATE tasks SET status = ?, version = ?, finished = NULL WHERE task_id = ?',
+                                   (json.dumps(status), version, task_id))
+        except sqlite3.Error:
+            # Put the changes back underneath anything buffered since, so the next flush retries them
+            with self._lock:
+                for task_id, (replace, fields) in pending.items():
+                    newer = self._pending.get(task_id)
+                    if newer is None:
+                        self._pending[task_id] = (replace, fields)
+                    elif not newer[0]:
+                        self._pending[task_id] = (replace, dict(fields, **newer[1]))
+            raise
+
+    def _flush_loop(self):
+        last_purge = 0
+        while True:
+            self._flush_now.wait(self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+                if time.time() - last_purge > 60:
+                    last_purge = time.time()
+                    self.purge_expired()
+            except sqlite3.Error as e:
+                print(f"Task store flush failed: {e}")
+
+
+class RedisTaskStore:
+    """Task store in Redis for API processes and download workers on several hosts.
+
+    Each task is a hash holding its status, job and version. Versions come
+    from one counter, so they are ordered across every writer, and field
+    updates are read-modify-write under WATCH so concurrent writers never
+    drop each other's fields. The holder of a dedup key is the active:<key>
+    pointer, which is only ever set while empty: watched along with the task
+    on create(), with SET NX on claim().
+    """
+
+    def __init__(self, url, retention, poll_interval=0.25, prefix='ytdl'):
+        import redis  # Only needed for TASK_STORE=redis
+        self._redis = redis
+        self.r = redis.Redis.from_url(url, decode_responses=True)
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+        self._last_purge = 0
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix, 'tasks') + parts)
+
+    # --- READS ---
+    def get(self, task_id, default=None):
+        status, version = self.r.hmget(self._key('task', task_id), 'status', 'version')
+        if status is None:
+            return default
+        return dict(json.loads(status), version=int(version))
+
+    def get_many(self, task_ids, since_version=0):
+        task_ids = list(task_ids)
+        with self.r.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hmget(self._key('task', task_id), 'status', 'version')
+            rows = pipe.execute()
+        return {task_id: dict(json.loads(status), version=int(version))
+                for task_id, (status, version) in zip(task_ids, rows)
+                if status is not None and int(version) > since_version}
+
+    def current_version(self):
+        return int(self.r.get(self._key('version')) or 0)
+
+    def wait_for_change(self, task_id, since_version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.get(task_id)
+            version = status['version'] if status else 0
+            if status is None or version > since_version or time.monotonic() >= deadline:
+                return status, version
+            time.sleep(self.poll_interval)
+
+    def job(self, task_id):
+        job = self.r.hget(self._key('task', task_id), 'job')
+        return json.loads(job) if job else None
+
+    def active_task_for_key(self, key):
+        return self.r.get(self._key('active', key))
+
+    def unfinished(self):
+        task_ids = self.r.zrange(self._key('unfinished'), 0, -1)
+        with self.r.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.hget(self._key('task', task_id), 'job')
+            jobs = pipe.execute()
+        return [(task_id, json.loads(job) if job else None) for task_id, job in zip(task_ids, jobs)]
+
+    # --- WRITES ---
+    def create(self, task_id, status, job=None, exclusive=True):
+        if time.time() - self._last_purge > 60:
+            self._last_purge = time.time()
+            self.purge_expired()
+        return self._write(task_id, lambda old: dict(status), job, new=True, exclusive=exclusive)
+
+    def claim(self, task_id):
+        dedup_key = (self.job(task_id) or {}).get('key')
+        if not dedup_key:
+            return task_id
+        active = self._key('active', dedup_key)
+        while True:
+            if self.r.set(active, task_id, nx=True):
+                return task_id
+            holder = self.r.get(active)
+            # None: the holder let go in between, so try again
+            if holder:
+                return holder
+
+    def set(self, task_id, status):
+        self._write(task_id, lambda old: dict(status))
+
+    def set_job(self, task_id, job):
+        self._write(task_id, lambda old: old or {}, job, replace_job=True)
+
+    def update(self, task_id, fields):
+        self._write(task_id, lambda old: dict(old or {}, **fields))
+
+    def _write(self, task_id, build, job=None, new=False, replace_job=False, exclusive=True):
+        key = self._key('task', task_id)
+        while True:
+            with self.r.pipeline() as pipe:
+                try:
+                    pipe.watch(key)
+                    old_status, old_job, created = pipe.hmget(key, 'status', 'job', 'created')
+                    status = build(json.loads(old_status) if old_status and not new else None)
+                    old_key = ((json.loads(old_job) if old_job else None) or {}).get('key')
+                    if not new and not replace_job:
+                        job = json.loads(old_job) if old_job else None
+                    created = float(created) if created and not new else time.time()
+                    dedup_key = (job or {}).get('key')
+                    active = holder = None
+                    if dedup_key:
+                        pipe.watch(self._key('active', dedup_key))
+                        active = pipe.get(self._key('active', dedup_key))
+                        if new and active and active != task_id:
+                            holder = active
+                            if exclusive:
+                                return holder
+                    stale_key = old_key if replace_job and old_key and old_key != dedup_key else None
+                    if stale_key:
+                        pipe.watch(self._key('active', stale_key))
+                        stale_active = pipe.get(self._key('active', stale_key))
+                    version = self.r.incr(self._key('version'))
+
+                    pipe.multi()
+                    pipe.hset(key, mapping={'status': json.dumps(status), 'job': json.dumps(job),
+                                            'version': version, 'created': created})
+                    if stale_key and stale_active == task_id:
+                        pipe.delete(self._key('active', stale_key))
+                    if is_terminal(status):
+                        pipe.zrem(self._key('unfinished'), task_id)
+                        pipe.zadd(self._key('finished'), {task_id: time.time()}, nx=True)
+                        if dedup_key and active == task_id:
+                            pipe.delete(self._key('active', dedup_key))
+                    else:
+                        pipe.zadd(self._key('unfinished'), {task_id: created})
+                        pipe.zrem(self._key('finished'), task_id)
+                        # Only a new task claims its key here; a later one goes through claim()
+                        if dedup_key and new and not holder:
+                            pipe.set(self._key('active', dedup_key), task_id)
+                    pipe.execute()
+                    return holder or task_id
+                except self._redis.WatchError:
+                    # Another writer got in between; redo the merge on top of its change
+                    continue
+
+    def delete(self, task_id):
+        job = self.job(task_id)
+        dedup_key = (job or {}).get('key')
+        with self.r.pipeline() as pipe:
+            pipe.delete(self._key('task', task_id))
+            pipe.zrem(self._key('unfinished'), task_id)
+            pipe.zrem(self._key('finished'), task_id)
+            pipe.execute()
+        if dedup_key and self.r.get(self._key('active', dedup_key)) == task_id:
+            self.r.delete(self._key('active', dedup_key))
+
+    def purge_expired(self):
+        expired = self.r.zrangebyscore(self._key('finished'), '-inf', time.time() - self.retention)
+        for task_id in expired:
+            self.delete(task_id)
+        return expired
+
+
+def create_task_store(kind, path, retention, redis_url=None):
+    """Builds the task store selected by the TASK_STORE setting."""
+    if kind == 'memory':
+        return MemoryTaskStore(retention)
+    if kind == 'sqlite':
+        return SQLiteTaskStore(path, retention)
+    if kind == 'shared':
+        return SharedSQLiteTaskStore(path, retention)
+    if kind == 'redis':
+        return RedisTaskStore(redis_url, retention)
+    raise ValueError(f"Unknown task store: {kind}")
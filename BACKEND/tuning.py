@@ -0,0 +1,58 @@
+# Per-download connection knobs accepted by /download and /download/batch under "tuning".
+# name -> (type, minimum, maximum)
+TUNING_OPTIONS = {
+    'fragments': (int, 1, 32),                # DASH/HLS fragments fetched in parallel
+    'http_chunk_size': (int, 0, 1 << 30),     # bytes per HTTP range request; 0 = one request
+    'buffer_size': (int, 1024, 16 << 20),     # initial read buffer in bytes (grows as needed)
+    'retries': (int, 0, 100),                 # per request and per fragment
+    'retry_backoff': (float, 0, 60),          # seconds before the first retry, doubled each time
+    'retry_backoff_max': (float, 0, 600),     # ceiling for the doubling
+}
+
+
+def parse_tuning(raw):
+    """Validates a request's tuning object. Returns a dict of the given knobs; raises ValueError."""
+    if raw is None:
+        return {}
+    if not isinstance(raw, dict):
+        raise ValueError("tuning must be an object")
+    tuning = {}
+    for name, value in raw.items():
+        if name not in TUNING_OPTIONS:
+            raise ValueError(f"Unknown tuning option: {name}")
+        kind, low, high = TUNING_OPTIONS[name]
+        valid_type = isinstance(value, int) if kind is int else isinstance(value, (int, float))
+        if isinstance(value, bool) or not valid_type or not low <= value <= high:
+            raise ValueError(f"tuning.{name} must be a{'n integer' if kind is int else ' number'} "
+                             f"between {low} and {high}")
+        tuning[name] = value
+    return tuning
+
+
+def fragment_share(budget, active, slots, queued):
+    """Default parallel fragments for a download starting now.
+
+    While nothing waits in the queue the budget is split between the downloads
+    actually running, so a lone download gets most of the link; once jobs are
+    waiting every slot is assumed busy and gets an even share.
+    """
+    share = budget // max(1, slots) if queued else budget // max(1, active)
+    return max(1, min(TUNING_OPTIONS['fragments'][2], share))
+
+
+def ydl_tuning_options(tuning):
+    """Maps a complete set of knobs onto yt-dlp options."""
+    base, ceiling = tuning['retry_backoff'], tuning['retry_backoff_max']
+
+    # yt-dlp calls these as func(n=<retries so far>)
+    def backoff(n):
+        return min(ceiling, base * 2 ** n)
+
+    return {
+        'concurrent_fragment_downloads': tuning['fragments'],
+        'http_chunk_size': tuning['http_chunk_size'] or None,
+        'buffersize': tuning['buffer_size'],
+        'retries': tuning['retries'],
+        'fragment_retries': tuning['retries'],
+        'retry_sleep_functions': {'http': backoff, 'fragment': backoff},
+    }
@@ -0,0 +1,34 @@
+# Standalone download node: python worker.py
+#
+# Pulls download jobs from the shared queue (TASK_STORE=shared on one host, redis across
+# hosts) and runs the same pipeline as the API process, MAX_CONCURRENT_DOWNLOADS at a time.
+# Every node must mount the same downloads folder. Progress goes to the shared task store,
+# and the scheduler heartbeats so jobs of a node that dies are re-leased to the others.
+# Run the API with NODE_ROLE=api to leave all downloading to the workers.
+import os
+import signal
+import threading
+
+# Seconds to wait for running downloads on SIGTERM before handing them back to the queue
+DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', '60'))
+
+
+def main():
+    # Not at module level: post-processing children are spawned, and re-import this script
+    # as __mp_main__; importing api there would start another scheduler in every one of them
+    os.environ['NODE_ROLE'] = 'worker'
+    import api  # Reads NODE_ROLE at import
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    print(f"Worker {api.SCHEDULER.owner} running up to {api.MAX_CONCURRENT_DOWNLOADS} downloads "
+          f"from the {api.TASK_STORE} queue", flush=True)
+    stop.wait()
+    released = api.shutdown(DRAIN_TIMEOUT)
+    print(f"Worker {api.SCHEDULER.owner} stopped; {len(released)} unfinished downloads handed back", flush=True)
+
+
+if __name__ == '__main__':
+    main()
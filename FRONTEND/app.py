@@ -1,6 +1,6 @@
 import streamlit as st
 import requests
-import time
+import json
 
 # --- CONFIGURATION ---
 st.set_page_config(
@@ -12,6 +12,7 @@ st.set_page_config(
 
 # --- CONSTANTS ---
 BACKEND_URL = "http://yt-backend:5000"
+SIDEBAR_FILE_LIMIT = 100
 
 
 # --- SESSION STATE ---
@@ -27,6 +28,8 @@ if 'playing_file' not in st.session_state:
     st.session_state.playing_file = None
 if 'delete_confirm' not in st.session_state:
     st.session_state.delete_confirm = None
+if 'files_cache' not in st.session_state:
+    st.session_state.files_cache = None  # (etag, response json) of the last /files call
 
 # --- DYNAMIC BACKGROUNDS ---
 bg_video = "radial-gradient(circle at 50% 10%, #032411 0%, #163417 60%, #0e602c 100%)"
@@ -653,7 +656,8 @@ def trigger_download(type_mode, quality):
         }
         # POST request to the /download endpoint to start the job
         r = requests.post(f"{BACKEND_URL}/download", json=payload)
-        if r.status_code == 202:
+        # 200 means the same download already exists; its task reports finished straight away
+        if r.status_code in (200, 202):
             st.session_state.task_id = r.json()['task_id']
         else:
              st.error(f"Download start failed. Code: {r.status_code}")
@@ -672,9 +676,17 @@ def display_sidebar():
     # Fetch files
     files_html = ""
     try:
-        r = requests.get(f"{BACKEND_URL}/files", timeout=2)
-        if r.status_code == 200:
+        # Revalidate the last listing; the backend answers 304 when nothing changed
+        cached = st.session_state.files_cache
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        r = requests.get(f"{BACKEND_URL}/files", params={"limit": SIDEBAR_FILE_LIMIT}, headers=headers, timeout=2)
+        data = None
+        if r.status_code == 304 and cached:
+            data = cached[1]
+        elif r.status_code == 200:
             data = r.json()
+            st.session_state.files_cache = (r.headers['ETag'], data) if 'ETag' in r.headers else None
+        if data is not None:
             files = data.get('files', [])
             
             if files:
@@ -912,11 +924,14 @@ if st.session_state.video_data:
 
         else: # Audio Mode
             st.markdown("##### 🎵 Select Bitrate")
-            col1, col2 = st.columns(2)
+            col1, col2, col3 = st.columns(3)
             with col1:
                 if st.button("💎 BEST", use_container_width=True): trigger_download('audio', '320k')
             with col2:
                 if st.button("Normal (128k)", use_container_width=True): trigger_download('audio', '128k')
+            with col3:
+                # The source stream as it is (m4a/opus), no re-encode
+                if st.button("⚡ Original", use_container_width=True): trigger_download('audio', 'original')
 
     # 6. PROGRESS BAR
     if st.session_state.task_id:
@@ -926,35 +941,36 @@ if st.session_state.video_data:
             p_bar = st.progress(0)
             lbl = st.empty()
 
-            check_count = 0
-            max_checks = 120
-
-            while check_count < max_checks:
-                time.sleep(0.5)
-                check_count += 1
-                try:
-                    # GET request to the /status endpoint
-                    r = requests.get(f"{BACKEND_URL}/status/{st.session_state.task_id}")
-                    d = r.json()
-                    state = d.get('status')
-
-                    p_bar.progress(int(d.get('progress', 0)))
-                    lbl.caption(f"Status: {state} | Speed: {d.get('speed')}")
-
-                    if state == 'finished':
-                        status.update(label="✅ Complete!", state="complete", expanded=False)
-                        st.balloons()
-                        st.session_state.task_id = None
-                        break
-                    if 'error' in state:
-                        status.update(label="❌ Error", state="error")
-                        st.error(f"Download failed: {state}")
-                        st.session_state.task_id = None
-                        break
-                except requests.exceptions.ConnectionError:
-                    lbl.caption("❌ Lost connection to the backend...")
-                    break
-
-            if st.session_state.task_id and check_count >= max_checks:
-                status.update(label="⚠️ Timeout", state="error")
-                st.error("Status check timed out. Please check your Docker logs.")
+            try:
+                # One long-lived connection; the backend pushes an event whenever the task changes
+                with requests.get(f"{BACKEND_URL}/status/{st.session_state.task_id}/stream",
+                                  stream=True, timeout=(5, 60)) as r:
+                    for line in r.iter_lines(decode_unicode=True):
+                        if not line or not line.startswith('data: '):
+                            continue
+                        d = json.loads(line[len('data: '):])
+                        state = d.get('status')
+
+                        p_bar.progress(int(d.get('progress', 0)))
+                        lbl.caption(f"Status: {state} | Speed: {d.get('speed')}")
+
+                        if state == 'finished':
+                            status.update(label="✅ Complete!", state="complete", expanded=False)
+                            st.balloons()
+                            st.session_state.task_id = None
+                            break
+                        if state == 'cancelled':
+                            status.update(label="🚫 Cancelled", state="error", expanded=False)
+                            st.session_state.task_id = None
+                            break
+                        if 'error' in state:
+                            status.update(label="❌ Error", state="error")
+                            st.error(f"Download failed: {state}")
+                            st.session_state.task_id = None
+                            break
+            except requests.exceptions.ConnectionError:
+                lbl.caption("❌ Lost connection to the backend...")
+
+            if st.session_state.task_id:
+                status.update(label="⚠️ Connection Closed", state="error")
+                st.error("Status stream ended early. Please check your Docker logs.")